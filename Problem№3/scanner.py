@@ -1,144 +1,1030 @@
-from socket import socket, AF_INET, SOCK_STREAM, SOCK_DGRAM, timeout
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from socket import (socket, gethostbyname, inet_aton, inet_ntoa, AF_INET, SOCK_STREAM, SOCK_DGRAM, SOL_SOCKET,
+                    SO_ERROR, SO_LINGER, SO_RCVBUF, IPPROTO_IP)
 from argparse import ArgumentParser
+from collections import Counter, deque
+from collections.abc import Iterable, Iterator
+from itertools import count
+from bisect import bisect_right
+import csv
+import errno
+import heapq
+import ipaddress
+import json
+import os
+import random
+import re
+import selectors
+import struct
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    from socket import MSG_ERRQUEUE
+except ImportError:
+    MSG_ERRQUEUE = None
+
+try:
+    from socket import IP_RECVERR
+except ImportError:
+    IP_RECVERR = 11 if sys.platform.startswith('linux') else None
+
+
+# Адаптивный таймаут соединения не выходит за эти границы, с
+MIN_TIMEOUT = 0.1
+MAX_TIMEOUT = 3.0
+DEFAULT_TIMEOUT = 1.0
+DEFAULT_PARALLEL = 2000
+# Одновременных запросов к одному хосту, чтобы при обходе малого числа хостов не заваливать каждый из них
+HOST_PARALLEL = 1000
+# Оценки времени ответа храним для стольких последних хостов, остальные начинают с общей оценки
+MAX_ESTIMATORS = 4096
+# Столько пар (хост, порт) для занятых хостов можно отложить, прежде чем перестать читать новые
+MAX_DEFERRED = 100000
+# Дескрипторы, которые оставляем процессу помимо сокетов сканирования
+RESERVED_FILES = 64
+# Как часто по умолчанию сохранять состояние обхода, с
+CHECKPOINT_INTERVAL = 10.0
+
+OPEN, CLOSED, FILTERED, OPEN_FILTERED = 'open', 'closed', 'filtered', 'open|filtered'
+# SO_LINGER с нулевым таймаутом: close() отправляет RST, и просканированные соединения
+# не остаются в TIME_WAIT, занимая локальные порты
+LINGER_RESET = struct.pack('ii', 1, 0)
+IN_PROGRESS = {errno.EINPROGRESS, getattr(errno, 'WSAEWOULDBLOCK', errno.EINPROGRESS)}
+# Кончились локальные порты или буферы ядра: попытку повторяем позже, а не считаем порт закрытым
+RETRY_LATER = {errno.EADDRNOTAVAIL, errno.EAGAIN, errno.ENOBUFS}
+
+
+# Самые частые открытые порты по nmap-services, по убыванию частоты
+TOP_TCP_PORTS = [
+    80, 23, 443, 21, 22, 25, 3389, 110, 445, 139, 143, 53, 135, 3306, 8080, 1723, 111, 995, 993, 5900,
+    1025, 587, 8888, 199, 1720, 465, 548, 113, 81, 6001, 10000, 514, 5060, 179, 1026, 2000, 8443, 8000, 32768, 554,
+    26, 1433, 49152, 2001, 515, 8008, 49154, 1027, 5666, 646, 5000, 5631, 631, 49153, 8081, 2049, 88, 79, 5800, 106,
+    2121, 1110, 49155, 6000, 513, 990, 5357, 427, 49156, 543, 544, 5101, 144, 7, 389, 8009, 3128, 444, 9999, 5009,
+    7070, 5190, 3000, 5432, 1900, 3986, 13, 1029, 9, 5051, 6646, 49157, 1028, 873, 1755, 2717, 4899, 9100, 119, 37,
+]
+TOP_UDP_PORTS = [
+    631, 161, 137, 123, 138, 1434, 445, 135, 67, 53, 139, 500, 68, 520, 1900, 4500, 514, 49152, 162, 69,
+    5353, 111, 49154, 1701, 998, 996, 997, 999, 3283, 49153,
+]
 
 
 def parse_ports(ports: str) -> list[int]:
-    if '-' in ports:
-        start, end = map(int, ports.split('-'))
-        return list(range(start, end + 1))
+    # Список через запятую из портов и диапазонов: 22,80,8000-8100. Повторы убираются
+    result = {}
+    for item in ports.split(','):
+        if '-' in item:
+            start, end = map(int, item.split('-'))
+            result.update(dict.fromkeys(range(start, end + 1)))
+        elif item.strip():
+            result[int(item)] = None
+    if not result or min(result) < 1 or max(result) > 65535:
+        raise ValueError(f'Неверный набор портов: {ports}')
+    return list(result)
+
+
+def parse_targets(targets: Iterable[str]) -> list[tuple[int, int]]:
+    # Хосты, IP-адреса и сети CIDR -> отсортированные непересекающиеся диапазоны адресов (первый, количество).
+    # В сетях больше /31 адрес сети и широковещательный не сканируются
+    ranges = []
+    for target in targets:
+        target = target.strip()
+        if not target or target.startswith('#'):
+            continue
+        if '/' in target:
+            network = ipaddress.IPv4Network(target, strict=False)
+            first, size = int(network.network_address), network.num_addresses
+            if size > 2:
+                first, size = first + 1, size - 2
+        else:
+            first, size = int(ipaddress.IPv4Address(gethostbyname(target))), 1
+        ranges.append((first, size))
+    ranges.sort()
+    merged = []
+    for first, size in ranges:
+        if merged and first <= merged[-1][0] + merged[-1][1]:
+            last_first, last_size = merged[-1]
+            merged[-1] = (last_first, max(last_size, first + size - last_first))
+        else:
+            merged.append((first, size))
+    return merged
+
+
+class TargetSpace:
+    # Все пары (хост, порт) в случайном порядке без хранения списка: номер пары проходит полный цикл
+    # линейного конгруэнтного генератора по модулю 2^k (a = 1 mod 4, c нечетное - теорема Халла-Добелла),
+    # номера за пределами числа пар пропускаются. Младшие разряды номера задают хост, поэтому соседние
+    # запросы уходят на разные хосты
+    def __init__(self, ranges: list[tuple[int, int]], ports: list[int], seed: int | None = None):
+        self.ranges = ranges
+        self.ports = ports
+        self.port_index = {port: i for i, port in enumerate(ports)}
+        self.firsts = [first for first, _ in ranges]
+        self.starts = []
+        self.hosts = 0
+        for first, size in ranges:
+            self.starts.append(self.hosts)
+            self.hosts += size
+        self.size = self.hosts * len(ports)
+        rng = random.Random(seed)
+        self.modulus = 1 << max(1, (self.size - 1).bit_length())
+        self.multiplier = rng.randrange(0, self.modulus, 4) + 1
+        self.increment = rng.randrange(1, self.modulus, 2)
+        self.start = rng.randrange(self.modulus)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def host(self, index: int) -> str:
+        position = bisect_right(self.starts, index) - 1
+        return inet_ntoa((self.ranges[position][0] + index - self.starts[position]).to_bytes(4, 'big'))
+
+    def pair(self, value: int) -> tuple[str, int]:
+        return self.host(value % self.hosts), self.ports[value // self.hosts]
+
+    def index(self, host: str, port: int) -> int:
+        # Обратное к pair: номер пары по хосту и порту
+        address = int.from_bytes(inet_aton(host), 'big')
+        position = bisect_right(self.firsts, address) - 1
+        return self.starts[position] + address - self.firsts[position] + self.port_index[port] * self.hosts
+
+    def __iter__(self) -> Iterator[tuple[str, int]]:
+        size, modulus, multiplier, increment = self.size, self.modulus, self.multiplier, self.increment
+        value = self.start
+        for _ in range(modulus):
+            value = (multiplier * value + increment) % modulus
+            if value < size:
+                yield self.pair(value)
+
+
+class ScanProgress:
+    # Обход TargetSpace, который можно сохранить и продолжить. Пары выдаются в порядке перестановки:
+    # все пары до шага position уже выданы сканеру, и из них не завершены только pending (номера пар).
+    # При продолжении сначала повторяются pending, затем обход идет с position. Пары из done
+    # (завершенные после последнего сохранения и найденные в журнале результатов) пропускаются
+    def __init__(self, space: TargetSpace, state: dict | None = None, done: Iterable[int] = ()):
+        self.space = space
+        self.position = state['position'] if state else 0
+        self.value = state['value'] if state else space.start
+        self.done = set(done)
+        self.pending = set(state['pending']) - self.done if state else set()
+
+    @property
+    def finished(self) -> bool:
+        return self.position == self.space.modulus and not self.pending
+
+    def __iter__(self) -> Iterator[tuple[str, int]]:
+        space, done = self.space, self.done
+        for value in sorted(self.pending):
+            yield space.pair(value)
+        size, modulus, multiplier, increment = space.size, space.modulus, space.multiplier, space.increment
+        while self.position < modulus:
+            self.value = (multiplier * self.value + increment) % modulus
+            self.position += 1
+            if self.value < size and self.value not in done:
+                self.pending.add(self.value)
+                yield space.pair(self.value)
+
+    def complete(self, host: str, port: int) -> None:
+        self.pending.discard(self.space.index(host, port))
+
+    def state(self) -> dict:
+        return {'position': self.position, 'value': self.value, 'pending': sorted(self.pending)}
+
+
+class HostSlots:
+    # Раздает пары (хост, порт) сканеру, держа не больше limit незавершенных запросов на хост.
+    # Пары для занятых хостов откладываются и выдаются, когда хост освобождается
+    def __init__(self, targets: Iterable[tuple[str, int]], limit: int):
+        self.targets = iter(targets)
+        self.limit = limit
+        self.busy = {}
+        self.deferred = {}
+        self.deferred_count = 0
+        self.ready = deque()
+        self.exhausted = False
+
+    @property
+    def done(self) -> bool:
+        return self.exhausted and not self.deferred
+
+    def take(self) -> tuple[str, int] | None:
+        # Следующая пара или None, если сейчас выдать нечего
+        while self.ready:
+            host = self.ready.popleft()
+            queue = self.deferred.get(host)
+            if queue and self.busy.get(host, 0) < self.limit:
+                port = queue.popleft()
+                self.deferred_count -= 1
+                if not queue:
+                    del self.deferred[host]
+                self.busy[host] = self.busy.get(host, 0) + 1
+                return host, port
+        while not self.exhausted and self.deferred_count < MAX_DEFERRED:
+            target = next(self.targets, None)
+            if target is None:
+                self.exhausted = True
+                break
+            host, port = target
+            busy = self.busy.get(host, 0)
+            if busy < self.limit:
+                self.busy[host] = busy + 1
+                return target
+            self.deferred.setdefault(host, deque()).append(port)
+            self.deferred_count += 1
+        return None
+
+    def release(self, host: str) -> None:
+        busy = self.busy[host] - 1
+        if busy:
+            self.busy[host] = busy
+        else:
+            del self.busy[host]
+        if host in self.deferred:
+            self.ready.append(host)
+
+
+class ScanResults:
+    # Итоги обхода в компактном виде: по каждому хосту с открытыми портами - битовая маска по номерам
+    # портов в списке сканирования (целое число Python), протоколы открытых портов и общие счетчики состояний
+    def __init__(self, ports: list[int]):
+        self.ports = ports
+        self.index = {port: i for i, port in enumerate(ports)}
+        self.open = {}
+        self.protocols = {}
+        self.states = Counter()
+
+    def add(self, host: str, port: int, state: str, protocol: str | None) -> None:
+        self.states[state] += 1
+        if state == OPEN:
+            self.open[host] = self.open.get(host, 0) | 1 << self.index[port]
+            if protocol is not None and protocol != UNKNOWN:
+                self.protocols[host, port] = protocol
+
+    def open_ports(self, host: str) -> list[int]:
+        mask = self.open.get(host, 0)
+        return [port for i, port in enumerate(self.ports) if mask >> i & 1]
+
+    def state(self) -> dict:
+        return {'open': self.open, 'protocols': [[host, port, protocol] for (host, port), protocol in
+                                                 self.protocols.items()], 'states': self.states}
+
+    def load(self, state: dict) -> None:
+        self.open.update(state['open'])
+        self.protocols.update(((host, port), protocol) for host, port, protocol in state['protocols'])
+        self.states.update(state['states'])
+
+
+class ResultWriter:
+    # Потоковый вывод результатов в JSON Lines или CSV: строка на каждую пару (хост, порт), сброс на диск
+    # сразу после записи, чтобы после остановки сканера в файле были все полученные результаты
+    FIELDS = ['proto', 'host', 'port', 'state', 'protocol']
+
+    def __init__(self, path: str, format: str, offset: int | None = None):
+        self.format = format
+        self.file = open(path, 'a' if offset is not None else 'w', encoding='utf-8', newline='')
+        if format == 'csv':
+            self.csv = csv.writer(self.file)
+            if not offset:
+                self.csv.writerow(self.FIELDS)
+                self.file.flush()
+
+    def write(self, proto: str, host: str, port: int, state: str, protocol: str | None) -> None:
+        if self.format == 'csv':
+            self.csv.writerow([proto, host, port, state, protocol or ''])
+        else:
+            self.file.write(json.dumps(dict(zip(self.FIELDS, (proto, host, port, state, protocol)))) + '\n')
+        self.file.flush()
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def read_journal(path: str, format: str, offset: int) -> list[tuple[str, str, int, str, str | None]]:
+    # Результаты, записанные после сохранения состояния (с позиции offset). Оборванная последняя строка
+    # отрезается, чтобы дописывать файл с целой строки
+    with open(path, 'r+b') as file:
+        file.seek(offset)
+        tail = file.read()
+        complete = tail[:tail.rfind(b'\n') + 1]
+        file.truncate(offset + len(complete))
+    lines = complete.decode('utf-8').splitlines()
+    if format == 'csv':
+        if offset == 0:
+            lines = lines[1:]
+        rows = csv.reader(lines)
     else:
-        return [int(ports)]
+        rows = ([row[field] for field in ResultWriter.FIELDS] for row in map(json.loads, lines))
+    return [(proto, host, int(port), state, protocol or None) for proto, host, port, state, protocol in rows]
 
 
-def check_tcp_port(host: str, port: int) -> tuple[str, int] | None:
-    with socket(AF_INET, SOCK_STREAM) as tcp:
-        tcp.settimeout(1)
-        result = tcp.connect_ex((host, port))
-        return ('TCP', port) if result == 0 else None
+def save_checkpoint(path: str, state: dict) -> None:
+    # Запись через временный файл: при остановке во время записи остается прежнее состояние
+    temporary = path + '.tmp'
+    with open(temporary, 'w', encoding='utf-8') as file:
+        json.dump(state, file)
+    os.replace(temporary, path)
 
 
-def check_udp_port(host: str, port: int) -> tuple[str, int] | None:
-    try:
-        with socket(AF_INET, SOCK_DGRAM) as udp:
-            udp.settimeout(3)
-            udp.sendto(b'', (host, port))
-            udp.recvfrom(1024)
-            return 'UDP', port
-    except timeout:
-        return 'UDP', port
-    except Exception:
+def raise_file_limit() -> int:
+    # Каждое соединение в полете занимает дескриптор: поднимаем мягкий лимит до жесткого
+    if resource is None:
+        return 512
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY:
+        hard = 1 << 20
+    if soft != resource.RLIM_INFINITY and soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (ValueError, OSError):
+            pass
+    return hard if soft == resource.RLIM_INFINITY else soft
+
+
+class RTTEstimator:
+    # Оценка времени ответа хоста по RFC 6298: таймаут = SRTT + 4 * RTTVAR
+    def __init__(self, initial: float):
+        self.initial = initial
+        self.srtt = None
+        self.rttvar = 0.0
+
+    def sample(self, rtt: float) -> None:
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar += (abs(self.srtt - rtt) - self.rttvar) / 4
+            self.srtt += (rtt - self.srtt) / 8
+
+    @property
+    def timeout(self) -> float:
+        if self.srtt is None:
+            return self.initial
+        return min(max(self.srtt + 4 * self.rttvar, MIN_TIMEOUT), MAX_TIMEOUT)
+
+
+class RateLimiter:
+    # Ведро токенов: не больше rate пакетов в секунду, всплеск - до 10 мс трафика
+    def __init__(self, rate: float):
+        self.set_rate(rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def set_rate(self, rate: float) -> None:
+        self.rate = rate
+        self.capacity = max(1.0, rate / 100)
+
+    def delay(self, now: float, packets: int = 1) -> float:
+        # 0, если пакеты можно отправить сейчас (токены списаны, возможно в долг), иначе сколько ждать
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        needed = min(packets, self.capacity)
+        if self.tokens >= needed:
+            self.tokens -= packets
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+
+# Сигнатуры начала ответа сервера, собранные в одно регулярное выражение с именованными группами.
+# Порядок важен: первой совпадает более точная сигнатура (FTP и SMTP оба приветствуют кодом 220)
+SIGNATURES = [
+    ('SSH', rb'SSH-\d+\.\d+-'),
+    ('FTP', rb'220[ -][^\r\n]*(?i:ftp)'),
+    ('SMTP', rb'220[ -]'),
+    ('POP3', rb'\+OK'),
+    ('IMAP', rb'\* (?:OK|PREAUTH)'),
+    ('MySQL', rb'.\x00\x00\x00\x0a\d'),
+    ('VNC', rb'RFB \d{3}\.\d{3}\n'),
+    ('HTTP', rb'HTTP/\d'),
+]
+SIGNATURE_RE = re.compile(b'|'.join(b'(?P<%s>%s)' % (name.encode(), pattern) for name, pattern in SIGNATURES),
+                          re.S)
+# Запрос для серверов, которые молчат, пока клиент не заговорит первым
+ACTIVE_PROBE = b'GET / HTTP/1.0\r\n\r\n'
+MAX_BANNER_SIZE = 4096
+UNKNOWN = 'Unknown'
+
+
+class ServiceProbe:
+    # Определение протокола на соединении, открытом сканером: сначала пассивно ждем баннер,
+    # и только если он ничего не сказал, отправляем один активный запрос
+    __slots__ = ('data', 'probed', 'deadline')
+
+    def __init__(self, deadline: float):
+        self.data = b''
+        self.probed = False
+        self.deadline = deadline
+
+    def advance(self, sock: socket, now: float, probe_timeout: float, expired: bool) -> str | None:
+        # Протокол, если он уже ясен, иначе None (срок ожидания при этом может сдвинуться)
+        if not expired:
+            try:
+                chunk = sock.recv(MAX_BANNER_SIZE)
+            except BlockingIOError:
+                return None
+            except OSError:
+                chunk = b''
+            if not chunk:
+                return UNKNOWN
+            self.data = (self.data + chunk)[:MAX_BANNER_SIZE]
+            match = SIGNATURE_RE.match(self.data)
+            if match:
+                return match.lastgroup
+            # Строка баннера еще не дошла целиком
+            if b'\n' not in self.data and len(self.data) < MAX_BANNER_SIZE:
+                return None
+        if self.probed:
+            return UNKNOWN if expired else None
+        self.probed = True
+        self.deadline = now + probe_timeout
+        try:
+            sock.send(ACTIVE_PROBE)
+        except OSError:
+            return UNKNOWN
         return None
 
 
-def check_http(tcp_socket: socket) -> bool:
-    try:
-        tcp_socket.send(b'GET / HTTP/1.0\r\n\r\n')
-        response = tcp_socket.recv(1024)
-        return b'HTTP/' in response
-    except Exception:
-        return False
+class Scanner:
+    # Общее для TCP и UDP: ограничения, оценки времени ответа хостов и счетчики
+    def __init__(self, parallel: int, rate: float, timeout: float, retries: int, host_parallel: int):
+        self.parallel = parallel
+        self.rate = rate
+        self.timeout = timeout
+        self.retries = retries
+        self.host_parallel = host_parallel
+        # Оценки по последним хостам и общая по всем: с нее начинает хост, которого еще не мерили
+        self.rtt = {}
+        self.overall = RTTEstimator(timeout)
+        self.stats = Counter()
 
+    def estimator(self, host: str) -> RTTEstimator:
+        estimator = self.rtt.get(host)
+        if estimator is None:
+            if len(self.rtt) >= MAX_ESTIMATORS:
+                del self.rtt[next(iter(self.rtt))]
+            estimator = self.rtt[host] = RTTEstimator(self.overall.timeout)
+        return estimator
 
-def check_smtp(tcp_socket: socket) -> bool:
-    try:
-        response = tcp_socket.recv(1024)
-        if response.startswith(b'220'):
-            return True
-        tcp_socket.send(b'EHLO example.com\r\n')
-        response = tcp_socket.recv(1024)
-        return response.startswith(b'250')
-    except Exception:
-        return False
+    def sample(self, host: str, rtt: float) -> None:
+        self.estimator(host).sample(rtt)
+        self.overall.sample(rtt)
 
+    def scan(self, targets: Iterable[tuple[str, int]]) -> Iterator[tuple[str, int, str, str | None]]:
+        # Выдает (хост, порт, состояние, протокол) по мере готовности; хосты - IP-адреса.
+        # Хост освобождается сразу по готовности результата, до того как сканер возьмет следующие пары
+        slots = HostSlots(targets, self.host_parallel)
+        for result in self.run(slots):
+            slots.release(result[0])
+            yield result
 
-def check_pop3(tcp_socket: socket) -> bool:
-    try:
-        response = tcp_socket.recv(1024)
-        if response.startswith(b'+OK'):
-            return True
-        tcp_socket.send(b'USER test\r\n')
-        response = tcp_socket.recv(1024)
-        return response.startswith(b'+OK')
-    except Exception:
-        return False
-
-
-def detect_tcp_protocol(host, port):
-    protocols = [
-        ('HTTP', check_http),
-        ('SMTP', check_smtp),
-        ('POP3', check_pop3),
-    ]
-    for name, checker in protocols:
+    def run(self, slots: HostSlots) -> Iterator[tuple[str, int, str, str | None]]:
+        raise NotImplementedError
+
+
+class TCPScanner(Scanner):
+    # Connect-сканер на неблокирующих сокетах: тысячи соединений в полете в одном потоке (epoll в Linux).
+    # Таймаут подстраивается под измеренное время ответа каждого хоста, SYN-пакеты ограничены по частоте
+    def __init__(self, parallel: int = DEFAULT_PARALLEL, rate: float = 0.0, timeout: float = DEFAULT_TIMEOUT,
+                 retries: int = 1, detect: bool = False, probe_timeout: float = DEFAULT_TIMEOUT,
+                 host_parallel: int = HOST_PARALLEL):
+        super().__init__(max(1, min(parallel, raise_file_limit() - RESERVED_FILES)), rate, timeout, retries,
+                         host_parallel)
+        self.detect = detect
+        self.probe_timeout = probe_timeout
+
+    def run(self, slots: HostSlots) -> Iterator[tuple[str, int, str, str | None]]:
+        # Протокол определяется только для открытых портов и только если включено detect
+        retry = deque()
+        limiter = RateLimiter(self.rate) if self.rate else None
+        selector = selectors.DefaultSelector()
+        # сокет -> (хост, порт, попытка, время отправки) для соединений в процессе установки
+        pending = {}
+        # сокет -> (хост, порт, ServiceProbe) для открытых соединений, на которых определяется протокол
+        sessions = {}
+        # Сроки лежат в куче с ленивым удалением: устаревшие записи пропускаются при извлечении
+        deadlines = []
+        order = count()
         try:
-            with socket(AF_INET, SOCK_STREAM) as tcp:
-                tcp.settimeout(1)
-                tcp.connect((host, port))
-                if checker(tcp):
-                    return name
-        except Exception:
-            continue
-    return 'Unknown'
+            while True:
+                now = time.monotonic()
+                wait = None
+                while len(pending) + len(sessions) < self.parallel:
+                    if retry:
+                        host, port, attempt = retry.popleft()
+                    else:
+                        target = slots.take()
+                        if target is None:
+                            break
+                        (host, port), attempt = target, 0
+                    if limiter is not None:
+                        wait = limiter.delay(now)
+                        if wait:
+                            retry.appendleft((host, port, attempt))
+                            break
+                    sock = socket(AF_INET, SOCK_STREAM)
+                    sock.setblocking(False)
+                    sock.setsockopt(SOL_SOCKET, SO_LINGER, LINGER_RESET)
+                    code = sock.connect_ex((host, port))
+                    self.stats['sent'] += 1
+                    if code in IN_PROGRESS:
+                        pending[sock] = (host, port, attempt, now)
+                        selector.register(sock, selectors.EVENT_WRITE)
+                        heapq.heappush(deadlines, (now + self.estimator(host).timeout, next(order), sock))
+                        continue
+                    if code in RETRY_LATER:
+                        sock.close()
+                        if not pending and not sessions:
+                            raise OSError(code, f'Не удалось начать соединение с {host}:{port}')
+                        self.stats['deferred'] += 1
+                        retry.appendleft((host, port, attempt))
+                        break
+                    state = self.classify(code)
+                    if state == OPEN and self.detect:
+                        selector.register(sock, selectors.EVENT_READ)
+                        self.start_probe(sock, host, port, now, sessions, deadlines, order)
+                        continue
+                    sock.close()
+                    yield host, port, state, None
 
+                if not pending and not sessions:
+                    if slots.done and not retry:
+                        return
+                    time.sleep(wait or 0)
+                    continue
 
-def check_dns(host: str, port: int) -> bool:
-    try:
-        query = b'\xab\xcd\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x07example\x03com\x00\x00\x01\x00\x01'
-        with socket(AF_INET, SOCK_DGRAM) as udp:
-            udp.settimeout(1)
-            udp.sendto(query, (host, port))
-            data, _ = udp.recvfrom(1024)
-            return data[:2] == b'\xab\xcd' and len(data) >= 12
-    except Exception:
-        return False
+                timeout = max(0.0, deadlines[0][0] - now)
+                if wait is not None:
+                    timeout = min(timeout, wait)
+                events = selector.select(timeout)
+                now = time.monotonic()
+                # Сначала готовые сокеты, потом просроченные: ответ, пришедший вместе со сроком, не теряется
+                for key, _ in events:
+                    sock = key.fileobj
+                    entry = pending.pop(sock, None)
+                    if entry is None:
+                        host, port, probe = sessions[sock]
+                        deadline = probe.deadline
+                        service = probe.advance(sock, now, self.probe_timeout, False)
+                        if service is None:
+                            if probe.deadline != deadline:
+                                heapq.heappush(deadlines, (probe.deadline, next(order), sock))
+                            continue
+                        del sessions[sock]
+                        selector.unregister(sock)
+                        sock.close()
+                        yield host, port, OPEN, service
+                        continue
+                    host, port, attempt, sent = entry
+                    code = sock.getsockopt(SOL_SOCKET, SO_ERROR)
+                    state = self.classify(code)
+                    if state != FILTERED:
+                        self.sample(host, now - sent)
+                    if state == OPEN and self.detect:
+                        # То же соединение, что показало открытый порт, используется для определения протокола
+                        selector.modify(sock, selectors.EVENT_READ)
+                        self.start_probe(sock, host, port, now, sessions, deadlines, order)
+                        continue
+                    selector.unregister(sock)
+                    sock.close()
+                    yield host, port, state, None
+                while deadlines and deadlines[0][0] <= now:
+                    _, _, sock = heapq.heappop(deadlines)
+                    entry = pending.pop(sock, None)
+                    if entry is not None:
+                        selector.unregister(sock)
+                        sock.close()
+                        host, port, attempt, _ = entry
+                        self.stats['timeouts'] += 1
+                        if attempt < self.retries:
+                            retry.append((host, port, attempt + 1))
+                        else:
+                            yield host, port, FILTERED, None
+                        continue
+                    session = sessions.get(sock)
+                    if session is None or session[2].deadline > now:
+                        continue
+                    host, port, probe = session
+                    service = probe.advance(sock, now, self.probe_timeout, True)
+                    if service is None:
+                        heapq.heappush(deadlines, (probe.deadline, next(order), sock))
+                        continue
+                    del sessions[sock]
+                    selector.unregister(sock)
+                    sock.close()
+                    yield host, port, OPEN, service
+        finally:
+            for sock in list(pending) + list(sessions):
+                selector.unregister(sock)
+                sock.close()
+            selector.close()
 
+    def start_probe(self, sock, host, port, now, sessions, deadlines, order):
+        # Серверы, которые говорят первыми, присылают баннер сразу после соединения:
+        # ждем его столько же, сколько ждали бы ответа на пакет
+        probe = ServiceProbe(now + self.estimator(host).timeout)
+        sessions[sock] = (host, port, probe)
+        heapq.heappush(deadlines, (probe.deadline, next(order), sock))
+
+    @staticmethod
+    def classify(code: int) -> str:
+        # RST - порт закрыт; ICMP unreachable и прочие ошибки - порт фильтруется
+        if code == 0:
+            return OPEN
+        return CLOSED if code == errno.ECONNREFUSED else FILTERED
+
+
+# Запросы для UDP-сервисов: (протокол, порты, запрос, проверка ответа). На порт без своего запроса
+# уходит пустая датаграмма, а с all_payloads - все запросы таблицы
+DNS_QUERY = b'\xab\xcd\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x07example\x03com\x00\x00\x01\x00\x01'
+SNTP_QUERY = b'\x1b' + 47 * b'\x00'
+# NBSTAT-запрос имени "*"
+NETBIOS_QUERY = (b'\x80\xf0\x00\x10\x00\x01\x00\x00\x00\x00\x00\x00\x20CKAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA\x00'
+                 b'\x00\x21\x00\x01')
+# SNMPv1 GetRequest sysDescr.0 с сообществом public
+SNMP_QUERY = bytes.fromhex('302602010004067075626c6963a019020101020100020100300e300c06082b060102010101000500')
+SSDP_QUERY = (b'M-SEARCH * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\nMAN: "ssdp:discover"\r\nMX: 1\r\n'
+              b'ST: ssdp:all\r\n\r\n')
+
+
+def is_dns_response(data: bytes) -> bool:
+    return data[:2] == DNS_QUERY[:2] and len(data) >= 12
+
+
+def is_sntp_response(data: bytes) -> bool:
+    return len(data) == 48 and (data[0] & 0b11111000) == 0x18
+
+
+def is_netbios_response(data: bytes) -> bool:
+    return data[:2] == NETBIOS_QUERY[:2] and len(data) >= 12 and data[2] & 0x80 != 0
+
+
+def is_snmp_response(data: bytes) -> bool:
+    return data[:1] == b'\x30' and b'public' in data[:16]
 
-def check_sntp(host: str, port: int) -> bool:
-    try:
-        query = b'\x1b' + 47 * b'\x00'
-        with socket(AF_INET, SOCK_DGRAM) as udp:
-            udp.settimeout(1)
-            udp.sendto(query, (host, port))
-            data, _ = udp.recvfrom(1024)
-            return len(data) == 48 and (data[0] & 0b11111000) == 0x18
-    except Exception:
-        return False
-
-
-def detect_udp_protocol(host: str, port: int) -> str:
-    protocols = [
-        ('DNS', check_dns),
-        ('SNTP', check_sntp),
-    ]
-    for name, checker in protocols:
-        if checker(host, port):
-            return name
-    return 'Unknown'
+
+def is_ssdp_response(data: bytes) -> bool:
+    return data.startswith(b'HTTP/1.1 200')
+
+
+UDP_PROBES = [
+    ('DNS', (53, 5353), DNS_QUERY, is_dns_response),
+    ('SNTP', (123,), SNTP_QUERY, is_sntp_response),
+    ('NetBIOS', (137,), NETBIOS_QUERY, is_netbios_response),
+    ('SNMP', (161,), SNMP_QUERY, is_snmp_response),
+    ('SSDP', (1900,), SSDP_QUERY, is_ssdp_response),
+]
+PORT_PAYLOADS = {port: [payload for _, ports, payload, _ in UDP_PROBES if port in ports]
+                 for _, probe_ports, _, _ in UDP_PROBES for port in probe_ports}
+ALL_PAYLOADS = [b''] + [payload for _, _, payload, _ in UDP_PROBES]
+
+UDP_PARALLEL = 1000
+UDP_RETRIES = 2
+# Больше повторов не бывает, даже если на повторы отвечают (см. UDPScanner.answered)
+MAX_UDP_RETRIES = 10
+# Темп отправки UDP-запросов в начале сканирования, его нижняя граница и прибавка за каждый ответ, пакетов/с
+INITIAL_PACE = 1000.0
+MIN_PACE = 10.0
+PACE_STEP = 20.0
+UDP_BUFFER_SIZE = 4 * 1024 * 1024
+RECEIVE_SIZE = 65535
+# Заголовок struct sock_extended_err из очереди ошибок: errno, источник, тип и код ICMP
+EXTENDED_ERROR = struct.Struct('IBBBB')
+SO_EE_ORIGIN_ICMP = 2
+ICMP_DEST_UNREACH, ICMP_PORT_UNREACH = 3, 3
+
+
+class UDPScanner(Scanner):
+    # UDP-сканер: запросы уходят через один общий неблокирующий сокет, ответы и ошибки ICMP из очереди
+    # ошибок (IP_RECVERR, только Linux) сопоставляются с запросами по адресу. Без ответа запрос повторяется
+    # с удвоением таймаута. Темп отправки растет с ответами и уменьшается вдвое, когда ответ приходит
+    # только на повтор: это признак потерь или ограничения частоты ICMP на хосте
+    def __init__(self, parallel: int = UDP_PARALLEL, rate: float = 0.0, timeout: float = DEFAULT_TIMEOUT,
+                 retries: int = UDP_RETRIES, all_payloads: bool = False, host_parallel: int = HOST_PARALLEL):
+        super().__init__(parallel, rate, timeout, retries, host_parallel)
+        self.all_payloads = all_payloads
+        self.pace = INITIAL_PACE if not rate else min(INITIAL_PACE, rate)
+        self.limiter = None
+        self.decreased = 0.0
+        # Наибольший номер попытки, на которую пришел ответ
+        self.answered_attempt = 0
+
+    def payloads(self, port: int) -> list[bytes]:
+        payloads = PORT_PAYLOADS.get(port)
+        if payloads:
+            return payloads
+        return ALL_PAYLOADS if self.all_payloads else [b'']
+
+    def run(self, slots: HostSlots) -> Iterator[tuple[str, int, str, str | None]]:
+        retry = deque()
+        limiter = self.limiter = RateLimiter(self.pace)
+        sock = socket(AF_INET, SOCK_DGRAM)
+        sock.setblocking(False)
+        try:
+            sock.setsockopt(SOL_SOCKET, SO_RCVBUF, UDP_BUFFER_SIZE)
+        except OSError:
+            pass
+        # Без IP_RECVERR закрытый порт неотличим от фильтруемого: оба остаются open|filtered
+        errors = IP_RECVERR is not None and MSG_ERRQUEUE is not None
+        if errors:
+            try:
+                sock.setsockopt(IPPROTO_IP, IP_RECVERR, 1)
+            except OSError:
+                errors = False
+        selector = selectors.DefaultSelector()
+        selector.register(sock, selectors.EVENT_READ)
+        # (хост, порт) -> (попытка, время отправки, время отправки прошлой попытки, оставшейся без ответа);
+        # сроки в куче помнят попытку, устаревшие пропускаются
+        outstanding = {}
+        deadlines = []
+        order = count()
+        try:
+            while True:
+                now = time.monotonic()
+                wait = None
+                while len(outstanding) < self.parallel:
+                    if retry:
+                        target, attempt, lost = retry.popleft()
+                    else:
+                        target = slots.take()
+                        if target is None:
+                            break
+                        attempt, lost = 0, None
+                    payloads = self.payloads(target[1])
+                    wait = limiter.delay(now, len(payloads))
+                    if wait:
+                        retry.appendleft((target, attempt, lost))
+                        break
+                    if not self.send(sock, target, payloads):
+                        retry.appendleft((target, attempt, lost))
+                        wait = MIN_TIMEOUT / 10
+                        break
+                    outstanding[target] = (attempt, now, lost)
+                    timeout = min(self.estimator(target[0]).timeout * 2 ** attempt, MAX_TIMEOUT)
+                    heapq.heappush(deadlines, (now + timeout, next(order), target, attempt))
+
+                if not outstanding:
+                    if slots.done and not retry:
+                        return
+                    time.sleep(wait or 0)
+                    continue
+
+                timeout = max(0.0, deadlines[0][0] - now)
+                if wait is not None:
+                    timeout = min(timeout, wait)
+                ready = selector.select(timeout)
+                now = time.monotonic()
+                if ready:
+                    yield from self.receive(sock, outstanding, now, errors)
+                while deadlines and deadlines[0][0] <= now:
+                    _, _, target, attempt = heapq.heappop(deadlines)
+                    entry = outstanding.get(target)
+                    if entry is None or entry[0] != attempt:
+                        continue
+                    del outstanding[target]
+                    if attempt < max(self.retries, min(self.answered_attempt + 1, MAX_UDP_RETRIES)):
+                        self.stats['retransmits'] += 1
+                        retry.append((target, attempt + 1, entry[1]))
+                    else:
+                        yield target[0], target[1], OPEN_FILTERED, None
+        finally:
+            selector.close()
+            sock.close()
+
+    def send(self, sock: socket, target: tuple[str, int], payloads: list[bytes]) -> bool:
+        for payload in payloads:
+            for _ in range(2):
+                try:
+                    sock.sendto(payload, target)
+                    break
+                except (BlockingIOError, InterruptedError):
+                    return False
+                except OSError as error:
+                    if error.errno == errno.ENOBUFS:
+                        return False
+                    # sendto вернул ошибку ICMP на один из прежних запросов, датаграмма не ушла:
+                    # сама ошибка останется в очереди ошибок, а отправку повторяем
+            else:
+                return False
+            self.stats['sent'] += 1
+        return True
+
+    def receive(self, sock: socket, outstanding: dict, now: float,
+                errors: bool) -> list[tuple[str, int, str, str | None]]:
+        results = []
+        own_port = sock.getsockname()[1]
+        while True:
+            try:
+                data, address = sock.recvfrom(RECEIVE_SIZE)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                # Ошибка ICMP на один из запросов; подробности читаем из очереди ошибок
+                continue
+            # Запрос на собственный порт сканера на локальном хосте возвращается к нему же
+            if address[1] == own_port and data in ALL_PAYLOADS:
+                continue
+            entry = outstanding.pop(address, None)
+            if entry is None:
+                continue
+            self.answered(address[0], entry, now)
+            results.append((address[0], address[1], OPEN, self.identify(data)))
+        if errors:
+            self.read_errors(sock, outstanding, now, results)
+        return results
+
+    def read_errors(self, sock: socket, outstanding: dict, now: float, results: list) -> None:
+        while True:
+            try:
+                _, ancdata, _, address = sock.recvmsg(64, 512, MSG_ERRQUEUE)
+            except OSError:
+                break
+            for level, kind, payload in ancdata:
+                if level != IPPROTO_IP or kind != IP_RECVERR:
+                    continue
+                _, origin, icmp_type, icmp_code, _ = EXTENDED_ERROR.unpack_from(payload)
+                entry = outstanding.pop(address, None) if origin == SO_EE_ORIGIN_ICMP else None
+                if entry is None:
+                    continue
+                self.answered(address[0], entry, now)
+                # Port unreachable - порт закрыт; прочие unreachable (запрещено администратором и т.п.) - фильтр
+                closed = icmp_type == ICMP_DEST_UNREACH and icmp_code == ICMP_PORT_UNREACH
+                results.append((address[0], address[1], CLOSED if closed else FILTERED, None))
+
+    def answered(self, host: str, entry: tuple[int, float, float | None], now: float) -> None:
+        attempt, sent, lost = entry
+        if attempt == 0:
+            # Время ответа меряем только по первой попытке: на повтор неясно, какой запрос ответили (Карн)
+            self.sample(host, now - sent)
+            self.set_pace(self.pace + PACE_STEP)
+            return
+        # Ответили только на повтор - первый запрос или ответ на него потерян. Раз потери есть,
+        # запросам без ответа положено не меньше попыток, чем понадобилось этому
+        self.answered_attempt = max(self.answered_attempt, attempt)
+        # Потери запросов, отправленных до прошлого снижения темпа, уже учтены им: иначе одна пачка
+        # потерь, о которой узнаем постепенно, обрушила бы темп до минимума
+        if lost > self.decreased:
+            self.set_pace(max(MIN_PACE, self.pace / 2))
+            self.decreased = now
+            self.stats['slowdowns'] += 1
+
+    def set_pace(self, pace: float) -> None:
+        self.pace = min(pace, self.rate) if self.rate else pace
+        self.limiter.set_rate(self.pace)
+
+    @staticmethod
+    def identify(data: bytes) -> str:
+        for name, _, _, matches in UDP_PROBES:
+            if matches(data):
+                return name
+        return UNKNOWN
+
+
+def format_ports(results: ScanResults, host: str) -> str:
+    ports = []
+    for port in results.open_ports(host):
+        protocol = results.protocols.get((host, port))
+        ports.append(f'{port}/{protocol}' if protocol else str(port))
+    return ', '.join(ports)
 
 
 def main():
     parser = ArgumentParser(description='Сканер портов')
-    parser.add_argument('host', help='Хост для сканирования', default="localhost")
-    parser.add_argument('ports', help='Набор портов (пример: 1-100)', default="1-1000")
+    parser.add_argument('targets', nargs='?',
+                        help='Цели через запятую: хосты, IP-адреса и сети CIDR (пример: 10.0.0.0/24,example.com); '
+                             'по умолчанию localhost')
+    parser.add_argument('ports', nargs='?', default="1-1000",
+                        help='Порты и диапазоны через запятую (пример: 22,80,8000-8100)')
+    parser.add_argument('--hosts-file', help='Файл с целями, по одной в строке')
+    parser.add_argument('--top-ports', type=int,
+                        help='Сканировать N самых частых TCP- и UDP-портов вместо списка портов')
+    parser.add_argument('--parallel', type=int, default=DEFAULT_PARALLEL,
+                        help='Сколько TCP-соединений держать в полете одновременно')
+    parser.add_argument('--host-parallel', type=int, default=HOST_PARALLEL,
+                        help='Наибольшее число одновременных запросов к одному хосту')
+    parser.add_argument('--seed', type=int, help='Зерно случайного порядка обхода пар (хост, порт)')
+    parser.add_argument('--rate', type=float, default=0.0,
+                        help='Ограничение частоты пакетов в секунду (0 - без ограничения)')
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help='Таймаут соединения в секундах, пока время ответа хоста не измерено')
+    parser.add_argument('--retries', type=int, default=1,
+                        help='Сколько раз повторять соединение, оставшееся без ответа')
+    parser.add_argument('--udp-parallel', type=int, default=UDP_PARALLEL,
+                        help='Наибольшее число UDP-запросов без ответа одновременно')
+    parser.add_argument('--udp-retries', type=int, default=UDP_RETRIES,
+                        help='Сколько раз повторять UDP-запрос, оставшийся без ответа')
+    parser.add_argument('--all-payloads', action='store_true',
+                        help='Отправлять на порты без известного UDP-сервиса все запросы таблицы, '
+                             'а не пустую датаграмму')
+    parser.add_argument('--probe-timeout', type=float, default=DEFAULT_TIMEOUT,
+                        help='Сколько ждать ответа на запрос, определяющий протокол, в секундах')
+    parser.add_argument('-o', '--output', help='Файл для потоковой записи всех результатов')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl', help='Формат файла результатов')
+    parser.add_argument('--checkpoint',
+                        help='Файл, в который периодически сохраняется состояние обхода (нужен -o/--output)')
+    parser.add_argument('--checkpoint-interval', type=float, default=CHECKPOINT_INTERVAL,
+                        help='Как часто сохранять состояние обхода, в секундах')
+    parser.add_argument('--resume', metavar='CHECKPOINT',
+                        help='Продолжить прерванный обход из файла состояния; цели, порты, зерно и файл '
+                             'результатов берутся из него')
 
     args = parser.parse_args()
-    ports = parse_ports(args.ports)
-
-    with ThreadPoolExecutor(max_workers=100) as executor:
-        futures = []
-        futures.extend(executor.submit(check_tcp_port, args.host, port) for port in ports)
-        futures.extend(executor.submit(check_udp_port, args.host, port) for port in ports)
-
-        for future in as_completed(futures):
-            result = future.result()
-            if result:
-                proto, port = result
-                if proto == 'TCP':
-                    app_proto = detect_tcp_protocol(args.host, port)
-                else:
-                    app_proto = detect_udp_protocol(args.host, port)
-                print(f"{proto} порт {port} открыт. Протокол: {app_proto}")
+    if args.resume:
+        with open(args.resume, encoding='utf-8') as file:
+            checkpoint = json.load(file)
+        args.checkpoint = args.checkpoint or args.resume
+        ranges = [tuple(item) for item in checkpoint['targets']]
+        tcp_ports, udp_ports = checkpoint['TCP']['ports'], checkpoint['UDP']['ports']
+    else:
+        checkpoint = None
+        targets = args.targets.split(',') if args.targets else []
+        if args.hosts_file:
+            with open(args.hosts_file, encoding='utf-8') as file:
+                targets.extend(file)
+        ranges = parse_targets(targets or ['localhost'])
+        if args.top_ports:
+            tcp_ports, udp_ports = TOP_TCP_PORTS[:args.top_ports], TOP_UDP_PORTS[:args.top_ports]
+        else:
+            tcp_ports = udp_ports = parse_ports(args.ports)
+    # Зерно выбирается явно, чтобы порядок обхода можно было воспроизвести при продолжении
+    seed = checkpoint['seed'] if checkpoint else args.seed if args.seed is not None else random.getrandbits(64)
+    output = checkpoint['output'] if checkpoint else args.output
+    output_format = checkpoint['format'] if checkpoint else args.format
+    # Результаты между сохранениями состояния есть только в файле результатов: без него продолжение
+    # повторило бы все запросы после последнего сохранения, а их результаты при остановке пропали бы
+    if args.checkpoint and not output:
+        parser.error('--checkpoint и --resume требуют файла результатов -o/--output')
+
+    spaces = {'TCP': TargetSpace(ranges, tcp_ports, seed), 'UDP': TargetSpace(ranges, udp_ports, seed)}
+    results = {proto: ScanResults(space.ports) for proto, space in spaces.items()}
+    journal = {proto: set() for proto in spaces}
+    if checkpoint:
+        for proto, found in results.items():
+            found.load(checkpoint[proto]['results'])
+        for proto, host, port, state, app_proto in read_journal(output, output_format, checkpoint['offset']):
+            results[proto].add(host, port, state, app_proto)
+            journal[proto].add(spaces[proto].index(host, port))
+        completed = ', '.join(f'{proto} {found.states.total()} из {len(spaces[proto])}'
+                              for proto, found in results.items())
+        print(f"Продолжение обхода из {args.resume}: выполнено {completed}")
+    progress = {proto: ScanProgress(space, checkpoint and checkpoint[proto], journal[proto])
+                for proto, space in spaces.items()}
+    writer = ResultWriter(output, output_format, checkpoint and checkpoint['offset']) if output else None
+
+    def save():
+        if args.checkpoint:
+            state = {'targets': ranges, 'seed': seed, 'output': output, 'format': output_format,
+                     'offset': writer.tell()}
+            for proto in spaces:
+                state[proto] = {'ports': spaces[proto].ports, 'results': results[proto].state(),
+                                **progress[proto].state()}
+            save_checkpoint(args.checkpoint, state)
+
+    tcp = TCPScanner(args.parallel, args.rate, args.timeout, args.retries, True, args.probe_timeout,
+                     args.host_parallel)
+    udp = UDPScanner(args.udp_parallel, args.rate, args.timeout, args.udp_retries, args.all_payloads,
+                     args.host_parallel)
+    saved = time.monotonic()
+    try:
+        for proto, scanner in (('TCP', tcp), ('UDP', udp)):
+            found, walk = results[proto], progress[proto]
+            if walk.finished:
+                continue
+            started = time.monotonic()
+            for host, port, state, app_proto in scanner.scan(walk):
+                if writer:
+                    writer.write(proto, host, port, state, app_proto)
+                walk.complete(host, port)
+                found.add(host, port, state, app_proto)
+                if state == OPEN:
+                    print(f"{proto} порт {port} на {host} открыт. Протокол: {app_proto}")
+                if time.monotonic() - saved >= args.checkpoint_interval:
+                    save()
+                    saved = time.monotonic()
+            save()
+            summary = ', '.join(f'{state} {n}' for state, n in found.states.most_common())
+            print(f"{proto}: {spaces[proto].hosts} хостов по {len(walk.space.ports)} портов "
+                  f"за {time.monotonic() - started:.1f} с: {summary}")
+    except KeyboardInterrupt:
+        save()
+        if args.checkpoint:
+            print(f"Обход прерван, продолжить: --resume {args.checkpoint}")
+        sys.exit(130)
+    finally:
+        if writer:
+            writer.close()
+
+    hosts = set(results['TCP'].open) | set(results['UDP'].open)
+    for host in sorted(hosts, key=ipaddress.IPv4Address):
+        report = '; '.join(f'{proto} {format_ports(found, host)}' for proto, found in results.items()
+                           if host in found.open)
+        print(f"{host}: {report}")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,488 @@
+import argparse
+import asyncio
+import multiprocessing
+import random
+import resource
+import selectors
+import socket
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from scanner import (CLOSED, FILTERED, OPEN, OPEN_FILTERED, UNKNOWN, ScanResults, TargetSpace, TCPScanner,
+                     UDPScanner, parse_targets, raise_file_limit)
+
+
+HOST = '127.0.0.1'
+
+
+class ListenerFarm:
+    # Слушающие сокеты на случайных портах диапазона. Открытые принимают соединения, у "молчащих"
+    # очередь accept заполнена, и ядро отбрасывает новые SYN - для сканера это фильтруемый порт
+    def __init__(self, ports, open_count, filtered_count, seed=1):
+        self.sockets = []
+        self.open = set()
+        self.filtered = set()
+        self.fillers = []
+        candidates = list(ports)
+        random.Random(seed).shuffle(candidates)
+        for port in candidates:
+            if len(self.open) >= open_count and len(self.filtered) >= filtered_count:
+                break
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                listener.bind((HOST, port))
+            except OSError:
+                listener.close()
+                continue
+            if len(self.open) < open_count:
+                listener.listen(1024)
+                self.open.add(port)
+            else:
+                listener.listen(0)
+                filler = socket.create_connection((HOST, port))
+                self.fillers.append(filler)
+                self.filtered.add(port)
+            self.sockets.append(listener)
+
+    def close(self):
+        for sock in self.fillers + self.sockets:
+            sock.close()
+
+
+# Прежний TCP-сканер: блокирующее соединение на каждый порт в пуле потоков
+def legacy_check_tcp_port(host, port):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp:
+        tcp.settimeout(1)
+        result = tcp.connect_ex((host, port))
+        return ('TCP', port) if result == 0 else None
+
+
+def scan_threads(ports, workers):
+    states = Counter()
+    found = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for result in executor.map(lambda port: legacy_check_tcp_port(HOST, port), ports):
+            if result:
+                found.add(result[1])
+                states[OPEN] += 1
+    return states, found, len(ports)
+
+
+def scan_select(ports, parallel, rate, timeout):
+    scanner = TCPScanner(parallel, rate, timeout)
+    states = Counter()
+    found = set()
+    for _, port, state, _ in scanner.scan((HOST, port) for port in ports):
+        states[state] += 1
+        if state == OPEN:
+            found.add(port)
+    return states, found, scanner.stats['sent']
+
+
+def bench_tcp(args):
+    raise_file_limit()
+    ports = list(range(args.first, args.first + args.ports))
+    farm = ListenerFarm(ports, args.open, args.filtered)
+    engines = [(f'threads x{args.workers}', lambda: scan_threads(ports, args.workers)),
+               (f'select x{args.parallel}', lambda: scan_select(ports, args.parallel, 0.0, args.timeout))]
+    engines.extend((f'select {rate:g} pps', lambda rate=rate: scan_select(ports, args.parallel, rate, args.timeout))
+                   for rate in args.rates)
+
+    print(f"Портов: {len(ports)} ({args.first}-{ports[-1]}), открыто {len(farm.open)}, "
+          f"молчит {len(farm.filtered)}, таймаут {args.timeout} с")
+    print(f"{'движок':<18}{'время, с':>10}{'портов/с':>10}{'SYN':>8}{'open':>7}{'closed':>8}"
+          f"{'filtered':>10}{'верно':>7}")
+    try:
+        for title, scan in engines:
+            started = time.perf_counter()
+            states, found, sent = scan()
+            elapsed = time.perf_counter() - started
+            closed = states[CLOSED] if CLOSED in states or FILTERED in states else '-'
+            filtered = states[FILTERED] if CLOSED in states or FILTERED in states else '-'
+            correct = 'да' if found == farm.open else 'нет'
+            print(f"{title:<18}{elapsed:>10.2f}{len(ports) / elapsed:>10.0f}{sent:>8}{states[OPEN]:>7}"
+                  f"{closed:>8}{filtered:>10}{correct:>7}")
+    finally:
+        farm.close()
+
+
+# Прежнее определение протокола: новое соединение на каждый проверяемый протокол
+def legacy_check_http(tcp_socket):
+    try:
+        tcp_socket.send(b'GET / HTTP/1.0\r\n\r\n')
+        response = tcp_socket.recv(1024)
+        return b'HTTP/' in response
+    except Exception:
+        return False
+
+
+def legacy_check_smtp(tcp_socket):
+    try:
+        response = tcp_socket.recv(1024)
+        if response.startswith(b'220'):
+            return True
+        tcp_socket.send(b'EHLO example.com\r\n')
+        response = tcp_socket.recv(1024)
+        return response.startswith(b'250')
+    except Exception:
+        return False
+
+
+def legacy_check_pop3(tcp_socket):
+    try:
+        response = tcp_socket.recv(1024)
+        if response.startswith(b'+OK'):
+            return True
+        tcp_socket.send(b'USER test\r\n')
+        response = tcp_socket.recv(1024)
+        return response.startswith(b'+OK')
+    except Exception:
+        return False
+
+
+def legacy_detect_tcp_protocol(host, port):
+    protocols = [
+        ('HTTP', legacy_check_http),
+        ('SMTP', legacy_check_smtp),
+        ('POP3', legacy_check_pop3),
+    ]
+    for name, checker in protocols:
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp:
+                tcp.settimeout(1)
+                tcp.connect((host, port))
+                if checker(tcp):
+                    return name
+        except Exception:
+            continue
+    return 'Unknown'
+
+
+# Заглушки сервисов: (приветствие сразу после соединения, ответ на первую строку клиента)
+FAKE_SERVICES = {
+    'SSH': (b'SSH-2.0-OpenSSH_9.6\r\n', None),
+    'FTP': (b'220 ProFTPD Server ready\r\n', b'530 Please login\r\n'),
+    'SMTP': (b'220 mail.bench.local ESMTP\r\n', b'250 mail.bench.local\r\n'),
+    'POP3': (b'+OK POP3 ready\r\n', b'+OK\r\n'),
+    'HTTP': (None, b'HTTP/1.0 200 OK\r\nContent-Length: 0\r\n\r\n'),
+    UNKNOWN: (None, None),
+}
+
+
+class ServiceFarm:
+    # Заглушки сервисов на случайных портах в отдельном потоке с циклом asyncio; считает принятые соединения
+    def __init__(self, per_service):
+        self.loop = asyncio.new_event_loop()
+        self.connections = 0
+        self.expected = {}
+        thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        thread.start()
+        for name, (greeting, reply) in FAKE_SERVICES.items():
+            for _ in range(per_service):
+                server = asyncio.run_coroutine_threadsafe(self.serve(greeting, reply), self.loop).result()
+                self.expected[server.sockets[0].getsockname()[1]] = name
+
+    async def serve(self, greeting, reply):
+        async def handle(reader, writer):
+            self.connections += 1
+            try:
+                if greeting:
+                    writer.write(greeting)
+                line = await reader.readline()
+                if reply and line:
+                    writer.write(reply)
+                    await writer.drain()
+                await reader.read()
+            except ConnectionError:
+                pass
+            writer.close()
+        return await asyncio.start_server(handle, HOST, 0)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+def fingerprint_legacy(ports):
+    found = {}
+
+    def check(port):
+        if legacy_check_tcp_port(HOST, port):
+            found[port] = legacy_detect_tcp_protocol(HOST, port)
+
+    with ThreadPoolExecutor(max_workers=100) as executor:
+        list(executor.map(check, ports))
+    return found
+
+
+def fingerprint_select(ports):
+    scanner = TCPScanner(detect=True)
+    return {port: service for _, port, state, service in scanner.scan((HOST, port) for port in ports)
+            if state == OPEN}
+
+
+def bench_fingerprint(args):
+    farm = ServiceFarm(args.per_service)
+    ports = sorted(farm.expected)
+    print(f"Сервисов: {len(ports)} ({', '.join(FAKE_SERVICES)} по {args.per_service})")
+    print(f"{'способ':<16}{'время, с':>10}{'соединений':>12}{'на порт':>9}{'верно':>7}  ошибки")
+    try:
+        for title, detect in (('новое соединение', fingerprint_legacy), ('то же соединение', fingerprint_select)):
+            before = farm.connections
+            started = time.perf_counter()
+            found = detect(ports)
+            elapsed = time.perf_counter() - started
+            connections = farm.connections - before
+            correct = sum(found.get(port) == name for port, name in farm.expected.items())
+            errors = Counter(f'{name}->{found.get(port)}' for port, name in farm.expected.items()
+                             if found.get(port) != name)
+            print(f"{title:<16}{elapsed:>10.2f}{connections:>12}{connections / len(ports):>9.1f}"
+                  f"{correct:>7}  {', '.join(f'{error} x{n}' for error, n in errors.items()) or '-'}")
+    finally:
+        farm.close()
+
+
+# Прежний UDP-сканер: таймаут считался открытым портом, протокол определялся отдельными запросами
+def legacy_check_udp_port(host, port):
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp:
+            udp.settimeout(3)
+            udp.sendto(b'', (host, port))
+            udp.recvfrom(1024)
+            return 'UDP', port
+    except socket.timeout:
+        return 'UDP', port
+    except Exception:
+        return None
+
+
+def legacy_check_dns(host, port):
+    try:
+        query = b'\xab\xcd\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x07example\x03com\x00\x00\x01\x00\x01'
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp:
+            udp.settimeout(1)
+            udp.sendto(query, (host, port))
+            data, _ = udp.recvfrom(1024)
+            return data[:2] == b'\xab\xcd' and len(data) >= 12
+    except Exception:
+        return False
+
+
+def legacy_check_sntp(host, port):
+    try:
+        query = b'\x1b' + 47 * b'\x00'
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp:
+            udp.settimeout(1)
+            udp.sendto(query, (host, port))
+            data, _ = udp.recvfrom(1024)
+            return len(data) == 48 and (data[0] & 0b11111000) == 0x18
+    except Exception:
+        return False
+
+
+def legacy_detect_udp_protocol(host, port):
+    protocols = [
+        ('DNS', legacy_check_dns),
+        ('SNTP', legacy_check_sntp),
+    ]
+    for name, checker in protocols:
+        if checker(host, port):
+            return name
+    return 'Unknown'
+
+
+class UDPFarm:
+    # UDP-заглушки на случайных портах, обслуживаемые одним потоком. Эхо-сервисы отвечают все вместе
+    # не чаще echo_rate раз в секунду, как хост с ограничением частоты ICMP; молчащие сокеты не отвечают никогда
+    def __init__(self, per_service, echo_count, echo_rate):
+        self.selector = selectors.DefaultSelector()
+        self.sockets = []
+        self.expected = {}
+        self.echo_rate = echo_rate
+        self.tokens = self.burst = 50.0
+        self.updated = time.monotonic()
+        self.dropped = 0
+        for kind, amount in (('DNS', per_service), ('SNTP', per_service), (UNKNOWN, echo_count),
+                             (OPEN_FILTERED, per_service)):
+            for _ in range(amount):
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.bind((HOST, 0))
+                sock.setblocking(False)
+                self.sockets.append(sock)
+                self.selector.register(sock, selectors.EVENT_READ, kind)
+                port = sock.getsockname()[1]
+                self.expected[port] = (OPEN_FILTERED, None) if kind == OPEN_FILTERED else (OPEN, kind)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while True:
+            for key, _ in self.selector.select():
+                try:
+                    data, address = key.fileobj.recvfrom(2048)
+                except OSError:
+                    continue
+                if key.data == 'DNS' and len(data) >= 12:
+                    key.fileobj.sendto(data[:2] + b'\x81\x80' + data[4:], address)
+                elif key.data == 'SNTP' and data[:1] == b'\x1b':
+                    key.fileobj.sendto(b'\x1c' + 47 * b'\x00', address)
+                elif key.data == UNKNOWN:
+                    now = time.monotonic()
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.echo_rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        key.fileobj.sendto(b'echo', address)
+                    else:
+                        self.dropped += 1
+
+
+def udp_legacy(ports):
+    def check(port):
+        if legacy_check_udp_port(HOST, port):
+            return port, OPEN, legacy_detect_udp_protocol(HOST, port)
+        return port, CLOSED, None
+
+    with ThreadPoolExecutor(max_workers=100) as executor:
+        return {port: (state, protocol) for port, state, protocol in executor.map(check, ports)}
+
+
+def udp_shared(ports):
+    scanner = UDPScanner(all_payloads=True)
+    return {port: (state, protocol) for _, port, state, protocol in scanner.scan((HOST, port) for port in ports)}
+
+
+def bench_udp(args):
+    farm = UDPFarm(args.per_service, args.echo, args.echo_rate)
+    expected = {port: (CLOSED, None) for port in range(args.first, args.first + args.ports)}
+    expected.update(farm.expected)
+    ports = list(expected)
+    random.Random(1).shuffle(ports)
+
+    print(f"Портов: {len(ports)}: закрыто {args.ports}, DNS и SNTP по {args.per_service}, "
+          f"эхо {args.echo} (вместе не чаще {args.echo_rate:g} ответов/с), молчит {args.per_service}")
+    print(f"{'сканер':<16}{'время, с':>10}{'open':>7}{'closed':>8}{'open|filtered':>15}{'верно':>8}")
+    for title, scan in (('threads x100', udp_legacy), ('общий сокет', udp_shared)):
+        started = time.perf_counter()
+        found = scan(ports)
+        elapsed = time.perf_counter() - started
+        states = Counter(state for state, _ in found.values())
+        correct = sum(found.get(port) == result for port, result in expected.items())
+        print(f"{title:<16}{elapsed:>10.2f}{states[OPEN]:>7}{states[CLOSED]:>8}{states[OPEN_FILTERED]:>15}"
+              f"{correct:>5}/{len(expected)}")
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('0.0.0.0', 0))
+        return sock.getsockname()[1]
+
+
+def accept_forever(listener):
+    while True:
+        connection, _ = listener.accept()
+        connection.close()
+
+
+def sweep_list(ranges, ports, seed):
+    # Прежний подход: список всех пар и словарь результатов по каждой паре
+    targets = [(socket.inet_ntoa((first + i).to_bytes(4, 'big')), port)
+               for first, size in ranges for i in range(size) for port in ports]
+    random.Random(seed).shuffle(targets)
+    results = {}
+    for host, port, state, _ in TCPScanner().scan(targets):
+        results[host, port] = state
+    return sum(state == OPEN for state in results.values())
+
+
+def sweep_space(ranges, ports, seed):
+    results = ScanResults(ports)
+    for host, port, state, protocol in TCPScanner().scan(TargetSpace(ranges, ports, seed)):
+        results.add(host, port, state, protocol)
+    return results.states[OPEN]
+
+
+def sweep_process(params):
+    sweep, network, ports = params
+    raise_file_limit()
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    found = sweep(parse_targets([network]), ports, 1)
+    elapsed = time.perf_counter() - started
+    return elapsed, found, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline) / 1024
+
+
+def bench_sweep(args):
+    # Все адреса 127.0.0.0/8 ведут на loopback, а сокет на 0.0.0.0 принимает соединения на любой из них:
+    # один слушающий сокет дает открытый порт на каждом хосте сети
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('0.0.0.0', 0))
+    listener.listen(4096)
+    threading.Thread(target=accept_forever, args=(listener,), daemon=True).start()
+    ports = [listener.getsockname()[1]] + [free_port() for _ in range(args.closed)]
+    hosts = parse_targets([args.network])[0][1]
+
+    print(f"Сеть {args.network}: {hosts} хостов по {len(ports)} порта (1 открыт), {hosts * len(ports)} пар")
+    print(f"{'обход':<14}{'время, с':>10}{'пар/с':>10}{'открыто':>10}{'прирост памяти, МБ':>20}")
+    context = multiprocessing.get_context('fork')
+    for title, sweep in (('список пар', sweep_list), ('TargetSpace', sweep_space)):
+        with context.Pool(1) as pool:
+            elapsed, found, memory = pool.apply(sweep_process, ((sweep, args.network, ports),))
+        print(f"{title:<14}{elapsed:>10.2f}{hosts * len(ports) / elapsed:>10.0f}{found:>10}{memory:>20.1f}")
+    listener.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарки сканера портов')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    tcp = commands.add_parser('tcp', help='TCP-сканирование локальной фермы слушающих сокетов')
+    tcp.add_argument('--first', type=int, default=10000,
+                     help='Первый порт диапазона (ниже эфемерных портов Linux)')
+    tcp.add_argument('--ports', type=int, default=20000,
+                     help='Количество портов в диапазоне')
+    tcp.add_argument('--open', type=int, default=200,
+                     help='Сколько портов слушают и принимают соединения')
+    tcp.add_argument('--filtered', type=int, default=1000,
+                     help='Сколько портов молча отбрасывают SYN')
+    tcp.add_argument('--workers', type=int, default=100,
+                     help='Потоков в пуле прежнего сканера')
+    tcp.add_argument('--parallel', type=int, default=2000,
+                     help='Соединений в полете у неблокирующего сканера')
+    tcp.add_argument('--timeout', type=float, default=1.0,
+                     help='Начальный таймаут соединения в секундах')
+    tcp.add_argument('--rates', type=float, nargs='*', default=[5000.0],
+                     help='Ограничения частоты SYN для дополнительных прогонов')
+    tcp.set_defaults(func=bench_tcp)
+
+    fingerprint = commands.add_parser('fingerprint', help='Определение протоколов на заглушках сервисов')
+    fingerprint.add_argument('--per-service', type=int, default=20,
+                             help='Сколько заглушек каждого протокола запустить')
+    fingerprint.set_defaults(func=bench_fingerprint)
+
+    udp = commands.add_parser('udp', help='UDP-сканирование закрытых портов и заглушек сервисов')
+    udp.add_argument('--first', type=int, default=10000,
+                     help='Первый порт диапазона закрытых портов')
+    udp.add_argument('--ports', type=int, default=500,
+                     help='Количество закрытых портов')
+    udp.add_argument('--per-service', type=int, default=10,
+                     help='Сколько заглушек DNS, SNTP и молчащих сокетов запустить')
+    udp.add_argument('--echo', type=int, default=200,
+                     help='Сколько эхо-сервисов запустить')
+    udp.add_argument('--echo-rate', type=float, default=100.0,
+                     help='Общее ограничение частоты ответов эхо-сервисов в секунду')
+    udp.set_defaults(func=bench_udp)
+
+    sweep = commands.add_parser('sweep', help='TCP-обход сети на loopback: память списка пар против TargetSpace')
+    sweep.add_argument('--network', default='127.1.0.0/16',
+                       help='Сеть из 127.0.0.0/8 для обхода')
+    sweep.add_argument('--closed', type=int, default=1,
+                       help='Сколько закрытых портов сканировать на каждом хосте')
+    sweep.set_defaults(func=bench_sweep)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
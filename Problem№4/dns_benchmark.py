@@ -0,0 +1,871 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import multiprocessing
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+from dns_server import (CLASSIC_UDP_SIZE, NAME_RDATA_TYPES, OPT_RECORD, RCODE_NXDOMAIN, TYPE_OPT, TYPE_SOA,
+                        DNSCache, build_dns_query, build_dns_response, decode_name, encode_name, find_opt,
+                        parse_dns_query, parse_dns_response, parse_negative_response)
+
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dns_server.py')
+
+
+def build_query(query_id, name, qtype=1):
+    return build_dns_query(query_id, name, qtype)
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(len(values) * p / 100))
+    return values[index]
+
+
+# Заглушка старшего DNS сервера: отвечает A-записью 127.0.0.1 с задержкой
+class StubUpstream(asyncio.DatagramProtocol):
+    def __init__(self, delay):
+        self.delay = delay
+        self.transport = None
+        self.queries = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.queries += 1
+        asyncio.get_running_loop().call_later(self.delay, self.reply, data, addr)
+
+    def reply(self, data, addr):
+        _, offset = decode_name(data, 12)
+        question = data[12:offset + 4]
+        header = struct.pack('!6H', struct.unpack_from('!H', data)[0], 0x8180, 1, 1, 0, 0)
+        answer = b'\xc0\x0c' + struct.pack('!2HIH', 1, 1, 300, 4) + socket.inet_aton('127.0.0.1')
+        self.transport.sendto(header + question + answer, addr)
+
+
+def start_stub_upstream(port, delay):
+    ready = threading.Event()
+    state = {}
+
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        transport, protocol = loop.run_until_complete(loop.create_datagram_endpoint(
+            lambda: StubUpstream(delay), local_addr=('127.0.0.1', port)))
+        state['loop'] = loop
+        state['protocol'] = protocol
+        ready.set()
+        loop.run_forever()
+        transport.close()
+        loop.close()
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    ready.wait()
+    return state
+
+
+def start_server(port, upstream_port, extra_args=()):
+    backup = os.path.join(tempfile.mkdtemp(), 'bench_cache.bin')
+    process = subprocess.Popen([
+        sys.executable, SERVER_SCRIPT,
+        '--listen-addr', '127.0.0.1', '--listen-port', str(port),
+        '--upstream-dns', '127.0.0.1', '--upstream-port', str(upstream_port),
+        '--backup-file', backup, '--quiet', *extra_args
+    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_server(port)
+    return process
+
+
+def wait_server(port, timeout=10.0):
+    deadline = time.time() + timeout
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(0.2)
+        while time.time() < deadline:
+            try:
+                sock.sendto(build_query(1, 'warmup.bench.local'), ('127.0.0.1', port))
+                sock.recvfrom(4096)
+                return
+            except OSError:
+                continue
+    raise RuntimeError("Сервер не ответил")
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+class LoadClient(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.waiter = None
+
+    def datagram_received(self, data, addr):
+        if self.waiter and not self.waiter.done():
+            self.waiter.set_result(data)
+
+
+async def generate_load(port, duration, concurrency, miss_ratio, hot_names, timeout=2.0):
+    loop = asyncio.get_running_loop()
+    latencies = []
+    lost = 0
+    unique = [0]
+    deadline = time.perf_counter() + duration
+
+    async def worker(worker_id):
+        nonlocal lost
+        transport, client = await loop.create_datagram_endpoint(
+            LoadClient, remote_addr=('127.0.0.1', port))
+        try:
+            while time.perf_counter() < deadline:
+                if random.random() < miss_ratio:
+                    unique[0] += 1
+                    name = f'miss{worker_id}-{unique[0]}.bench.local'
+                else:
+                    name = f'hot{random.randrange(hot_names)}.bench.local'
+
+                client.waiter = loop.create_future()
+                started = time.perf_counter()
+                transport.sendto(build_query(random.getrandbits(16), name))
+                try:
+                    await asyncio.wait_for(client.waiter, timeout)
+                    latencies.append(time.perf_counter() - started)
+                except asyncio.TimeoutError:
+                    lost += 1
+        finally:
+            transport.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return latencies, elapsed, lost
+
+
+def bench_load(args):
+    upstream_port = free_port()
+    start_stub_upstream(upstream_port, args.upstream_delay / 1000)
+
+    print(f"Нагрузка: {args.concurrency} клиентов, {args.duration} с, доля промахов {args.miss_ratio}, "
+          f"задержка старшего DNS {args.upstream_delay} мс")
+    print(f"{'режим':<10}{'запросов/с':>14}{'p99, мс':>12}{'потеряно':>10}")
+
+    for mode in args.modes:
+        port = free_port()
+        process = start_server(port, upstream_port, ['--mode', mode])
+        try:
+            latencies, elapsed, lost = asyncio.run(generate_load(
+                port, args.duration, args.concurrency, args.miss_ratio, args.hot_names))
+        finally:
+            stop_server(process)
+        print(f"{mode:<10}{len(latencies) / elapsed:>14.0f}{percentile(latencies, 99) * 1000:>12.2f}{lost:>10}")
+
+
+def load_process(params):
+    random.seed()
+    return asyncio.run(generate_load(*params))
+
+
+def warm_names(port, hot_names):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(2.0)
+        for i in range(hot_names):
+            sock.sendto(build_query(i, f'hot{i}.bench.local'), ('127.0.0.1', port))
+            sock.recvfrom(4096)
+
+
+def bench_workers(args):
+    upstream_port = free_port()
+    start_stub_upstream(upstream_port, args.upstream_delay / 1000)
+
+    print(f"Нагрузка: {args.clients} процессов по {args.concurrency} клиентов, {args.duration} с, "
+          f"только попадания в кэш, ядер: {os.cpu_count()}")
+    print(f"{'процессов':<10}{'запросов/с':>14}{'p99, мс':>12}{'потеряно':>10}{'рост':>8}")
+
+    baseline = None
+    for workers in range(1, args.max_workers + 1):
+        port = free_port()
+        process = start_server(port, upstream_port, ['--workers', str(workers)])
+        try:
+            warm_names(port, args.hot_names)
+            params = (port, args.duration, args.concurrency, 0.0, args.hot_names)
+            with multiprocessing.Pool(args.clients) as pool:
+                results = pool.map(load_process, [params] * args.clients)
+        finally:
+            stop_server(process)
+
+        latencies = [latency for result in results for latency in result[0]]
+        qps = sum(len(result[0]) / result[1] for result in results)
+        lost = sum(result[2] for result in results)
+        baseline = baseline or qps
+        print(f"{workers:<10}{qps:>14.0f}{percentile(latencies, 99) * 1000:>12.2f}{lost:>10}"
+              f"{qps / baseline:>7.2f}x")
+
+
+def burst_client(params):
+    port, duration, burst, hot_names = params
+    queries = [build_query(i, f'hot{i % hot_names}.bench.local') for i in range(burst)]
+    answered = lost = 0
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(0.5)
+        started = time.perf_counter()
+        deadline = started + duration
+        while time.perf_counter() < deadline:
+            # Вся пачка уходит без ожидания ответов, затем собираем ответы
+            for query in queries:
+                sock.sendto(query, ('127.0.0.1', port))
+            received = 0
+            try:
+                while received < burst:
+                    sock.recvfrom(4096)
+                    received += 1
+            except socket.timeout:
+                pass
+            answered += received
+            lost += burst - received
+        return answered, lost, time.perf_counter() - started
+
+
+def bench_burst(args):
+    upstream_port = free_port()
+    start_stub_upstream(upstream_port, 0)
+
+    print(f"Нагрузка: {args.clients} процессов, пачки по {args.burst} запросов, {args.duration} с, "
+          f"только попадания в кэш")
+    print(f"{'режим':<10}{'ответов/с':>14}{'потеряно':>10}")
+
+    for mode in args.modes:
+        port = free_port()
+        process = start_server(port, upstream_port, ['--mode', mode])
+        try:
+            warm_names(port, args.hot_names)
+            params = (port, args.duration, args.burst, args.hot_names)
+            with multiprocessing.Pool(args.clients) as pool:
+                results = pool.map(burst_client, [params] * args.clients)
+        finally:
+            stop_server(process)
+
+        qps = sum(answered / elapsed for answered, _, elapsed in results)
+        lost = sum(result[1] for result in results)
+        print(f"{mode:<10}{qps:>14.0f}{lost:>10}")
+
+
+# Прежнее устройство кэша на defaultdict(list) для сравнения
+class LegacyDNSCache:
+    def __init__(self):
+        self.records = defaultdict(list)
+
+    def add_record(self, name, rtype, data, ttl):
+        self.records[(name, rtype)].append({
+            'data': data,
+            'expired': time.time() + ttl
+        })
+
+    def get_records(self, name, rtype):
+        current_time = time.time()
+        return [r for r in self.records.get((name, rtype), []) if r['expired'] > current_time]
+
+    def cleanup(self):
+        current_time = time.time()
+        removed = 0
+
+        for key in list(self.records.keys()):
+            self.records[key] = [r for r in self.records[key] if r['expired'] > current_time]
+            if not self.records[key]:
+                self.records.pop(key)
+                removed += 1
+
+        return removed
+
+
+# Прежняя сборка ответа: словари ответов на каждое попадание и имена без сжатия
+def legacy_encode_name(name):
+    encoded = bytearray()
+    for part in name.split('.'):
+        encoded.append(len(part))
+        encoded.extend(part.encode('ascii', 'replace'))
+    encoded.append(0)
+    return bytes(encoded)
+
+
+def legacy_build_dns_response(query, answers):
+    question = query['questions'][0]
+    header = struct.pack('!6H', query['id'], 0x8180, 1, len(answers), 0, 0)
+
+    response = bytearray()
+    response.extend(header)
+    response.extend(legacy_encode_name(question['name']))
+    response.extend(struct.pack('!2H', question['type'], question['class']))
+
+    for answer in answers:
+        response.extend(legacy_encode_name(answer['name']))
+        response.extend(struct.pack('!2HIH', answer['type'], 1, answer['ttl'], len(answer['data'])))
+        response.extend(answer['data'])
+
+    return bytes(response)
+
+
+def legacy_answer(query, cache):
+    question = query['questions'][0]
+    cached_records = cache.get_records(question['name'], question['type'])
+    answers = [{
+        'name': question['name'],
+        'type': question['type'],
+        'ttl': int(record.expired - time.time()),
+        'data': record.data
+    } for record in cached_records]
+    return legacy_build_dns_response(query, answers)
+
+
+def wire_answer(query, cache):
+    question = query['questions'][0]
+    return cache.get_response(query['id'], question['name'], question['type'], question['class'])
+
+
+# Прежний рекурсивный разбор пакетов для сравнения и проверки нового
+def legacy_decode_name(data, offset):
+    name = []
+    processed_pointers = set()
+
+    while True:
+        if offset >= len(data):
+            raise ValueError("Сдвиг выходит за пределы запроса")
+
+        length = data[offset]
+
+        if (length & 0xc0) == 0xc0:  # Компрессия
+            if offset + 1 >= len(data):
+                raise ValueError("Неправильный указатель сжатия")
+
+            pointer = struct.unpack('!H', data[offset:offset + 2])[0] & 0x3fff
+            if pointer in processed_pointers:
+                raise ValueError("Засечен цикл сжатия")
+
+            processed_pointers.add(pointer)
+            part, _ = legacy_decode_name(data, pointer)
+            name.append(part)
+            return '.'.join(name), offset + 2
+
+        elif length > 0:  # Обычная метка
+            if offset + 1 + length > len(data):
+                raise ValueError("Метка превышает длину пакета")
+
+            name.append(data[offset + 1:offset + 1 + length].decode('ascii',
+                                                                    'replace'))
+            offset += 1 + length
+        else:  # Конец имени
+            return '.'.join(name), offset + 1
+
+
+def legacy_find_opt(message, offset=None):
+    # Ищет OPT в секции additional: (начало записи, конец записи, размер UDP буфера) или None
+    _, _, qdcount, ancount, nscount, arcount = struct.unpack('!6H', message[:12])
+    if offset is None:
+        offset = 12
+        for _ in range(qdcount):
+            _, offset = legacy_decode_name(message, offset)
+            offset += 4
+
+    for index in range(ancount + nscount + arcount):
+        start = offset
+        _, offset = legacy_decode_name(message, offset)
+        rtype, rclass, _, rdlength = struct.unpack('!2HIH', message[offset:offset + 10])
+        offset += 10 + rdlength
+        if rtype == TYPE_OPT and index >= ancount + nscount:
+            return start, offset, rclass
+    return None
+
+
+def legacy_parse_dns_query(data):
+    try:
+        if len(data) < 12:
+            raise ValueError("Пакет слишком короткий")
+
+        header = struct.unpack('!6H', data[:12])
+        query_id = header[0]
+        qdcount = header[2]
+
+        questions = []
+        offset = 12
+
+        for _ in range(qdcount):
+            if offset >= len(data):
+                raise ValueError("Вопрос секции усечен")
+
+            name, offset = legacy_decode_name(data, offset)
+
+            if offset + 4 > len(data):
+                raise ValueError("Вопрос типа/класса усечен")
+
+            qtype, qclass = struct.unpack('!2H', data[offset:offset + 4])
+            questions.append({
+                'name': name,
+                'type': qtype,
+                'class': qclass
+            })
+            offset += 4
+
+        # Клиент с EDNS0 сообщает, какой UDP ответ он готов принять
+        opt = legacy_find_opt(data, offset) if header[5] else None
+        return {
+            'id': query_id,
+            'questions': questions,
+            'header': header,
+            'udp_size': max(CLASSIC_UDP_SIZE, opt[2]) if opt else CLASSIC_UDP_SIZE
+        }
+    except Exception as e:
+        print(f"Попытка обработки запроса провалена: {e}")
+        return None
+
+
+def legacy_parse_dns_response(response):
+    if not response or len(response) < 12:
+        return None
+
+    try:
+        header = struct.unpack('!6H', response[:12])
+        ancount = header[3]
+        nscount = header[4]
+        arcount = header[5]
+
+        offset = 12
+        for _ in range(header[2]):
+            _, offset = legacy_decode_name(response, offset)
+            offset += 4
+
+        records = []
+
+        for _ in range(ancount + nscount + arcount):
+            if offset >= len(response):
+                break
+
+            name, offset = legacy_decode_name(response, offset)
+
+            if offset + 10 > len(response):
+                break
+
+            rtype, rclass, ttl, rdlength = struct.unpack('!2HIH', response[offset:offset + 10])
+            offset += 10
+
+            if offset + rdlength > len(response):
+                break
+
+            rdata = response[offset:offset + rdlength]
+            if rtype in NAME_RDATA_TYPES:
+                # Имя в rdata может ссылаться на другие части пакета, храним его без сжатия
+                rdata = encode_name(legacy_decode_name(response, offset)[0])
+            offset += rdlength
+
+            if rclass == 1:
+                records.append({
+                    'name': name,
+                    'type': rtype,
+                    'data': rdata,
+                    'ttl': ttl
+                })
+
+        return records
+    except Exception as e:
+        print(f"Не получилось обработать ответ: {e}")
+        return None
+
+
+def legacy_parse_negative_response(response):
+    # Возвращает (имя, тип, отрицательный TTL, [(смещение TTL, TTL записи)]) или None
+    if not response or len(response) < 12:
+        return None
+
+    try:
+        _, flags, qdcount, ancount, nscount, arcount = struct.unpack('!6H', response[:12])
+        rcode = flags & 0x000f
+        if flags & 0x0200 or qdcount != 1:  # Усеченные ответы не кэшируем
+            return None
+        if rcode != RCODE_NXDOMAIN and not (rcode == 0 and ancount == 0):
+            return None
+
+        name, offset = legacy_decode_name(response, 12)
+        qtype, qclass = struct.unpack('!2H', response[offset:offset + 4])
+        offset += 4
+        if qclass != 1:
+            return None
+
+        negative_ttl = None
+        ttl_offsets = []
+        for index in range(ancount + nscount + arcount):
+            _, offset = legacy_decode_name(response, offset)
+            if offset + 10 > len(response):
+                return None
+
+            rtype, _, ttl, rdlength = struct.unpack('!2HIH', response[offset:offset + 10])
+            if offset + 10 + rdlength > len(response):
+                return None
+
+            if rtype != TYPE_OPT:  # В OPT на месте TTL лежат флаги EDNS
+                ttl_offsets.append((offset + 4, ttl))
+
+            is_authority = ancount <= index < ancount + nscount
+            if is_authority and rtype == TYPE_SOA and rdlength >= 20:
+                minimum = struct.unpack('!I', response[offset + 10 + rdlength - 4:offset + 10 + rdlength])[0]
+                negative_ttl = min(ttl, minimum)
+
+            offset += 10 + rdlength
+
+        if negative_ttl is None:  # Без SOA отрицательный ответ не кэшируется
+            return None
+        return name, qtype, negative_ttl, ttl_offsets
+    except Exception as e:
+        print(f"Не получилось обработать отрицательный ответ: {e}")
+        return None
+
+
+def build_negative(name, qtype, rcode=RCODE_NXDOMAIN):
+    zone = name.split('.', 1)[1]
+    response = bytearray(struct.pack('!6H', 0, 0x8180 | rcode, 1, 0, 1, 0))
+    compression = {}
+    response.extend(encode_name(name, compression, len(response)))
+    response.extend(struct.pack('!2H', qtype, 1))
+    soa = bytearray(encode_name(f'ns1.{zone}'))
+    soa.extend(encode_name(f'hostmaster.{zone}'))
+    soa.extend(struct.pack('!5I', 2024010101, 7200, 900, 1209600, 300))
+    response.extend(encode_name(zone, compression, len(response)))
+    response.extend(struct.pack('!2HIH', TYPE_SOA, 1, 3600, len(soa)))
+    response.extend(soa)
+    return bytes(response)
+
+
+def with_opt(message):
+    header = bytearray(message[:12])
+    struct.pack_into('!H', header, 10, struct.unpack_from('!H', header, 10)[0] + 1)
+    return bytes(header) + message[12:] + OPT_RECORD
+
+
+def synthetic_corpus(count):
+    # Типичные ответы резолвера: A/AAAA с несколькими адресами, цепочки CNAME, NS, NXDOMAIN/NODATA с SOA
+    corpus = []
+    for i in range(count):
+        name = f'www{i}.service{i % 50}.example.com'
+        kind = i % 5
+        if kind == 0:
+            answers = [{'name': name, 'type': 1, 'ttl': 300, 'data': socket.inet_aton(f'10.0.{i % 256}.{j}')}
+                       for j in range(1 + i % 4)]
+            qtype = 1
+        elif kind == 1:
+            answers = [{'name': name, 'type': 28, 'ttl': 300, 'data': bytes(15) + bytes([j])}
+                       for j in range(1 + i % 3)]
+            qtype = 28
+        elif kind == 2:
+            target = f'edge{i % 7}.cdn.example.net'
+            answers = [{'name': name, 'type': 5, 'ttl': 60, 'data': encode_name(f'alias.service{i % 50}.example.com')},
+                       {'name': f'alias.service{i % 50}.example.com', 'type': 5, 'ttl': 60,
+                        'data': encode_name(target)}]
+            answers += [{'name': target, 'type': 1, 'ttl': 20, 'data': socket.inet_aton(f'192.0.2.{j}')}
+                        for j in range(2)]
+            qtype = 1
+        elif kind == 3:
+            answers = [{'name': f'service{i % 50}.example.com', 'type': 2, 'ttl': 86400,
+                        'data': encode_name(f'ns{j}.example.com')} for j in range(4)]
+            name = f'service{i % 50}.example.com'
+            qtype = 2
+        else:
+            corpus.append(build_negative(name, 1, RCODE_NXDOMAIN if i % 2 else 0))
+            continue
+
+        query = {'id': i & 0xffff, 'questions': [{'name': name, 'type': qtype, 'class': 1}]}
+        response = build_dns_response(query, answers)
+        corpus.append(with_opt(response) if i % 3 == 0 else response)
+    return corpus
+
+
+def load_corpus(args):
+    if not args.corpus:
+        return synthetic_corpus(args.packets)
+
+    # Файл с сообщениями в формате DNS поверх TCP: 2 байта длины, затем пакет
+    corpus = []
+    with open(args.corpus, 'rb') as file:
+        data = file.read()
+    offset = 0
+    while offset + 2 <= len(data):
+        length = struct.unpack_from('!H', data, offset)[0]
+        corpus.append(data[offset + 2:offset + 2 + length])
+        offset += 2 + length
+    return corpus
+
+
+PARSERS = {
+    'прежний': (legacy_parse_dns_query, legacy_parse_dns_response, legacy_parse_negative_response),
+    'новый': (parse_dns_query, parse_dns_response, parse_negative_response),
+}
+
+
+def bench_parse(args):
+    corpus = load_corpus(args)
+    queries = [build_query(i, f'www{i}.service{i % 50}.example.com') for i in range(len(corpus))]
+
+    print(f"Пакетов: {len(corpus)} (в среднем {sum(map(len, corpus)) / len(corpus):.0f} байт), "
+          f"повторов: {args.repeat}")
+    print(f"{'разбор':<10}{'мкс/ответ':>12}{'мкс/запрос':>12}")
+
+    results = {}
+    for title, (parse_query, parse_response, parse_negative) in PARSERS.items():
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            for response in corpus:
+                parse_response(response)
+                parse_negative(response)
+        response_time = (time.perf_counter() - started) / args.repeat / len(corpus)
+
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            for query in queries:
+                parse_query(query)
+        query_time = (time.perf_counter() - started) / args.repeat / len(queries)
+
+        results[title] = response_time
+        print(f"{title:<10}{response_time * 1e6:>12.2f}{query_time * 1e6:>12.2f}")
+
+    print(f"Ускорение разбора ответов: {results['прежний'] / results['новый']:.2f}x")
+
+
+def mutate(packet, rng):
+    data = bytearray(packet)
+    for _ in range(rng.randint(1, 4)):
+        if not data:
+            break
+        action = rng.randrange(5)
+        position = rng.randrange(len(data))
+        if action == 0:
+            data[position] = rng.randrange(256)
+        elif action == 1:
+            # Указатель сжатия в случайное место, в том числе на самого себя
+            data[position:position + 2] = bytes([0xc0 | rng.randrange(4), rng.randrange(256)])
+        elif action == 2:
+            del data[position:]
+        elif action == 3 and len(data) >= 12:
+            struct.pack_into('!H', data, 2 * rng.randrange(2, 6), rng.randrange(8))
+        else:
+            data[position:position] = bytes(rng.randrange(256) for _ in range(rng.randrange(1, 8)))
+    return bytes(data)
+
+
+def run_parser(parser, packet):
+    try:
+        return parser(packet)
+    except Exception:
+        return 'ошибка'
+
+
+def bench_fuzz(args):
+    rng = random.Random(args.seed)
+    corpus = load_corpus(args)
+    corpus += [build_query(i, f'www{i}.example.com') for i in range(len(corpus) // 4)]
+    corpus += [with_opt(query) for query in corpus[-len(corpus) // 5:]]
+
+    checks = [
+        ('parse_dns_query', legacy_parse_dns_query, parse_dns_query),
+        ('parse_dns_response', legacy_parse_dns_response, parse_dns_response),
+        ('parse_negative_response', legacy_parse_negative_response, parse_negative_response),
+        ('find_opt', legacy_find_opt, find_opt),
+    ]
+
+    mismatches = 0
+    started = time.perf_counter()
+    # Оба парсера печатают ошибки разбора, в выводе теста они не нужны
+    with contextlib.redirect_stdout(io.StringIO()):
+        for iteration in range(args.iterations):
+            packet = mutate(rng.choice(corpus), rng)
+            for title, legacy, current in checks:
+                expected = run_parser(legacy, packet)
+                actual = run_parser(current, packet)
+                if expected != actual:
+                    mismatches += 1
+                    if mismatches <= 5:
+                        sys.stderr.write(f"Расхождение в {title}: {packet.hex()}\n"
+                                         f"  прежний: {expected!r}\n  новый:   {actual!r}\n")
+
+    print(f"Пакетов: {args.iterations}, проверок: {args.iterations * len(checks)}, "
+          f"расхождений: {mismatches}, {time.perf_counter() - started:.1f} с")
+    if mismatches:
+        sys.exit(1)
+
+
+def bench_wire(args):
+    name = 'www.bench.example.com'
+    cases = [
+        ('A', 1, [socket.inet_aton(f'10.0.0.{i}') for i in range(args.records)]),
+        ('NS', 2, [encode_name(f'ns{i}.bench.example.com') for i in range(args.records)]),
+    ]
+
+    print(f"Попаданий: {args.hits}, записей в ответе: {args.records}")
+    print(f"{'тип':<6}{'сборка':<10}{'мкс/ответ':>12}{'байт':>8}")
+
+    for title, rtype, rdatas in cases:
+        cache = DNSCache()
+        for data in rdatas:
+            cache.add_record(name, rtype, data, 3600)
+        query = parse_dns_query(build_query(1, name, rtype))
+
+        for method, answer in (('прежняя', legacy_answer), ('wire', wire_answer)):
+            size = len(answer(query, cache))
+            started = time.perf_counter()
+            for _ in range(args.hits):
+                answer(query, cache)
+            elapsed = (time.perf_counter() - started) / args.hits
+            print(f"{title:<6}{method:<10}{elapsed * 1e6:>12.2f}{size:>8}")
+
+
+def fill_cache(cache, names, expired_every):
+    data = socket.inet_aton('10.0.0.1')
+    for i, name in enumerate(names):
+        cache.add_record(name, 1, data, 0 if i % expired_every == 0 else 3600)
+
+
+def bench_cache(args):
+    names = [f'host{i}.bench.local' for i in range(args.entries)]
+    lookups = [names[random.randrange(args.entries)] for _ in range(args.lookups)]
+    engines = [
+        ('defaultdict', LegacyDNSCache),
+        ('lru+heap', lambda: DNSCache(max_entries=args.entries, max_bytes=1 << 40)),
+    ]
+
+    print(f"Записей: {args.entries}, поисков: {args.lookups}, просрочено: 1/{args.expired_every}")
+    print(f"{'кэш':<14}{'вставка, с':>12}{'поиск, мкс':>12}{'очистка, мс':>13}{'память, МБ':>12}")
+
+    for title, factory in engines:
+        tracemalloc.start()
+        cache = factory()
+        fill_cache(cache, names, args.expired_every)
+        memory = tracemalloc.get_traced_memory()[0] / 1024 / 1024
+        tracemalloc.stop()
+        del cache
+
+        cache = factory()
+        started = time.perf_counter()
+        fill_cache(cache, names, args.expired_every)
+        insert_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        cache.cleanup()
+        cleanup_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for name in lookups:
+            cache.get_records(name, 1)
+        lookup_time = (time.perf_counter() - started) / len(lookups)
+
+        print(f"{title:<14}{insert_time:>12.2f}{lookup_time * 1e6:>12.2f}"
+              f"{cleanup_time * 1000:>13.1f}{memory:>12.1f}")
+        del cache
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарки кэширующего DNS сервера')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    load = commands.add_parser('load', help='Нагрузочный тест против локальной заглушки старшего DNS')
+    load.add_argument('--modes', nargs='+', default=['loop', 'batch', 'async'],
+                      help='Режимы сервера для сравнения')
+    load.add_argument('--duration', type=float, default=5.0,
+                      help='Длительность теста каждого режима в секундах')
+    load.add_argument('--concurrency', type=int, default=50,
+                      help='Количество одновременных клиентов')
+    load.add_argument('--miss-ratio', type=float, default=0.1,
+                      help='Доля запросов с уникальными именами (промахи кэша)')
+    load.add_argument('--hot-names', type=int, default=100,
+                      help='Количество популярных имен')
+    load.add_argument('--upstream-delay', type=float, default=20.0,
+                      help='Задержка ответа заглушки в миллисекундах')
+    load.set_defaults(func=bench_load)
+
+    burst = commands.add_parser('burst', help='Пачки попаданий в кэш: пакетный режим против последовательного цикла')
+    burst.add_argument('--modes', nargs='+', default=['loop', 'batch', 'async'],
+                       help='Режимы сервера для сравнения')
+    burst.add_argument('--clients', type=int, default=4,
+                       help='Число процессов, генерирующих нагрузку')
+    burst.add_argument('--burst', type=int, default=64,
+                       help='Запросов в одной пачке')
+    burst.add_argument('--duration', type=float, default=5.0,
+                       help='Длительность теста каждого режима в секундах')
+    burst.add_argument('--hot-names', type=int, default=100,
+                       help='Количество имен в кэше')
+    burst.set_defaults(func=bench_burst)
+
+    cache = commands.add_parser('cache', help='Микробенчмарк движка кэша против defaultdict(list)')
+    cache.add_argument('--entries', type=int, default=1_000_000,
+                       help='Количество ключей в кэше')
+    cache.add_argument('--lookups', type=int, default=1_000_000,
+                       help='Количество поисков')
+    cache.add_argument('--expired-every', type=int, default=10,
+                       help='Каждая N-ая запись сразу просрочена')
+    cache.set_defaults(func=bench_cache)
+
+    wire = commands.add_parser('wire', help='Стоимость ответа из кэша: сборка заново против готового wire-формата')
+    wire.add_argument('--hits', type=int, default=200_000,
+                      help='Количество ответов из кэша')
+    wire.add_argument('--records', type=int, default=4,
+                      help='Количество записей в ответе')
+    wire.set_defaults(func=bench_wire)
+
+    parse = commands.add_parser('parse', help='Скорость разбора пакетов: прежний рекурсивный против memoryview')
+    parse.add_argument('--packets', type=int, default=2000,
+                       help='Размер синтетического набора ответов')
+    parse.add_argument('--corpus',
+                       help='Файл с записанными ответами (2 байта длины перед каждым пакетом)')
+    parse.add_argument('--repeat', type=int, default=20,
+                       help='Сколько раз разобрать весь набор')
+    parse.set_defaults(func=bench_parse)
+
+    fuzz = commands.add_parser('fuzz', help='Сравнение нового разбора с прежним на испорченных пакетах')
+    fuzz.add_argument('--iterations', type=int, default=100_000,
+                      help='Количество случайных пакетов')
+    fuzz.add_argument('--packets', type=int, default=500,
+                      help='Размер синтетического набора, из которого берутся пакеты')
+    fuzz.add_argument('--corpus',
+                      help='Файл с записанными ответами (2 байта длины перед каждым пакетом)')
+    fuzz.add_argument('--seed', type=int, default=1,
+                      help='Зерно генератора случайных чисел')
+    fuzz.set_defaults(func=bench_fuzz)
+
+    workers = commands.add_parser('workers', help='Масштабирование по числу рабочих процессов (--workers)')
+    workers.add_argument('--max-workers', type=int, default=os.cpu_count(),
+                         help='Максимальное число рабочих процессов')
+    workers.add_argument('--clients', type=int, default=os.cpu_count(),
+                         help='Число процессов, генерирующих нагрузку')
+    workers.add_argument('--concurrency', type=int, default=32,
+                         help='Одновременных клиентов в каждом процессе нагрузки')
+    workers.add_argument('--duration', type=float, default=5.0,
+                         help='Длительность теста в секундах')
+    workers.add_argument('--hot-names', type=int, default=100,
+                         help='Количество имен в кэше')
+    workers.add_argument('--upstream-delay', type=float, default=1.0,
+                         help='Задержка ответа заглушки в миллисекундах')
+    workers.set_defaults(func=bench_workers)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
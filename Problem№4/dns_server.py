@@ -1,73 +1,640 @@
 import argparse
+import asyncio
+import errno
+import hashlib
+import heapq
+import mmap
+import os
+import random
+import selectors
 import socket
 import struct
+import threading
 import time
 import signal
 import sys
-import pickle
-from collections import defaultdict
+import zlib
+from collections import Counter, OrderedDict
 
 
-class DNSCache:
+VERBOSE = True
+
+# Типы записей, rdata которых состоит из одного доменного имени (NS, CNAME, PTR)
+NAME_RDATA_TYPES = {2, 5, 12}
+
+RCODE_NXDOMAIN = 3
+TYPE_SOA = 6
+TYPE_OPT = 41
+
+# RFC 8767: TTL, с которым отдаются просроченные записи
+STALE_TTL = 30
+# Пауза перед повторным обновлением записи, если предыдущее не удалось
+REFRESH_RETRY = 5
+
+# Формат файла кэша: заголовок, кадры записей, отсортированный индекс (хэш ключа, смещение кадра), концевик
+SNAPSHOT_MAGIC = b'DNSC'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('!4sH')
+SNAPSHOT_FOOTER = struct.Struct('!4sHQQ')
+INDEX_ITEM = struct.Struct('!QQ')
+# Кадр: длина тела и его CRC32, чтобы оборванный при сбое хвост журнала отбрасывался
+FRAME_HEADER = struct.Struct('!II')
+FRAME_KEY = struct.Struct('!BHH')
+FRAME_VALUE = struct.Struct('!dI')
+KIND_RECORD = 1
+KIND_NEGATIVE = 2
+
+# EDNS0: размер UDP буфера, который объявляем старшим серверам, и предел для клиентов без EDNS
+EDNS_UDP_SIZE = 1232
+CLASSIC_UDP_SIZE = 512
+OPT_RECORD = b'\x00' + struct.pack('!2HIH', TYPE_OPT, EDNS_UDP_SIZE, 0, 0)
+
+# Старшие серверы: задержка перед запросом к следующему серверу и отключение после череды отказов
+INITIAL_HEDGE_DELAY = 0.3
+MIN_HEDGE_DELAY = 0.02
+MAX_HEDGE_DELAY = 1.0
+FAILURES_TO_TRIP = 3
+TRIP_TIME = 30
+
+ID_FIELD = struct.Struct('!H')
+TTL_FIELD = struct.Struct('!I')
+HEADER = struct.Struct('!6H')
+QUESTION = struct.Struct('!2H')
+RECORD_HEADER = struct.Struct('!2HIH')
+
+# Больше переходов по указателям, чем меток в самом длинном имени, бывает только при цикле
+MAX_POINTERS = 128
+
+
+def log(message):
+    if VERBOSE:
+        print(message)
+
+
+class CachedRecord:
+    __slots__ = ('data', 'expired')
+
+    def __init__(self, data, expired):
+        self.data = data
+        self.expired = expired
+
+
+class CacheEntry:
+    __slots__ = ('records', 'expired', 'size', 'wire', 'ttl_offsets', 'patched', 'negative',
+                 'stored', 'hits', 'refresh_after')
+
     def __init__(self):
-        self.records = defaultdict(list)
+        self.records = ()
+        self.stored = 0.0
+        # Попадания с момента последнего обновления и когда можно снова запросить обновление
+        self.hits = 0
+        self.refresh_after = 0.0
+        # Отрицательная запись (NXDOMAIN/NODATA): ответ хранится только в wire
+        self.negative = False
+        self.expired = 0.0
+        self.size = 0
+        # Готовый к отправке ответ и смещения полей TTL в нем (смещение, момент истечения)
+        self.wire = None
+        self.ttl_offsets = ()
+        # Секунда, для которой в wire уже записаны TTL
+        self.patched = None
+
+
+def key_hash(name, rtype):
+    digest = hashlib.blake2b(f'{name}\0{rtype}'.encode('utf-8', 'replace'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+def encode_frame(kind, name, rtype, expired, payload):
+    name_bytes = name.encode('utf-8', 'replace')
+    body = (FRAME_KEY.pack(kind, rtype, len(name_bytes)) + name_bytes +
+            FRAME_VALUE.pack(expired, len(payload)) + payload)
+    return FRAME_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def decode_frame(data, offset):
+    # Возвращает ((вид, имя, тип, момент истечения, данные), смещение следующего кадра) или None
+    start = offset + FRAME_HEADER.size
+    if start > len(data):
+        return None
+
+    length, crc = FRAME_HEADER.unpack_from(data, offset)
+    body = data[start:start + length]
+    if len(body) != length or zlib.crc32(body) != crc:
+        return None
+
+    kind, rtype, name_length = FRAME_KEY.unpack_from(body)
+    name_end = FRAME_KEY.size + name_length
+    name = bytes(body[FRAME_KEY.size:name_end]).decode('utf-8', 'replace')
+    expired, payload_length = FRAME_VALUE.unpack_from(body, name_end)
+    payload_start = name_end + FRAME_VALUE.size
+    payload = bytes(body[payload_start:payload_start + payload_length])
+    return (kind, name, rtype, expired, payload), start + length
+
+
+def read_frames(data, offset=0, end=None):
+    end = len(data) if end is None else end
+    while offset < end:
+        decoded = decode_frame(data, offset)
+        if decoded is None:
+            break
+        frame, offset = decoded
+        yield frame
+
+
+def encode_negative(wire, ttl_offsets):
+    payload = bytearray(struct.pack('!H', len(ttl_offsets)))
+    for offset, expired in ttl_offsets:
+        payload.extend(struct.pack('!Hd', offset, expired))
+    return bytes(payload + wire)
+
+
+def decode_negative(payload):
+    count = struct.unpack_from('!H', payload)[0]
+    ttl_offsets = tuple(struct.unpack_from('!Hd', payload, 2 + i * 10) for i in range(count))
+    return payload[2 + count * 10:], ttl_offsets
+
+
+def write_snapshot(filename, frames):
+    temp_filename = filename + '.tmp'
+    index = []
+    with open(temp_filename, 'wb') as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION))
+        offset = SNAPSHOT_HEADER.size
+        for kind, name, rtype, expired, payload in frames:
+            frame = encode_frame(kind, name, rtype, expired, payload)
+            index.append((key_hash(name, rtype), offset))
+            f.write(frame)
+            offset += len(frame)
+
+        index.sort()
+        for item in index:
+            f.write(INDEX_ITEM.pack(*item))
+        f.write(SNAPSHOT_FOOTER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, offset, len(index)))
+        f.flush()
+        os.fsync(f.fileno())
+
+    # Атомарная замена: после сбоя остается либо старый, либо новый снимок целиком
+    os.replace(temp_filename, filename)
+    return len(index)
+
+
+class CacheSnapshot:
+    # Снимок кэша, отображенный в память; записи читаются только по запросу через индекс
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        try:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version = SNAPSHOT_HEADER.unpack_from(self.data)
+            footer = SNAPSHOT_FOOTER.unpack_from(self.data, len(self.data) - SNAPSHOT_FOOTER.size)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION or footer[:2] != (magic, version):
+                raise ValueError("Невалидный формат кэша")
+        except Exception:
+            self.file.close()
+            raise
+        _, _, self.index_offset, self.index_count = footer
+
+    def __len__(self):
+        return self.index_count
+
+    def index_item(self, position):
+        return INDEX_ITEM.unpack_from(self.data, self.index_offset + position * INDEX_ITEM.size)
+
+    def find(self, name, rtype):
+        target = key_hash(name, rtype)
+        low, high = 0, self.index_count
+        while low < high:
+            middle = (low + high) // 2
+            if self.index_item(middle)[0] < target:
+                low = middle + 1
+            else:
+                high = middle
+
+        frames = []
+        while low < self.index_count:
+            item_hash, offset = self.index_item(low)
+            if item_hash != target:
+                break
+            decoded = decode_frame(self.data, offset)
+            if decoded and decoded[0][1] == name and decoded[0][2] == rtype:
+                frames.append(decoded[0])
+            low += 1
+        return frames
+
+    def frames(self):
+        return read_frames(self.data, SNAPSHOT_HEADER.size, self.index_offset)
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+
+class CacheJournal:
+    # Журнал изменений с момента последнего снимка, только дозапись
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'ab')
 
-    def add_record(self, name, rtype, data, ttl):
-        self.records[(name, rtype)].append({
-            'data': data,
-            'expired': time.time() + ttl
-        })
+    def append(self, kind, name, rtype, expired, payload):
+        self.file.write(encode_frame(kind, name, rtype, expired, payload))
+
+    def flush(self):
+        self.file.flush()
+
+    def rotate(self):
+        # Текущий журнал откладывается до завершения снимка, новые изменения идут в чистый файл
+        self.file.close()
+        os.replace(self.filename, self.filename + '.1')
+        self.file = open(self.filename, 'ab')
+
+    def close(self):
+        self.file.close()
+
+
+class DNSCache:
+    # Примерная стоимость записи и ключа в памяти сверх самих данных
+    RECORD_OVERHEAD = 120
+    ENTRY_OVERHEAD = 250
+
+    def __init__(self, max_entries=100_000, max_bytes=64 * 1024 * 1024,
+                 prefetch_threshold=0.9, prefetch_min_hits=3, stale_window=0, checkpoint_interval=300):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # Доля TTL, после которой популярная запись обновляется заранее (0 - выключено)
+        self.prefetch_threshold = prefetch_threshold
+        self.prefetch_min_hits = prefetch_min_hits
+        # Сколько секунд после истечения TTL запись еще можно отдавать (0 - выключено)
+        self.stale_window = stale_window
+        # Ключи, которые нужно обновить запросом к старшему серверу
+        self.refresh_queue = set()
+        # (имя, тип) -> CacheEntry в порядке последнего использования
+        self.entries = OrderedDict()
+        # Куча (момент истечения, ключ); устаревшие элементы пропускаются при извлечении
+        self.expiry = []
+        self.size = 0
+        self.evicted = 0
+        self.stats = Counter()
+        # Сохранение: снимок на диске, журнал изменений и фоновая запись нового снимка
+        self.filename = None
+        self.snapshot = None
+        self.journal = None
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_thread = None
+        self.checkpoint_result = False
+        self.last_checkpoint = time.time()
+        self.last_cleanup = time.time()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add_record(self, name, rtype, data, ttl, persist=True):
+        key = (name, rtype)
+        current_time = time.time()
+        record = CachedRecord(data, current_time + ttl)
+        if persist and self.journal:
+            self.journal.append(KIND_RECORD, name, rtype, record.expired, data)
+
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = CacheEntry()
+            self.entries[key] = entry
+            records = (record,)
+        else:
+            self.entries.move_to_end(key)
+            if entry.expired <= current_time:
+                records = (record,)
+            else:
+                records = tuple(r for r in entry.records if r.data != data) + (record,)
+
+        self.set_records(key, entry, records)
+        if len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            self.evict()
+
+    def set_records(self, key, entry, records):
+        size = self.ENTRY_OVERHEAD + len(key[0])
+        expired = records[0].expired
+        for record in records:
+            size += self.RECORD_OVERHEAD + len(record.data)
+            if record.expired < expired:
+                expired = record.expired
+
+        self.size += size - entry.size
+        entry.size = size
+        entry.records = records
+        entry.wire = None
+        entry.negative = False
+        self.set_expired(key, entry, expired)
+
+    def set_expired(self, key, entry, expired):
+        entry.stored = time.time()
+        entry.hits = 0
+        entry.refresh_after = 0.0
+        if expired != entry.expired:
+            entry.expired = expired
+            heapq.heappush(self.expiry, (expired, key))
+
+    def add_negative(self, name, rtype, response, ttl_offsets, ttl):
+        # RFC 2308: отрицательный ответ живет не дольше минимума из TTL и MINIMUM записи SOA
+        current_time = time.time()
+        expired = current_time + ttl
+        ttl_offsets = tuple((offset, min(expired, current_time + rr_ttl)) for offset, rr_ttl in ttl_offsets)
+        self.store_negative(name, rtype, response, ttl_offsets, expired)
+
+    def store_negative(self, name, rtype, response, ttl_offsets, expired, persist=True):
+        key = (name, rtype)
+        if persist and self.journal:
+            self.journal.append(KIND_NEGATIVE, name, rtype, expired, encode_negative(response, ttl_offsets))
+
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = CacheEntry()
+            self.entries[key] = entry
+        else:
+            self.entries.move_to_end(key)
+
+        size = self.ENTRY_OVERHEAD + len(name) + len(response)
+        self.size += size - entry.size
+        entry.size = size
+        entry.records = ()
+        entry.negative = True
+        entry.wire = bytearray(response)
+        entry.ttl_offsets = ttl_offsets
+        entry.patched = None
+        self.set_expired(key, entry, expired)
+
+        if len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            self.evict()
+
+    def lookup(self, key, allow_stale=False):
+        entry = self.entries.get(key)
+        if entry is None and self.snapshot:
+            self.restore(key)
+            entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        current_time = time.time()
+        if entry.expired <= current_time:
+            if entry.expired + self.stale_window <= current_time:
+                self.remove(key)
+                return None
+            if not allow_stale:
+                return None
+
+        self.entries.move_to_end(key)
+        return entry
+
+    def request_refresh(self, key, entry, current_time):
+        if current_time >= entry.refresh_after:
+            entry.refresh_after = current_time + REFRESH_RETRY
+            self.refresh_queue.add(key)
 
     def get_records(self, name, rtype):
+        entry = self.lookup((name, rtype))
+        return entry.records if entry is not None else ()
+
+    def get_response(self, query_id, name, rtype, rclass=1):
+        if rclass != 1:
+            return None
+
+        key = (name, rtype)
+        entry = self.lookup(key, allow_stale=True)
+        if entry is None:
+            self.stats['misses'] += 1
+            return None
+
         current_time = time.time()
-        return [r for r in self.records.get((name, rtype), []) if r['expired'] > current_time]
+        stale = entry.expired <= current_time
+        entry.hits += 1
+        if stale:
+            self.stats['stale_hits'] += 1
+            self.request_refresh(key, entry, current_time)
+        elif (self.prefetch_threshold and entry.hits >= self.prefetch_min_hits and
+              current_time >= entry.stored + (entry.expired - entry.stored) * self.prefetch_threshold):
+            self.request_refresh(key, entry, current_time)
+
+        self.stats['negative_hits' if entry.negative else 'hits'] += 1
+        if entry.wire is None:
+            entry.wire, entry.ttl_offsets = build_wire_response(name, rtype, entry.records)
+            entry.patched = None
+            entry.size += len(entry.wire)
+            self.size += len(entry.wire)
+
+        # Меняем только ID и оставшиеся TTL, остальной ответ уже собран
+        wire = entry.wire
+        ID_FIELD.pack_into(wire, 0, query_id)
+        current_second = 'stale' if stale else int(current_time)
+        if entry.patched != current_second:
+            pack_ttl = TTL_FIELD.pack_into
+            for offset, expired in entry.ttl_offsets:
+                pack_ttl(wire, offset, STALE_TTL if stale else max(0, int(expired) - current_second))
+            entry.patched = current_second
+        return bytes(wire)
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def evict(self):
+        while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+            _, entry = self.entries.popitem(last=False)
+            self.size -= entry.size
+            self.evicted += 1
 
     def cleanup(self):
         current_time = time.time()
         removed = 0
 
-        for key in list(self.records.keys()):
-            self.records[key] = [r for r in self.records[key] if r['expired'] > current_time]
-            if not self.records[key]:
-                self.records.pop(key)
+        while self.expiry and self.expiry[0][0] + self.stale_window <= current_time:
+            expired, key = heapq.heappop(self.expiry)
+            entry = self.entries.get(key)
+            if entry is not None and entry.expired == expired:
+                self.remove(key)
                 removed += 1
 
+        # Не даем куче разрастись из-за устаревших элементов (обновленные и вытесненные ключи)
+        if len(self.expiry) > 2 * len(self.entries) + 1024:
+            self.expiry = [(entry.expired, key) for key, entry in self.entries.items()]
+            heapq.heapify(self.expiry)
+
         if removed > 0:
             print(f"Убрал {removed} просроченные записи")
 
         return removed
 
+    def print_stats(self):
+        hits = self.stats['hits']
+        negative_hits = self.stats['negative_hits']
+        total = hits + negative_hits + self.stats['misses']
+        if not total:
+            return
+
+        print(f"Попаданий в кэш: {(hits + negative_hits) / total:.1%} "
+              f"(положительных {hits / total:.1%}, отрицательных {negative_hits / total:.1%}), "
+              f"промахов: {self.stats['misses']}, вытеснено: {self.evicted}")
+        print(f"Просроченных ответов: {self.stats['stale_hits']}, "
+              f"обновлений заранее: {self.stats['refreshes']}")
+
+    def restore(self, key):
+        for frame in self.snapshot.find(*key):
+            self.apply_frame(frame)
+
+    def apply_frame(self, frame, persist=False):
+        kind, name, rtype, expired, payload = frame
+        # В файле хранится абсолютный момент истечения, в кэш кладем оставшийся TTL
+        ttl = expired - time.time()
+        if ttl <= -self.stale_window or (ttl <= 0 and not self.stale_window):
+            return False
+
+        if kind == KIND_RECORD:
+            self.add_record(name, rtype, payload, ttl, persist)
+        elif kind == KIND_NEGATIVE:
+            wire, ttl_offsets = decode_negative(payload)
+            self.store_negative(name, rtype, wire, ttl_offsets, expired, persist)
+        return True
+
+    def entry_frames(self):
+        frames = []
+        for (name, rtype), entry in self.entries.items():
+            if entry.negative:
+                frames.append((KIND_NEGATIVE, name, rtype, entry.expired,
+                               encode_negative(bytes(entry.wire), entry.ttl_offsets)))
+            else:
+                frames.extend((KIND_RECORD, name, rtype, r.expired, r.data) for r in entry.records)
+        return frames
+
+    def checkpoint(self):
+        if self.filename is None or self.checkpoint_thread is not None:
+            return False
+
+        # В основном потоке только копируем ссылки, файл пишется в фоне
+        self.journal.flush()
+        self.journal.rotate()
+        frames = self.entry_frames()
+        keys = set(self.entries)
+        self.checkpoint_thread = threading.Thread(
+            target=self.write_checkpoint, args=(frames, self.snapshot, keys), daemon=True)
+        self.checkpoint_thread.start()
+        self.last_checkpoint = time.time()
+        return True
+
+    def write_checkpoint(self, frames, snapshot, keys):
+        def all_frames():
+            yield from frames
+            if snapshot:
+                # Записи старого снимка, которые еще не поднимались в память, переносим как есть
+                current_time = time.time()
+                for frame in snapshot.frames():
+                    if (frame[1], frame[2]) not in keys and frame[3] + self.stale_window > current_time:
+                        yield frame
+
+        try:
+            self.checkpoint_result = write_snapshot(self.filename, all_frames())
+        except Exception as e:
+            print(f"Процесс сохранения был прерван: {e}")
+            self.checkpoint_result = None
+
+    def poll_checkpoint(self, wait=False):
+        thread = self.checkpoint_thread
+        if thread is None:
+            return
+        if wait:
+            thread.join()
+        if thread.is_alive():
+            return
+
+        self.checkpoint_thread = None
+        rotated = self.journal.filename + '.1'
+        if self.checkpoint_result is None:
+            # Снимок не записан: отложенный журнал возвращаем в текущий
+            with open(rotated, 'rb') as f:
+                self.journal.file.write(f.read())
+            self.journal.flush()
+            os.remove(rotated)
+            return
+
+        old_snapshot = self.snapshot
+        self.snapshot = CacheSnapshot(self.filename)
+        if old_snapshot:
+            old_snapshot.close()
+        os.remove(rotated)
+        print(f"Кэш сохранен в {self.filename}: {self.checkpoint_result} записей")
+
+    def maintain(self):
+        current_time = time.time()
+        if self.journal:
+            self.journal.flush()
+            self.poll_checkpoint()
+
+        if current_time - self.last_cleanup > 60:
+            self.cleanup()
+            self.last_cleanup = current_time
+
+        if self.checkpoint_interval and current_time - self.last_checkpoint > self.checkpoint_interval:
+            self.checkpoint()
+
     def save_to_file(self, filename):
         try:
-            with open(filename, 'wb') as cache:
-                pickle.dump(dict(self.records), cache)
-            print(f"Кэш сохранен в {filename}")
-            return True
+            if self.filename is None:
+                self.open_files(filename)
+            self.poll_checkpoint(wait=True)
+            if self.checkpoint():
+                self.poll_checkpoint(wait=True)
+            return self.checkpoint_result is not None
         except Exception as e:
             print(f"Процесс сохранения был прерван: {e}")
             return False
 
+    def open_files(self, filename):
+        self.filename = filename
+        self.journal = CacheJournal(filename + '.journal')
+
     def load_from_file(self, filename):
+        result = True
         try:
-            with open(filename, 'rb') as f:
-                data = pickle.load(f)
-                if not isinstance(data, dict):
-                    raise ValueError("Невалидный формат кэша")
-
-                self.records.clear()
-                for key, records in data.items():
-                    if isinstance(records, list):
-                        self.records[key].extend(records)
-
-            print(f"Кэш загружен из {filename}")
-            self.cleanup()
-            return True
+            self.snapshot = CacheSnapshot(filename)
+            print(f"Кэш подключен из {filename}: {len(self.snapshot)} записей, загрузка по мере запросов")
         except FileNotFoundError:
             print("Файл кэша не был найден, кэш пуст")
-            return True
         except Exception as e:
             print(f"Процесс загрузки прерван: {e}")
-            return False
+            result = False
+
+        try:
+            replayed = self.replay_journal(filename + '.journal')
+            if replayed:
+                print(f"Из журнала восстановлено {replayed} записей")
+            self.open_files(filename)
+        except Exception as e:
+            print(f"Процесс загрузки журнала прерван: {e}")
+            result = False
+
+        return result
+
+    def replay_journal(self, journal_filename):
+        # Отложенный журнал остается после сбоя во время записи снимка, он старше текущего
+        frames = []
+        for filename in (journal_filename + '.1', journal_filename):
+            try:
+                with open(filename, 'rb') as f:
+                    frames.extend(read_frames(f.read()))
+            except FileNotFoundError:
+                continue
+
+        live = [frame for frame in frames if self.apply_frame(frame)]
+
+        # Переписываем живые кадры в один журнал, оборванный хвост при этом отбрасывается
+        temp_filename = journal_filename + '.tmp'
+        with open(temp_filename, 'wb') as f:
+            for frame in live:
+                f.write(encode_frame(*frame))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_filename, journal_filename)
+        if os.path.exists(journal_filename + '.1'):
+            os.remove(journal_filename + '.1')
+        return len(live)
 
 
 def parse_dns_query(data):
@@ -75,7 +642,8 @@ def parse_dns_query(data):
         if len(data) < 12:
             raise ValueError("Пакет слишком короткий")
 
-        header = struct.unpack('!6H', data[:12])
+        packet = PacketView(data)
+        header = HEADER.unpack_from(packet.data)
         query_id = header[0]
         qdcount = header[2]
 
@@ -86,12 +654,12 @@ def parse_dns_query(data):
             if offset >= len(data):
                 raise ValueError("Вопрос секции усечен")
 
-            name, offset = decode_name(data, offset)
+            name, offset = packet.read_name(offset)
 
             if offset + 4 > len(data):
                 raise ValueError("Вопрос типа/класса усечен")
 
-            qtype, qclass = struct.unpack('!2H', data[offset:offset + 4])
+            qtype, qclass = QUESTION.unpack_from(packet.data, offset)
             questions.append({
                 'name': name,
                 'type': qtype,
@@ -99,10 +667,13 @@ def parse_dns_query(data):
             })
             offset += 4
 
+        # Клиент с EDNS0 сообщает, какой UDP ответ он готов принять
+        opt = find_opt(packet, offset) if header[5] else None
         return {
             'id': query_id,
             'questions': questions,
-            'header': header
+            'header': header,
+            'udp_size': max(CLASSIC_UDP_SIZE, opt[2]) if opt else CLASSIC_UDP_SIZE
         }
     except Exception as e:
         print(f"Попытка обработки запроса провалена: {e}")
@@ -119,20 +690,14 @@ def build_dns_response(query, answers):
         flags = 0x8180
         header = struct.pack('!6H', query['id'], flags, 1, len(answers), 0, 0)
 
-        encoded_question = encode_name(question['name'])
-        encoded_question += struct.pack('!2H', question['type'], question['class'])
-
+        compression = {}
         response = bytearray()
         response.extend(header)
-        response.extend(encoded_question)
+        response.extend(encode_name(question['name'], compression, len(response)))
+        response.extend(struct.pack('!2H', question['type'], question['class']))
 
         for answer in answers:
-            encoded_name = encode_name(answer['name'])
-            response.extend(encoded_name)
-
-            response.extend(struct.pack('!2HIH', answer['type'], 1, answer['ttl'], len(answer['data'])))
-
-            response.extend(answer['data'])
+            append_record(response, compression, answer['name'], answer['type'], answer['ttl'], answer['data'])
 
         return bytes(response)
     except Exception as e:
@@ -140,16 +705,279 @@ def build_dns_response(query, answers):
         return None
 
 
-def forward_query(query_data, upstream_dns, upstream_port):
-    try:
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
-            sock.settimeout(2.0)
-            sock.sendto(query_data, (upstream_dns, upstream_port))
-            response, _ = sock.recvfrom(512)
+def build_dns_query(query_id, name, qtype, qclass=1):
+    header = struct.pack('!6H', query_id, 0x0100, 1, 0, 0, 0)
+    return header + encode_name(name) + struct.pack('!2H', qtype, qclass)
+
+
+def find_opt(message, offset=None):
+    # Ищет OPT в секции additional: (начало записи, конец записи, размер UDP буфера) или None
+    packet = message if isinstance(message, PacketView) else PacketView(message)
+    _, _, qdcount, ancount, nscount, arcount = HEADER.unpack_from(packet.data)
+    if offset is None:
+        offset = 12
+        for _ in range(qdcount):
+            _, offset = packet.read_name(offset)
+            offset += 4
+
+    for index in range(ancount + nscount + arcount):
+        start = offset
+        _, offset = packet.read_name(offset)
+        rtype, rclass, _, rdlength = RECORD_HEADER.unpack_from(packet.data, offset)
+        offset += 10 + rdlength
+        if rtype == TYPE_OPT and index >= ancount + nscount:
+            return start, offset, rclass
+    return None
+
+
+def add_edns(data):
+    # Без OPT старший сервер ограничится 512 байтами и будет чаще отвечать с TC
+    if find_opt(data):
+        return data, False
+
+    header = bytearray(data[:12])
+    struct.pack_into('!H', header, 10, struct.unpack_from('!H', header, 10)[0] + 1)
+    return bytes(header) + data[12:] + OPT_RECORD, True
+
+
+def strip_edns(response):
+    # Клиенту без EDNS нельзя отдавать OPT, который мы сами добавили в запрос
+    opt = find_opt(response)
+    if not opt:
+        return response
+
+    start, end, _ = opt
+    header = bytearray(response[:12])
+    struct.pack_into('!H', header, 10, struct.unpack_from('!H', header, 10)[0] - 1)
+    return bytes(header) + response[12:start] + response[end:]
+
+
+def is_truncated(response):
+    return len(response) > 2 and bool(response[2] & 0x02)
+
+
+def fit_response(response, udp_size):
+    if not response or len(response) <= udp_size:
+        return response
+
+    # Ответ не помещается в буфер клиента: отдаем только вопрос с флагом TC
+    _, offset = decode_name(response, 12)
+    header = bytearray(response[:12])
+    header[2] |= 0x02
+    struct.pack_into('!4H', header, 4, 1, 0, 0, 0)
+    return bytes(header) + response[12:offset + 4]
+
+
+def recv_exact(sock, length):
+    data = bytearray()
+    while len(data) < length:
+        part = sock.recv(length - len(data))
+        if not part:
+            raise ConnectionError("Соединение закрыто")
+        data.extend(part)
+    return bytes(data)
+
+
+class UpstreamServer:
+    def __init__(self, address):
+        self.address = address
+        # Сглаженное время ответа и его разброс, как у TCP (RFC 6298)
+        self.srtt = None
+        self.rttvar = 0.0
+        self.failures = 0
+        self.down_until = 0.0
+        self.stats = Counter()
+
+    def hedge_delay(self):
+        if self.srtt is None:
+            return INITIAL_HEDGE_DELAY
+        return min(max(self.srtt + 4 * self.rttvar, MIN_HEDGE_DELAY), MAX_HEDGE_DELAY)
+
+    def record_rtt(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def record_success(self, rtt):
+        self.record_rtt(rtt)
+        self.failures = 0
+        self.stats['answers'] += 1
+
+    def record_slow(self, elapsed):
+        # Сервер проиграл гонку: его время ответа не меньше прошедшего
+        if self.srtt is None or elapsed > self.srtt:
+            self.record_rtt(elapsed)
+
+    def record_failure(self):
+        self.failures += 1
+        self.stats['failures'] += 1
+        if self.failures >= FAILURES_TO_TRIP:
+            if self.down_until <= time.monotonic():
+                print(f"Старший DNS {self.address[0]}:{self.address[1]} отключен на {TRIP_TIME} с")
+            self.down_until = time.monotonic() + TRIP_TIME
+
+
+class UpstreamPool:
+    def __init__(self, addresses, timeout=2.0, max_idle=4):
+        self.servers = [UpstreamServer(address) for address in addresses]
+        self.by_address = {server.address: server for server in self.servers}
+        self.timeout = timeout
+        # Простаивающие TCP соединения к каждому серверу для повторного использования
+        self.max_idle = max_idle
+        self.tcp_idle = {server.address: [] for server in self.servers}
+
+    def describe(self):
+        return ', '.join(f'{host}:{port}' for host, port in self.by_address)
+
+    def candidates(self):
+        # Сначала самые быстрые из доступных; если отключены все, пробуем раньше всех отключенные
+        current_time = time.monotonic()
+        alive = [server for server in self.servers if server.down_until <= current_time]
+        if not alive:
+            alive = sorted(self.servers, key=lambda server: server.down_until)
+        return sorted(alive, key=lambda server: server.srtt or 0.0)
+
+    def settle(self, result, sent, current_time):
+        if result is None:
+            for address in sent:
+                self.by_address[address].record_failure()
+            print("Запрос к вышестоящему DNS серверу превысил время ожидания")
+            return None, None
+
+        response, address = result
+        for other, sent_at in sent.items():
+            if other == address:
+                self.by_address[other].record_success(current_time - sent_at)
+            else:
+                self.by_address[other].record_slow(current_time - sent_at)
+        return response, self.by_address[address]
+
+    def query(self, data):
+        response, server = self.query_udp(data)
+        if response and is_truncated(response):
+            log("Ответ усечен, повторяю запрос по TCP")
+            response = self.query_tcp(data, server) or response
+        return response
+
+    def query_udp(self, data):
+        candidates = self.candidates()
+        sent = {}
+        sockets = {}
+        result = None
+        selector = selectors.DefaultSelector()
+        deadline = time.monotonic() + self.timeout
+        next_send = time.monotonic()
+
+        try:
+            while result is None:
+                current_time = time.monotonic()
+                if current_time >= deadline or not (candidates or sockets):
+                    break
+
+                if candidates and current_time >= next_send:
+                    server = candidates.pop(0)
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    sockets[sock] = server
+                    try:
+                        sock.connect(server.address)
+                        sock.send(data)
+                    except OSError:
+                        server.record_failure()
+                        sockets.pop(sock).close()
+                        continue
+                    server.stats['queries'] += 1
+                    sent[server.address] = current_time
+                    selector.register(sock, selectors.EVENT_READ)
+                    next_send = current_time + server.hedge_delay()
+
+                wait = (min(deadline, next_send) if candidates else deadline) - current_time
+                for key, _ in selector.select(max(wait, 0)):
+                    try:
+                        response = key.fileobj.recv(65535)
+                    except OSError:
+                        # Порт закрыт (ICMP unreachable): сервер отказал сразу, пробуем следующий
+                        server = sockets.pop(key.fileobj)
+                        sent.pop(server.address, None)
+                        server.record_failure()
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+                        next_send = time.monotonic()
+                        continue
+
+                    if response[:2] == data[:2]:
+                        result = (response, sockets[key.fileobj].address)
+                        break
+        finally:
+            selector.close()
+            for sock in sockets:
+                sock.close()
+
+        return self.settle(result, sent, time.monotonic())
+
+    def query_tcp(self, data, server):
+        idle = self.tcp_idle[server.address]
+        message = struct.pack('!H', len(data)) + data
+        # Соединение из пула могло быть закрыто сервером, тогда одна повторная попытка на новом
+        for _ in range(2):
+            fresh = not idle
+            sock = None
+            try:
+                sock = socket.create_connection(server.address, self.timeout) if fresh else idle.pop()
+                sock.settimeout(self.timeout)
+                sock.sendall(message)
+                length = struct.unpack('!H', recv_exact(sock, 2))[0]
+                response = recv_exact(sock, length)
+            except OSError as e:
+                if sock:
+                    sock.close()
+                if fresh:
+                    server.record_failure()
+                    print(f"TCP запрос к старшему DNS серверу провален: {e}")
+                    return None
+                # Сервер закрыл простаивающее соединение - остальные из пула, скорее всего, тоже закрыты:
+                # сбрасываем их, чтобы повтор шел по новому соединению
+                while idle:
+                    idle.pop().close()
+                continue
+
+            server.stats['tcp'] += 1
+            if len(idle) < self.max_idle:
+                idle.append(sock)
+            else:
+                sock.close()
             return response
-    except socket.timeout:
-        print("Запрос к вышестоящему DNS серверу превысил время ожидания")
         return None
+
+    def print_stats(self):
+        current_time = time.monotonic()
+        for server in self.servers:
+            srtt = f"{server.srtt * 1000:.1f} мс" if server.srtt is not None else "нет данных"
+            state = 'отключен' if server.down_until > current_time else 'доступен'
+            print(f"Старший DNS {server.address[0]}:{server.address[1]}: запросов {server.stats['queries']}, "
+                  f"ответов {server.stats['answers']}, отказов {server.stats['failures']}, "
+                  f"по TCP {server.stats['tcp']}, SRTT {srtt}, {state}")
+
+
+def parse_upstreams(values, default_port):
+    addresses = []
+    for value in values:
+        for item in value.split(','):
+            host, separator, port = item.strip().partition(':')
+            if host:
+                addresses.append((socket.gethostbyname(host), int(port) if separator else default_port))
+    return addresses
+
+
+def forward_query(query_data, pool):
+    try:
+        data, added_opt = add_edns(query_data)
+        response = pool.query(data)
+        if response and added_opt:
+            response = strip_edns(response)
+        return response
     except Exception as e:
         print(f"Запрос в старший DNS сервер провален: {e}")
         return None
@@ -160,186 +988,1145 @@ def parse_dns_response(response):
         return None
 
     try:
-        header = struct.unpack('!6H', response[:12])
-        ancount = header[3]
-        nscount = header[4]
-        arcount = header[5]
+        packet = PacketView(response)
+        header = HEADER.unpack_from(packet.data)
 
         offset = 12
         for _ in range(header[2]):
-            _, offset = decode_name(response, offset)
+            _, offset = packet.read_name(offset)
             offset += 4
 
         records = []
 
-        for _ in range(ancount + nscount + arcount):
-            if offset >= len(response):
-                break
+        for record in packet.records(offset, header[3] + header[4] + header[5]):
+            rdata = record.rdata(packet)
+            if record.rclass == 1:
+                records.append({
+                    'name': record.name,
+                    'type': record.type,
+                    'data': rdata,
+                    'ttl': record.ttl
+                })
 
-            name, offset = decode_name(response, offset)
+        return records
+    except Exception as e:
+        print(f"Не получилось обработать ответ: {e}")
+        return None
 
-            if offset + 10 > len(response):
-                break
 
-            rtype, rclass, ttl, rdlength = struct.unpack('!2HIH', response[offset:offset + 10])
-            offset += 10
+def parse_negative_response(response):
+    # Возвращает (имя, тип, отрицательный TTL, [(смещение TTL, TTL записи)]) или None
+    if not response or len(response) < 12:
+        return None
 
-            if offset + rdlength > len(response):
-                break
+    try:
+        _, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(response)
+        rcode = flags & 0x000f
+        if flags & 0x0200 or qdcount != 1:  # Усеченные ответы не кэшируем
+            return None
+        if rcode != RCODE_NXDOMAIN and not (rcode == 0 and ancount == 0):
+            return None
 
-            rdata = response[offset:offset + rdlength]
-            offset += rdlength
+        packet = PacketView(response)
+        name, offset = packet.read_name(12)
+        qtype, qclass = QUESTION.unpack_from(packet.data, offset)
+        offset += 4
+        if qclass != 1:
+            return None
 
-            if rclass == 1:
-                records.append({
-                    'name': name,
-                    'type': rtype,
-                    'data': rdata,
-                    'ttl': ttl
-                })
+        count = ancount + nscount + arcount
+        records = list(packet.records(offset, count))
+        if len(records) < count:  # Последняя запись выходит за пределы пакета
+            return None
 
-        return records
+        negative_ttl = None
+        ttl_offsets = []
+        for index, record in enumerate(records):
+            if record.type != TYPE_OPT:  # В OPT на месте TTL лежат флаги EDNS
+                ttl_offsets.append((record.offset - 6, record.ttl))
+
+            is_authority = ancount <= index < ancount + nscount
+            if is_authority and record.type == TYPE_SOA and record.rdlength >= 20:
+                minimum = TTL_FIELD.unpack_from(packet.data, record.offset + record.rdlength - 4)[0]
+                negative_ttl = min(record.ttl, minimum)
+
+        if negative_ttl is None:  # Без SOA отрицательный ответ не кэшируется
+            return None
+        return name, qtype, negative_ttl, ttl_offsets
     except Exception as e:
-        print(f"Не получилось обработать ответ: {e}")
+        print(f"Не получилось обработать отрицательный ответ: {e}")
         return None
 
 
 # Доподнительные функции
 def decode_name(data, offset):
-    name = []
-    processed_pointers = set()
+    return PacketView(data).read_name(offset)
+
+
+# Разбор пакета без копирования: поля читаются по смещениям, имена кэшируются по смещениям
+class RecordView:
+    __slots__ = ('name', 'type', 'rclass', 'ttl', 'offset', 'rdlength')
+
+    def __init__(self, name, rtype, rclass, ttl, offset, rdlength):
+        self.name = name
+        self.type = rtype
+        self.rclass = rclass
+        self.ttl = ttl
+        # Смещение rdata в пакете, сами данные не копируются до запроса
+        self.offset = offset
+        self.rdlength = rdlength
+
+    def rdata(self, packet):
+        if self.type in NAME_RDATA_TYPES:
+            # Имя в rdata может ссылаться на другие части пакета, храним его без сжатия
+            return encode_name(packet.read_name(self.offset)[0])
+        return packet.data[self.offset:self.offset + self.rdlength]
+
+
+class PacketView:
+    __slots__ = ('data', 'text', 'names')
+
+    def __init__(self, data):
+        # data - bytes, bytearray или memoryview над буфером приема: поля читаются struct.unpack_from
+        # по смещениям, сам пакет не копируется
+        self.data = data
+        # Весь пакет, раскодированный один раз: latin-1 переводит байт в символ один к одному,
+        # поэтому метки получаются срезами строки по тем же смещениям
+        self.text = str(data, 'latin-1')
+        # Смещение -> (имя, конец имени): каждый указатель сжатия разбирается один раз на пакет
+        self.names = {}
+
+    def label(self, offset, end):
+        label = self.text[offset:end]
+        if label.isascii():
+            return label
+        return str(self.data[offset:end], 'ascii', 'replace')
+
+    def read_name(self, offset):
+        cached = self.names.get(offset)
+        if cached is not None:
+            return cached
+
+        data = self.data
+        text = self.text
+        size = len(data)
+        start = offset
+        labels = []
+
+        # Метки до первого указателя лежат подряд
+        while True:
+            if offset >= size:
+                raise ValueError("Сдвиг выходит за пределы запроса")
+
+            length = data[offset]
+            if length >= 0xc0 or length == 0:
+                break
+
+            end = offset + 1 + length
+            if end > size:
+                raise ValueError("Метка превышает длину пакета")
+            label = text[offset + 1:end]
+            labels.append(label if label.isascii() else self.label(offset + 1, end))
+            offset = end
+
+        if length == 0:  # Конец имени
+            cached = self.names[start] = ('.'.join(labels), offset + 1)
+            return cached
+        return self.follow_pointers(start, labels, offset)
+
+    def follow_pointers(self, start, labels, offset):
+        names = self.names
+        data = self.data
+        size = len(data)
+
+        # Чаще всего указатель ведет на уже разобранное имя
+        if offset + 1 < size:
+            cached = names.get((data[offset] & 0x3f) << 8 | data[offset + 1])
+            if cached is not None:
+                labels.append(cached[0])
+                cached = names[start] = ('.'.join(labels), offset + 2)
+                return cached
+
+        # Непрерывные куски имени: (начало, сколько меток было до него, конец куска)
+        segments = []
+        first = 0
 
-    while True:
-        if offset >= len(data):
-            raise ValueError("Сдвиг выходит за пределы запроса")
+        while True:
+            if offset >= size:
+                raise ValueError("Сдвиг выходит за пределы запроса")
+
+            length = data[offset]
+
+            if length >= 0xc0:  # Компрессия
+                if offset + 1 >= size:
+                    raise ValueError("Неправильный указатель сжатия")
+
+                segments.append((start, first, offset + 2))
+                if len(segments) > MAX_POINTERS:
+                    raise ValueError("Засечен цикл сжатия")
+
+                offset = (length & 0x3f) << 8 | data[offset + 1]
+                cached = names.get(offset)
+                if cached is not None:
+                    labels.append(cached[0])
+                    break
+                start = offset
+                first = len(labels)
+
+            elif length > 0:  # Обычная метка
+                end = offset + 1 + length
+                if end > size:
+                    raise ValueError("Метка превышает длину пакета")
+                labels.append(self.label(offset + 1, end))
+                offset = end
+            else:  # Конец имени
+                # Указатель на пустое имя дает точку в конце, как и раньше при рекурсивном разборе
+                if first == len(labels):
+                    labels.append('')
+                segments.append((start, first, offset + 1))
+                break
 
-        length = data[offset]
+        for start, first, end in segments:
+            names[start] = ('.'.join(labels[first:]), end)
+        return names[segments[0][0]]
 
-        if (length & 0xc0) == 0xc0:  # Компрессия
-            if offset + 1 >= len(data):
-                raise ValueError("Неправильный указатель сжатия")
+    def records(self, offset, count):
+        # Отдает записи по очереди и останавливается на первой, выходящей за пределы пакета
+        data = self.data
+        size = len(data)
+        for _ in range(count):
+            if offset >= size:
+                return
 
-            pointer = struct.unpack('!H', data[offset:offset + 2])[0] & 0x3fff
-            if pointer in processed_pointers:
-                raise ValueError("Засечен цикл сжатия")
+            name, offset = self.read_name(offset)
 
-            processed_pointers.add(pointer)
-            part, _ = decode_name(data, pointer)
-            name.append(part)
-            return '.'.join(name), offset + 2
+            if offset + 10 > size:
+                return
 
-        elif length > 0:  # Обычная метка
-            if offset + 1 + length > len(data):
-                raise ValueError("Метка превышает длину пакета")
+            rtype, rclass, ttl, rdlength = RECORD_HEADER.unpack_from(data, offset)
+            offset += 10
 
-            name.append(data[offset + 1:offset + 1 + length].decode('ascii',
-                                                                    'replace'))
-            offset += 1 + length
-        else:  # Конец имени
-            return '.'.join(name), offset + 1
+            if offset + rdlength > size:
+                return
 
+            yield RecordView(name, rtype, rclass, ttl, offset, rdlength)
+            offset += rdlength
 
-def encode_name(name):
+
+def encode_name(name, compression=None, offset=0):
+    # compression: суффикс имени -> смещение в сообщении, offset: куда будет записано имя
     encoded = bytearray()
-    for part in name.split('.'):
+    labels = [part for part in name.split('.') if part]
+    for i, part in enumerate(labels):
+        if compression is not None:
+            suffix = '.'.join(labels[i:]).lower()
+            pointer = compression.get(suffix)
+            if pointer is not None:
+                encoded.extend(struct.pack('!H', 0xc000 | pointer))
+                return bytes(encoded)
+            if offset + len(encoded) < 0x4000:
+                compression[suffix] = offset + len(encoded)
+
         encoded.append(len(part))
         encoded.extend(part.encode('ascii', 'replace'))
     encoded.append(0)
     return bytes(encoded)
 
 
-def process_dns_query(data, cache, upstream_dns, upstream_port):
+def append_record(response, compression, name, rtype, ttl, data):
+    response.extend(encode_name(name, compression, len(response)))
+    ttl_offset = len(response) + 4
+    if rtype in NAME_RDATA_TYPES:
+        data = encode_name(decode_name(data, 0)[0], compression, len(response) + 10)
+    response.extend(struct.pack('!2HIH', rtype, 1, ttl, len(data)))
+    response.extend(data)
+    return ttl_offset
+
+
+def build_wire_response(name, rtype, records):
+    compression = {}
+    response = bytearray(struct.pack('!6H', 0, 0x8180, 1, len(records), 0, 0))
+    response.extend(encode_name(name, compression, len(response)))
+    response.extend(struct.pack('!2H', rtype, 1))
+
+    ttl_offsets = []
+    for record in records:
+        ttl_offset = append_record(response, compression, name, rtype, 0, record.data)
+        ttl_offsets.append((ttl_offset, record.expired))
+    return response, tuple(ttl_offsets)
+
+
+def answer_from_cache(query, cache):
+    question = query['questions'][0]
+    response = cache.get_response(query['id'], question['name'], question['type'], question['class'])
+    if response:
+        log(f"Использую кэшированный ответ для {question['name']}")
+    return response
+
+
+def cache_response(response, cache):
+    # Усеченный ответ содержит не все записи, такой не кэшируем
+    if is_truncated(response):
+        return
+
+    records = parse_dns_response(response)
+    if records:
+        for record in records:
+            if record['type'] in {1, 2, 12, 28}:
+                cache.add_record(record['name'], record['type'], record['data'], record['ttl'])
+
+    negative = parse_negative_response(response)
+    if negative:
+        name, qtype, ttl, ttl_offsets = negative
+        log(f"Кэширую отрицательный ответ для {name} на {ttl} с")
+        cache.add_negative(name, qtype, response, ttl_offsets, ttl)
+
+
+def refresh_entries(cache, pool):
+    while cache.refresh_queue:
+        name, rtype = cache.refresh_queue.pop()
+        log(f"Обновляю запись {name} типа {rtype}")
+        cache.stats['refreshes'] += 1
+        response = forward_query(build_dns_query(random.getrandbits(16), name, rtype), pool)
+        if response:
+            cache_response(response, cache)
+
+
+def process_dns_query(data, cache, pool):
     try:
         query = parse_dns_query(data)
         if not query or not query['questions']:
             return None
 
         question = query['questions'][0]
-        print(f"Обрабатываю запрос: {question['name']} типа {question['type']}")
-
-        cached_records = cache.get_records(question['name'], question['type'])
-        if cached_records:
-            print(f"Использую кэшированный ответ для {question['name']}")
-            answers = [{
-                'name': question['name'],
-                'type': question['type'],
-                'ttl': int(record['expired'] - time.time()),
-                'data': record['data']
-            } for record in cached_records]
-            return build_dns_response(query, answers)
-
-        print(f"Перенаправляю запрос в старший DNS сервер для {question['name']}")
-        response = forward_query(data, upstream_dns, upstream_port)
+        log(f"Обрабатываю запрос: {question['name']} типа {question['type']}")
+
+        response = answer_from_cache(query, cache)
+        if response:
+            return fit_response(response, query['udp_size'])
+
+        log(f"Перенаправляю запрос в старший DNS сервер для {question['name']}")
+        response = forward_query(data, pool)
         if not response:
             return None
 
-        records = parse_dns_response(response)
-        if records:
-            for record in records:
-                if record['type'] in {1, 2, 12, 28}:
-                    cache.add_record(record['name'], record['type'], record['data'], record['ttl'])
-        return response
+        cache_response(response, cache)
+        return fit_response(response, query['udp_size'])
     except Exception as e:
         print(f"Обработка кэша закончилась с ошибкой: {e}")
         return None
 
 
-def main():
-    parser = argparse.ArgumentParser(description='Кэширующий DNS сервер')
-    parser.add_argument('--upstream-dns', default='1.1.1.1',
-                        help='Старший DNS сервер')
-    parser.add_argument('--upstream-port', type=int, default=53,
-                        help='Порт вышестоящего DNS сервера')
-    parser.add_argument('--listen-addr', default='0.0.0.0',
-                        help="Aдрес для прослушки")
-    parser.add_argument('--cache-ttl', type=int, default=300,
-                        help='TTL кэша в секундах')
-    parser.add_argument('--backup-file', default='dns_cache.pkl',
-                        help="Файл для сохранения кэша")
-    args = parser.parse_args()
+# Асинхронный режим
+class UpstreamProtocol(asyncio.DatagramProtocol):
+    def __init__(self, pool):
+        self.pool = pool
+        self.transport = None
+        # ID запроса -> (future с ответом, {адрес сервера: время отправки})
+        self.pending = {}
+        self.tcp_idle = {server.address: [] for server in pool.servers}
 
-    cache = DNSCache()
+    def connection_made(self, transport):
+        self.transport = transport
 
-    if not cache.load_from_file(args.backup_file):
-        print("Произошла ошибка при загрузке кэша, кэш пуст")
+    def datagram_received(self, data, addr):
+        if len(data) < 12:
+            return
+
+        upstream_id = ID_FIELD.unpack_from(data)[0]
+        pending = self.pending.get(upstream_id)
+        # Принимаем ответ только от сервера, которому отправляли этот запрос
+        if pending and addr in pending[1] and not pending[0].done():
+            pending[0].set_result((data, addr))
+
+    def error_received(self, exc):
+        print(f"Ошибка сокета старшего DNS сервера: {exc}")
+
+    def next_id(self):
+        if len(self.pending) >= 0x10000:
+            raise RuntimeError("Закончились свободные идентификаторы запросов")
+
+        while True:
+            upstream_id = random.getrandbits(16)
+            if upstream_id not in self.pending:
+                return upstream_id
+
+    async def query(self, data):
+        try:
+            upstream_data, added_opt = add_edns(data)
+            response, server = await self.query_udp(upstream_data)
+            if response and is_truncated(response):
+                log("Ответ усечен, повторяю запрос по TCP")
+                response = await self.query_tcp(upstream_data, server) or response
+        except Exception as e:
+            print(f"Запрос в старший DNS сервер провален: {e}")
+            return None
+
+        if not response:
+            return None
+        if added_opt:
+            response = strip_edns(response)
+        return data[:2] + response[2:]
+
+    async def query_udp(self, data):
+        # Подменяем ID клиента на свободный ID общего сокета, чтобы ответы не путались
+        loop = asyncio.get_running_loop()
+        upstream_id = self.next_id()
+        future = loop.create_future()
+        sent = {}
+        self.pending[upstream_id] = (future, sent)
+        message = ID_FIELD.pack(upstream_id) + data[2:]
+
+        # Запрос уходит самому быстрому серверу; если он не ответил за свое обычное время, подключаем следующий
+        candidates = self.pool.candidates()
+        deadline = loop.time() + self.pool.timeout
+        result = None
+        try:
+            while result is None:
+                current_time = loop.time()
+                if current_time >= deadline:
+                    break
+
+                wait = deadline - current_time
+                if candidates:
+                    server = candidates.pop(0)
+                    server.stats['queries'] += 1
+                    sent[server.address] = current_time
+                    self.transport.sendto(message, server.address)
+                    if candidates:
+                        wait = min(wait, server.hedge_delay())
+
+                try:
+                    result = await asyncio.wait_for(asyncio.shield(future), wait)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self.pending.pop(upstream_id, None)
+            future.cancel()
+
+        return self.pool.settle(result, sent, loop.time())
+
+    async def query_tcp(self, data, server):
+        idle = self.tcp_idle[server.address]
+        message = struct.pack('!H', len(data)) + data
+        timeout = self.pool.timeout
+        for _ in range(2):
+            fresh = not idle
+            writer = None
+            try:
+                if fresh:
+                    reader, writer = await asyncio.wait_for(asyncio.open_connection(*server.address), timeout)
+                else:
+                    reader, writer = idle.pop()
+                writer.write(message)
+                length = struct.unpack('!H', await asyncio.wait_for(reader.readexactly(2), timeout))[0]
+                response = await asyncio.wait_for(reader.readexactly(length), timeout)
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                if writer:
+                    writer.close()
+                if fresh:
+                    server.record_failure()
+                    print(f"TCP запрос к старшему DNS серверу провален: {e}")
+                    return None
+                # Как и в UpstreamPool.query_tcp: остальные простаивающие соединения сбрасываем,
+                # чтобы повтор шел по новому
+                while idle:
+                    idle.pop()[1].close()
+                continue
+
+            server.stats['tcp'] += 1
+            if len(idle) < self.pool.max_idle:
+                idle.append((reader, writer))
+            else:
+                writer.close()
+            return response
+        return None
+
+
+class AsyncDNSServer(asyncio.DatagramProtocol):
+    def __init__(self, cache, upstream, on_fill=None):
+        self.cache = cache
+        self.upstream = upstream
+        # Вызывается с ответом старшего сервера после его записи в кэш
+        self.on_fill = on_fill
+        self.transport = None
+        self.tasks = set()
+        # Незавершенные запросы к старшему серверу: (имя, тип, класс) -> future с ответом
+        self.inflight = {}
+        self.stats = Counter()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            log(f"Получил запрос от {addr}")
+            query = parse_dns_query(data)
+            if not query or not query['questions']:
+                return
+
+            question = query['questions'][0]
+            log(f"Обрабатываю запрос: {question['name']} типа {question['type']}")
+
+            # Попадания в кэш отдаем сразу, не дожидаясь незавершенных промахов
+            response = answer_from_cache(query, self.cache)
+            if response:
+                self.transport.sendto(fit_response(response, query['udp_size']), addr)
+                if self.cache.refresh_queue:
+                    self.refresh_entries()
+                return
+
+            key = (question['name'], question['type'], question['class'])
+            inflight = self.inflight.get(key)
+            if inflight is not None:
+                log(f"Жду уже отправленный запрос для {question['name']}")
+                self.stats['coalesced'] += 1
+                inflight.add_done_callback(
+                    lambda future: self.reply(future.result(), data, addr, query['udp_size']))
+                return
+
+            self.stats['upstream'] += 1
+            self.inflight[key] = asyncio.get_running_loop().create_future()
+            task = asyncio.ensure_future(self.resolve(data, key, addr, query['udp_size']))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        except Exception as e:
+            print(f"Непредвиденная ошибка: {e}")
+
+    def refresh_entries(self):
+        loop = asyncio.get_running_loop()
+        while self.cache.refresh_queue:
+            name, rtype = self.cache.refresh_queue.pop()
+            key = (name, rtype, 1)
+            if key in self.inflight:
+                continue
+
+            log(f"Обновляю запись {name} типа {rtype}")
+            self.cache.stats['refreshes'] += 1
+            self.inflight[key] = loop.create_future()
+            task = asyncio.ensure_future(self.resolve(
+                build_dns_query(random.getrandbits(16), name, rtype), key, None, None))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def reply(self, response, data, addr, udp_size):
+        if response:
+            self.transport.sendto(fit_response(data[:2] + response[2:], udp_size), addr)
+
+    async def resolve(self, data, key, addr, udp_size):
+        response = None
+        try:
+            log(f"Перенаправляю запрос в старший DNS сервер для {key[0]}")
+            response = await self.upstream.query(data)
+            if not response:
+                return
+
+            try:
+                cache_response(response, self.cache)
+                if self.on_fill:
+                    self.on_fill(response)
+            except Exception as e:
+                print(f"Обработка кэша закончилась с ошибкой: {e}")
+            if addr is not None:
+                self.transport.sendto(fit_response(response, udp_size), addr)
+        finally:
+            self.inflight.pop(key).set_result(response)
 
+    def print_stats(self):
+        print(f"Запросов к старшему DNS: {self.stats['upstream']}, "
+              f"объединено одинаковых промахов: {self.stats['coalesced']}")
+
+
+# Связь рабочего процесса с владельцем кэша: принимает ответы, полученные другими процессами
+class CacheLinkProtocol(asyncio.DatagramProtocol):
+    def __init__(self, cache):
+        self.cache = cache
+
+    def datagram_received(self, data, addr):
+        try:
+            cache_response(data, self.cache)
+        except Exception as e:
+            print(f"Обработка кэша закончилась с ошибкой: {e}")
+
+
+async def serve_async(args, cache, pool, listen_sock=None, link_sock=None):
+    loop = asyncio.get_running_loop()
+
+    upstream_transport, upstream = await loop.create_datagram_endpoint(
+        lambda: UpstreamProtocol(pool),
+        local_addr=('0.0.0.0', 0)
+    )
+
+    link_transport = send_fill = None
+    if link_sock is not None:
+        link_transport, _ = await loop.create_datagram_endpoint(
+            lambda: CacheLinkProtocol(cache), sock=link_sock)
+
+        # Транспорт без адреса получателя не умеет sendto, пишем в соединенный сокет напрямую
+        def send_fill(response):
+            try:
+                link_sock.send(response)
+            except OSError:
+                pass  # Очередь владельца переполнена, запись останется только в этом процессе
+
+    if listen_sock is None:
+        endpoint = {'local_addr': (args.listen_addr, args.listen_port)}
+    else:
+        endpoint = {'sock': listen_sock}
+    server_transport, server = await loop.create_datagram_endpoint(
+        lambda: AsyncDNSServer(cache, upstream, send_fill),
+        **endpoint
+    )
+
+    if link_sock is None:
+        print(f"DNS сервер (asyncio) запущен на {args.listen_addr}:{args.listen_port}")
+        print(f"Использую старший DNS: {pool.describe()}")
+
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    try:
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), 1)
+            except asyncio.TimeoutError:
+                cache.maintain()
+    finally:
+        print("Выключаю сервер...")
+        server.print_stats()
+        cache.print_stats()
+        pool.print_stats()
+        server_transport.close()
+        upstream_transport.close()
+        if link_transport:
+            link_transport.close()
+
+
+def run_async(args, cache, pool):
+    try:
+        asyncio.run(serve_async(args, cache, pool))
+    except Exception as e:
+        print(f"Критическая ошибка: {e}")
+    finally:
+        cache.save_to_file(args.backup_file)
+        print("Сервер выключен")
+
+
+def run_worker(args, cache, pool, link_sock):
+    # Журнал и снимок пишет только владелец кэша
+    cache.journal = None
+    cache.filename = None
+    code = 0
+    try:
+        listen_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        listen_sock.bind((args.listen_addr, args.listen_port))
+        asyncio.run(serve_async(args, cache, pool, listen_sock, link_sock))
+    except Exception as e:
+        print(f"Критическая ошибка в процессе {os.getpid()}: {e}")
+        code = 1
+    finally:
+        sys.stdout.flush()
+        os._exit(code)
+
+
+def run_workers(args, cache, pool):
+    if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(os, 'fork'):
+        print("SO_REUSEPORT или fork не поддерживаются, запускаю один процесс")
+        run_async(args, cache, pool)
+        return
+
+    # Буфер журнала сбрасываем до fork, иначе его допишут и дочерние процессы
+    if cache.journal:
+        cache.journal.flush()
+
+    links = {}
+    for _ in range(args.workers):
+        owner_end, worker_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        pid = os.fork()
+        if pid == 0:
+            for end in links.values():
+                end.close()
+            owner_end.close()
+            run_worker(args, cache, pool, worker_end)
+        worker_end.close()
+        links[pid] = owner_end
+
+    print(f"DNS сервер запущен на {args.listen_addr}:{args.listen_port}, рабочих процессов: {args.workers}")
+    print(f"Использую старший DNS: {pool.describe()}")
+
+    def shutdown(signum, frame):
+        sys.exit(0)
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    # Этот процесс владеет кэшем: сохраняет ответы, пришедшие от рабочих, и рассылает их остальным
+    selector = selectors.DefaultSelector()
+    for end in links.values():
+        end.setblocking(False)
+        selector.register(end, selectors.EVENT_READ)
+
+    fills = 0
+    last_maintenance = time.time()
+    try:
+        while True:
+            for key, _ in selector.select(1.0):
+                try:
+                    response = key.fileobj.recv(65535)
+                except BlockingIOError:
+                    continue
+
+                fills += 1
+                cache_response(response, cache)
+                for end in links.values():
+                    if end is not key.fileobj:
+                        try:
+                            end.send(response)
+                        except OSError:
+                            pass  # Очередь процесса переполнена, он получит запись сам при промахе
+
+            if time.time() - last_maintenance >= 1:
+                cache.maintain()
+                last_maintenance = time.time()
+    except Exception as e:
+        print(f"Критическая ошибка: {e}")
+    finally:
+        print("Выключаю сервер...")
+        for pid in links:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in links:
+            os.waitpid(pid, 0)
+
+        print(f"Ответов, разосланных между процессами: {fills}, записей в кэше: {len(cache)}")
+        cache.save_to_file(args.backup_file)
+        print("Сервер выключен")
+
+
+# Пакетный режим: за одно пробуждение вычитываем все готовые датаграммы, обрабатываем их вместе и разом отправляем ответы
+class PendingQuery:
+    __slots__ = ('key', 'message', 'added_opt', 'waiters', 'candidates', 'sent', 'next_send', 'deadline', 'tcp')
+
+    def __init__(self, key, message, added_opt, candidates, deadline):
+        self.key = key
+        self.message = message
+        self.added_opt = added_opt
+        # Клиенты, ждущие этот ответ: (ID их запроса, адрес, размер UDP); пусто для обновления заранее
+        self.waiters = []
+        self.candidates = candidates
+        self.sent = {}
+        self.next_send = 0.0
+        self.deadline = deadline
+        # TCPRetry, пока ответ повторно запрашивается по TCP
+        self.tcp = None
+
+
+class TCPRetry:
+    # Повтор усеченного ответа по TCP на неблокирующем сокете из общего селектора: запрос отправляется,
+    # когда сокет готов к записи, ответ собирается по мере прихода. Не получится - клиентам уйдет усеченный
+    __slots__ = ('server', 'sock', 'fresh', 'out', 'buffer', 'truncated')
+
+    def __init__(self, server, sock, fresh, message, truncated):
+        self.server = server
+        self.sock = sock
+        self.fresh = fresh
+        self.out = struct.pack('!H', len(message)) + message
+        self.buffer = bytearray()
+        self.truncated = truncated
+
+
+class BatchDNSServer:
+    def __init__(self, cache, pool, sock, batch_size):
+        self.cache = cache
+        self.pool = pool
+        self.sock = sock
+        self.batch_size = batch_size
+        self.sock.setblocking(False)
+
+        # Общий сокет для всех запросов к старшим серверам, ответы различаем по подмененному ID
+        self.upstream_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.upstream_sock.bind(('0.0.0.0', 0))
+        self.upstream_sock.setblocking(False)
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.selector.register(self.upstream_sock, selectors.EVENT_READ)
+        self.writing = False
+
+        # ID запроса к старшему серверу -> PendingQuery
+        self.pending = {}
+        # (имя, тип, класс) -> ID незавершенного запроса к старшему серверу
+        self.inflight = {}
+        # Куча (время, ID): следующая повторная отправка или истечение ожидания
+        self.timers = []
+        self.outgoing = []
+        self.stats = Counter()
+        # Простаивающие TCP соединения к каждому серверу для повторов усеченных ответов
+        self.tcp_idle = {server.address: [] for server in pool.servers}
+
+    def next_id(self):
+        if len(self.pending) >= 0x10000:
+            raise RuntimeError("Закончились свободные идентификаторы запросов")
+
+        while True:
+            upstream_id = random.getrandbits(16)
+            if upstream_id not in self.pending:
+                return upstream_id
+
+    def receive(self):
+        batch = []
+        for _ in range(self.batch_size):
+            try:
+                batch.append(self.sock.recvfrom(4096))
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                # ICMP unreachable от прошлого ответа, клиент уже ушел
+                log(f"Ошибка сокета сервера: {e}")
+                continue
+
+        if batch:
+            self.stats['batches'] += 1
+            self.stats['received'] += len(batch)
+        for data, addr in batch:
+            try:
+                self.handle(data, addr)
+            except Exception as e:
+                print(f"Непредвиденная ошибка: {e}")
+
+    def handle(self, data, addr):
+        log(f"Получил запрос от {addr}")
+        query = parse_dns_query(data)
+        if not query or not query['questions']:
+            return
+
+        question = query['questions'][0]
+        log(f"Обрабатываю запрос: {question['name']} типа {question['type']}")
+
+        response = answer_from_cache(query, self.cache)
+        if response:
+            self.outgoing.append((fit_response(response, query['udp_size']), addr))
+            return
+
+        key = (question['name'], question['type'], question['class'])
+        upstream_id = self.inflight.get(key)
+        if upstream_id is not None:
+            log(f"Жду уже отправленный запрос для {question['name']}")
+            self.stats['coalesced'] += 1
+        else:
+            self.stats['upstream'] += 1
+            upstream_id = self.start_query(key, data)
+        self.pending[upstream_id].waiters.append((data[:2], addr, query['udp_size']))
+
+    def start_query(self, key, data):
+        log(f"Перенаправляю запрос в старший DNS сервер для {key[0]}")
+        data, added_opt = add_edns(data)
+        upstream_id = self.next_id()
+        current_time = time.monotonic()
+        pending = PendingQuery(key, ID_FIELD.pack(upstream_id) + data[2:], added_opt,
+                               self.pool.candidates(), current_time + self.pool.timeout)
+        self.pending[upstream_id] = pending
+        self.inflight[key] = upstream_id
+        self.send_next(upstream_id, pending, current_time)
+        return upstream_id
+
+    def send_next(self, upstream_id, pending, current_time):
+        # Запрос уходит самому быстрому серверу; если он не ответил за свое обычное время, подключаем следующий
+        while pending.candidates:
+            server = pending.candidates.pop(0)
+            try:
+                self.upstream_sock.sendto(pending.message, server.address)
+            except OSError:
+                server.record_failure()
+                continue
+            server.stats['queries'] += 1
+            pending.sent[server.address] = current_time
+            if pending.candidates:
+                pending.next_send = current_time + server.hedge_delay()
+                heapq.heappush(self.timers, (pending.next_send, upstream_id))
+                return
+            break
+        pending.next_send = pending.deadline
+        heapq.heappush(self.timers, (pending.deadline, upstream_id))
+
+    def run_timers(self):
+        current_time = time.monotonic()
+        while self.timers and self.timers[0][0] <= current_time:
+            when, upstream_id = heapq.heappop(self.timers)
+            pending = self.pending.get(upstream_id)
+            # Запись устарела: запрос уже завершен или время отправки сдвинулось
+            if pending is None or when != pending.next_send:
+                continue
+            if pending.tcp:
+                self.tcp_failed(upstream_id, pending, TimeoutError("истекло время ожидания ответа"))
+            elif current_time >= pending.deadline:
+                self.pool.settle(None, pending.sent, current_time)
+                self.finish(upstream_id, None)
+            else:
+                self.send_next(upstream_id, pending, current_time)
+
+    def next_timeout(self):
+        if self.outgoing:
+            return 0
+        if not self.timers:
+            return 1.0
+        return min(max(self.timers[0][0] - time.monotonic(), 0), 1.0)
+
+    def receive_upstream(self):
+        for _ in range(self.batch_size):
+            try:
+                data, addr = self.upstream_sock.recvfrom(65535)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                # Порт одного из серверов закрыт; по неподключенному сокету не узнать, какого именно
+                log(f"Ошибка сокета старшего DNS сервера: {e}")
+                continue
+
+            if len(data) < 12:
+                continue
+            upstream_id = ID_FIELD.unpack_from(data)[0]
+            pending = self.pending.get(upstream_id)
+            # Принимаем ответ только от сервера, которому отправляли этот запрос, и только первый
+            if pending is None or pending.tcp or addr not in pending.sent:
+                continue
+
+            response, server = self.pool.settle((data, addr), pending.sent, time.monotonic())
+            if is_truncated(response):
+                # Запрос остается в pending до конца повтора: новые клиенты с тем же вопросом ждут его же
+                log("Ответ усечен, повторяю запрос по TCP")
+                self.start_tcp(upstream_id, pending, server, response)
+            else:
+                self.complete(upstream_id, pending, response)
+
+    def start_tcp(self, upstream_id, pending, server, truncated, reuse=True):
+        idle = self.tcp_idle[server.address]
+        fresh = not (reuse and idle)
+        if fresh:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+        else:
+            sock = idle.pop()
+        pending.tcp = TCPRetry(server, sock, fresh, pending.message, truncated)
+        self.selector.register(sock, selectors.EVENT_WRITE, upstream_id)
+        pending.next_send = time.monotonic() + self.pool.timeout
+        heapq.heappush(self.timers, (pending.next_send, upstream_id))
+        if fresh:
+            code = sock.connect_ex(server.address)
+            if code not in (0, errno.EINPROGRESS):
+                self.tcp_failed(upstream_id, pending, OSError(code, os.strerror(code)))
+
+    def advance_tcp(self, upstream_id, sock):
+        pending = self.pending.get(upstream_id)
+        if pending is None or pending.tcp is None or pending.tcp.sock is not sock:
+            return
+        retry = pending.tcp
+        try:
+            if retry.out:
+                # Первая готовность к записи нового сокета - конец connect, его итог в SO_ERROR
+                code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if code:
+                    raise OSError(code, os.strerror(code))
+                retry.out = retry.out[sock.send(retry.out):]
+                if not retry.out:
+                    self.selector.modify(sock, selectors.EVENT_READ, upstream_id)
+                return
+
+            # Читаем не дальше конца ответа, чтобы соединение можно было использовать снова
+            buffer = retry.buffer
+            size = 2 + struct.unpack_from('!H', buffer)[0] if len(buffer) >= 2 else 2
+            data = sock.recv(size - len(buffer))
+            if not data:
+                raise ConnectionError("Сервер закрыл соединение")
+            buffer += data
+            if len(buffer) < 2 or len(buffer) < 2 + struct.unpack_from('!H', buffer)[0]:
+                return
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.tcp_failed(upstream_id, pending, e)
+            return
+
+        self.selector.unregister(sock)
+        retry.server.stats['tcp'] += 1
+        idle = self.tcp_idle[retry.server.address]
+        if len(idle) < self.pool.max_idle:
+            idle.append(sock)
+        else:
+            sock.close()
+        self.complete(upstream_id, pending, bytes(buffer[2:]))
+
+    def tcp_failed(self, upstream_id, pending, error):
+        retry = pending.tcp
+        pending.tcp = None
+        self.selector.unregister(retry.sock)
+        retry.sock.close()
+        if not retry.fresh:
+            # Соединение из пула могло быть закрыто сервером, одна повторная попытка на новом
+            self.start_tcp(upstream_id, pending, retry.server, retry.truncated, reuse=False)
+            return
+        retry.server.record_failure()
+        print(f"TCP запрос к старшему DNS серверу провален: {error}")
+        self.complete(upstream_id, pending, retry.truncated)
+
+    def complete(self, upstream_id, pending, response):
+        if pending.added_opt:
+            response = strip_edns(response)
+        self.finish(upstream_id, response)
+
+    def finish(self, upstream_id, response):
+        pending = self.pending.pop(upstream_id)
+        del self.inflight[pending.key]
+        if not response:
+            return
+
+        try:
+            cache_response(response, self.cache)
+        except Exception as e:
+            print(f"Обработка кэша закончилась с ошибкой: {e}")
+        for query_id, addr, udp_size in pending.waiters:
+            self.outgoing.append((fit_response(query_id + response[2:], udp_size), addr))
+
+    def refresh_entries(self):
+        while self.cache.refresh_queue:
+            name, rtype = self.cache.refresh_queue.pop()
+            key = (name, rtype, 1)
+            if key in self.inflight:
+                continue
+
+            log(f"Обновляю запись {name} типа {rtype}")
+            self.cache.stats['refreshes'] += 1
+            self.start_query(key, build_dns_query(0, name, rtype))
+
+    def flush(self):
+        sent = 0
+        for response, addr in self.outgoing:
+            try:
+                self.sock.sendto(response, addr)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                log(f"Не удалось отправить ответ {addr}: {e}")
+            sent += 1
+        del self.outgoing[:sent]
+
+        # Буфер отправки переполнен: остаток допишем, когда сокет станет доступен для записи
+        writing = bool(self.outgoing)
+        if writing != self.writing:
+            events = selectors.EVENT_READ | selectors.EVENT_WRITE if writing else selectors.EVENT_READ
+            self.selector.modify(self.sock, events)
+            self.writing = writing
+
+    def serve_forever(self):
+        last_maintenance = time.time()
+        while True:
+            for key, events in self.selector.select(self.next_timeout()):
+                if key.fileobj is self.upstream_sock:
+                    self.receive_upstream()
+                elif key.data is not None:
+                    self.advance_tcp(key.data, key.fileobj)
+                elif events & selectors.EVENT_READ:
+                    self.receive()
+
+            self.run_timers()
+            # Клиенты уже получат ответы этой пачки, теперь можно обновить популярные записи
+            if self.cache.refresh_queue:
+                self.refresh_entries()
+            self.flush()
+
+            if time.time() - last_maintenance >= 1:
+                self.cache.maintain()
+                last_maintenance = time.time()
+
+    def close(self):
+        for pending in self.pending.values():
+            if pending.tcp:
+                pending.tcp.sock.close()
+        for idle in self.tcp_idle.values():
+            for sock in idle:
+                sock.close()
+        self.selector.close()
+        self.upstream_sock.close()
+        self.sock.close()
+
+    def print_stats(self):
+        average = self.stats['received'] / self.stats['batches'] if self.stats['batches'] else 0
+        print(f"Запросов к старшему DNS: {self.stats['upstream']}, "
+              f"объединено одинаковых промахов: {self.stats['coalesced']}")
+        print(f"Пачек: {self.stats['batches']}, в среднем запросов за пробуждение: {average:.1f}")
+
+
+def run_batch(args, cache, pool):
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind((args.listen_addr, 53))
-    sock.settimeout(1.0)
+    sock.bind((args.listen_addr, args.listen_port))
+    server = BatchDNSServer(cache, pool, sock, args.batch_size)
 
-    print(f"DNS сервер запущен на {args.listen_addr}:53")
-    print(f"Использую старший DNS: {args.upstream_dns}:{args.upstream_port}")
+    print(f"DNS сервер (пакетный) запущен на {args.listen_addr}:{args.listen_port}")
+    print(f"Использую старший DNS: {pool.describe()}")
 
+    # Кэш сохраняется в finally, куда попадаем и по SystemExit
     def shutdown(signum, frame):
         print("Выключаю сервер...")
+        server.print_stats()
+        cache.print_stats()
+        pool.print_stats()
+        sys.exit(0)
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    try:
+        server.serve_forever()
+    except Exception as e:
+        print(f"Критическая ошибка: {e}")
+    finally:
         cache.save_to_file(args.backup_file)
-        sock.close()
+        server.close()
+        print("Сервер выключен")
+
+
+def run_loop(args, cache, pool):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((args.listen_addr, args.listen_port))
+    sock.settimeout(1.0)
+
+    print(f"DNS сервер запущен на {args.listen_addr}:{args.listen_port}")
+    print(f"Использую старший DNS: {pool.describe()}")
+
+    # Кэш сохраняется в finally, куда попадаем и по SystemExit
+    def shutdown(signum, frame):
+        print("Выключаю сервер...")
+        cache.print_stats()
+        pool.print_stats()
         sys.exit(0)
 
     signal.signal(signal.SIGINT, shutdown)
     signal.signal(signal.SIGTERM, shutdown)
 
-    last_cleanup = time.time()
+    last_maintenance = time.time()
 
     try:
         while True:
+            if time.time() - last_maintenance >= 1:
+                cache.maintain()
+                last_maintenance = time.time()
+
             try:
-                data, addr = sock.recvfrom(512)
-                print(f"Получил запрос от {addr}")
+                data, addr = sock.recvfrom(4096)
+                log(f"Получил запрос от {addr}")
 
-                response = process_dns_query(
-                    data,
-                    cache,
-                    args.upstream_dns,
-                    args.upstream_port
-                )
+                response = process_dns_query(data, cache, pool)
 
                 if response:
                     sock.sendto(response, addr)
 
-                if time.time() - last_cleanup > 60:
-                    cache.cleanup()
-                    last_cleanup = time.time()
+                # Клиент уже получил ответ, теперь можно обновить популярные записи
+                if cache.refresh_queue:
+                    refresh_entries(cache, pool)
 
             except socket.timeout:
                 continue
@@ -355,5 +2142,70 @@ def main():
         print("Сервер выключен")
 
 
+def main():
+    global VERBOSE
+
+    parser = argparse.ArgumentParser(description='Кэширующий DNS сервер')
+    parser.add_argument('--upstream-dns', nargs='+', default=['1.1.1.1'],
+                        help='Старшие DNS серверы: адрес или адрес:порт, через пробел или запятую')
+    parser.add_argument('--upstream-port', type=int, default=53,
+                        help='Порт вышестоящих DNS серверов, если он не указан в адресе')
+    parser.add_argument('--upstream-timeout', type=float, default=2.0,
+                        help='Общее время ожидания ответа старших серверов в секундах')
+    parser.add_argument('--listen-addr', default='0.0.0.0',
+                        help="Aдрес для прослушки")
+    parser.add_argument('--listen-port', type=int, default=53,
+                        help='Порт для прослушки')
+    parser.add_argument('--cache-ttl', type=int, default=300,
+                        help='TTL кэша в секундах')
+    parser.add_argument('--cache-size', type=int, default=100_000,
+                        help='Максимальное число ключей (имя, тип) в кэше')
+    parser.add_argument('--cache-memory', type=int, default=64,
+                        help='Ограничение памяти кэша в мегабайтах')
+    parser.add_argument('--prefetch-threshold', type=float, default=0.9,
+                        help='Доля TTL, после которой популярная запись обновляется заранее (0 - выключить)')
+    parser.add_argument('--prefetch-min-hits', type=int, default=3,
+                        help='Сколько попаданий нужно записи, чтобы обновлять ее заранее')
+    parser.add_argument('--serve-stale', type=int, default=0,
+                        help='Сколько секунд после истечения TTL отдавать запись, пока она обновляется '
+                             '(RFC 8767, 0 - выключить)')
+    parser.add_argument('--backup-file', default='dns_cache.bin',
+                        help="Файл для сохранения кэша")
+    parser.add_argument('--checkpoint-interval', type=int, default=300,
+                        help='Период фоновой записи снимка кэша в секундах (0 - только при выключении)')
+    parser.add_argument('--mode', choices=['async', 'batch', 'loop'], default='async',
+                        help='Режим работы: asyncio, пакетная обработка или последовательный цикл')
+    parser.add_argument('--batch-size', type=int, default=64,
+                        help='Сколько датаграмм вычитывать за одно пробуждение (режим batch)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Число рабочих процессов на одном порту (SO_REUSEPORT, режим async)')
+    parser.add_argument('--quiet', action='store_true',
+                        help='Не печатать сообщения о каждом запросе')
+    args = parser.parse_args()
+    # Рабочие процессы обмениваются ответами через канал к владельцу кэша, он есть только в режиме async
+    if args.workers > 1 and args.mode != 'async':
+        parser.error(f"--workers больше 1 поддерживается только в режиме async, а не {args.mode}")
+
+    VERBOSE = not args.quiet
+
+    cache = DNSCache(args.cache_size, args.cache_memory * 1024 * 1024,
+                     args.prefetch_threshold, args.prefetch_min_hits, args.serve_stale,
+                     args.checkpoint_interval)
+
+    if not cache.load_from_file(args.backup_file):
+        print("Произошла ошибка при загрузке кэша, кэш пуст")
+
+    pool = UpstreamPool(parse_upstreams(args.upstream_dns, args.upstream_port), args.upstream_timeout)
+
+    if args.workers > 1:
+        run_workers(args, cache, pool)
+    elif args.mode == 'async':
+        run_async(args, cache, pool)
+    elif args.mode == 'batch':
+        run_batch(args, cache, pool)
+    else:
+        run_loop(args, cache, pool)
+
+
 if __name__ == '__main__':
     main()
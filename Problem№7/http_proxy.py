@@ -1,107 +1,2914 @@
+import argparse
+import asyncio
+import email.utils
+import fcntl
+import hashlib
+import ipaddress
+import mmap
+import os
+import re
+import resource
+import select
 import socket
-from urllib.parse import urlparse
-from http.client import HTTPResponse
-from io import BytesIO
+import tempfile
+import threading
+import time
+import zlib
+from bisect import bisect_left
+from functools import partial
+from collections import Counter, OrderedDict, defaultdict
+from html import unescape
+from urllib.parse import urljoin, urlparse
 from socketserver import ThreadingMixIn, TCPServer, BaseRequestHandler
-from bs4 import BeautifulSoup
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+CHUNK_SIZE = 64 * 1024
+MAX_HEAD_SIZE = 64 * 1024
+UPSTREAM_TIMEOUT = 5
+CLIENT_IDLE_TIMEOUT = 30
+
+# Пул соединений со старшими серверами
+POOL_MAX_IDLE_PER_HOST = 8
+POOL_MAX_PER_HOST = 32
+POOL_IDLE_TIMEOUT = 30
+
+# Заголовки одного соединения, их нельзя пересылать дальше (RFC 9110, 7.6.1)
+HOP_BY_HOP = {'connection', 'proxy-connection', 'keep-alive', 'te', 'upgrade'}
+
+# Общий кэш ответов (RFC 9111): тела до CACHE_MEMORY_OBJECT_LIMIT держим в памяти, крупнее - в файлах
+CACHE_MEMORY_LIMIT = 64 * 1024 * 1024
+CACHE_DISK_LIMIT = 512 * 1024 * 1024
+CACHE_MEMORY_OBJECT_LIMIT = 256 * 1024
+CACHE_MAX_OBJECT_SIZE = 64 * 1024 * 1024
+# Эвристический срок свежести - доля возраста документа по Last-Modified (RFC 9111, 4.2.2)
+HEURISTIC_FRACTION = 0.1
+HEURISTIC_MAX_LIFETIME = 24 * 3600
+# Коды, которые можно кэшировать по умолчанию (RFC 9110, 15.1)
+CACHEABLE_STATUSES = {200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501}
+UNSAFE_METHODS = {'POST', 'PUT', 'DELETE', 'PATCH'}
+# Эти заголовки кэш пересчитывает сам при отдаче ответа
+UNSTORED_HEADERS = HOP_BY_HOP | {'age', 'content-length', 'transfer-encoding'}
+# Заголовки, которые передаются клиенту в ответе 304 вместо полного ответа (RFC 9110, 15.4.5)
+NOT_MODIFIED_HEADERS = {'cache-control', 'content-location', 'date', 'etag', 'expires', 'vary', 'age'}
 
 
 class ThreadingTCPServer(ThreadingMixIn, TCPServer):
-    pass
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def __init__(self, server_address, handler_class, cache=None, filters=None, codings=None, tunnel_relay=None,
+                 metrics=None):
+        super().__init__(server_address, handler_class)
+        self.pool = UpstreamPool()
+        self.cache = cache
+        self.filters = filters or FilterFile()
+        self.codings = codings or ContentCodings()
+        self.tunnel_relay = tunnel_relay or TUNNEL_RELAYS[0]
+        # Без метрик /__stats отдает только счетчики пула и кэша
+        self.metrics = metrics
+
+
+class SocketReader:
+    # Буферизованное чтение из сокета: заголовки построчно, тело кусками не больше CHUNK_SIZE
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b''
+
+    def fill(self):
+        part = self.sock.recv(CHUNK_SIZE)
+        if not part:
+            return False
+        self.buffer += part
+        return True
+
+    def read_until(self, delimiter, limit):
+        while True:
+            end = self.buffer.find(delimiter)
+            if end != -1:
+                end += len(delimiter)
+                data, self.buffer = self.buffer[:end], self.buffer[end:]
+                return data
+            if len(self.buffer) > limit:
+                raise ValueError("Header section is too large")
+            if not self.fill():
+                if self.buffer:
+                    raise ConnectionError("Connection closed in the middle of a message")
+                return None
+
+    def read_line(self):
+        line = self.read_until(b'\r\n', MAX_HEAD_SIZE)
+        if line is None:
+            raise ConnectionError("Connection closed in the middle of a message")
+        return line
+
+    def read(self, size):
+        # Возвращает до size байт; пустой ответ значит, что соединение закрыто
+        if not self.buffer:
+            return self.sock.recv(min(size, CHUNK_SIZE))
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class Message:
+    def __init__(self, start_line, headers):
+        self.start_line = start_line
+        # Список пар (имя, значение), порядок и регистр имен сохраняются
+        self.headers = headers
+
+    def get(self, name, default=None):
+        name = name.lower()
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value
+        return default
+
+    def get_all(self, name):
+        name = name.lower()
+        return [value for key, value in self.headers if key.lower() == name]
+
+    def remove(self, *names):
+        names = {name.lower() for name in names}
+        self.headers = [(key, value) for key, value in self.headers if key.lower() not in names]
+
+    def remove_hop_by_hop(self):
+        # Кроме стандартных, хоп-заголовками считаются перечисленные в Connection
+        listed = {name.strip() for name in self.get('Connection', '').split(',') if name.strip()}
+        self.remove(*HOP_BY_HOP, *listed)
+
+    def set(self, name, value):
+        self.remove(name)
+        self.headers.append((name, value))
+
+    def is_chunked(self):
+        return 'chunked' in self.get('Transfer-Encoding', '').lower()
+
+    def content_length(self):
+        value = self.get('Content-Length')
+        return int(value) if value is not None else None
+
+    def encode(self):
+        lines = [self.start_line] + [f'{key}: {value}' for key, value in self.headers]
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+def read_message_head(reader):
+    head = reader.read_until(b'\r\n\r\n', MAX_HEAD_SIZE)
+    if head is None:
+        return None
+    return parse_message_head(head)
+
+
+def parse_message_head(head):
+    lines = head.decode('latin-1').split('\r\n')
+    headers = []
+    for line in lines[1:]:
+        if not line:
+            continue
+        name, _, value = line.partition(':')
+        headers.append((name.strip(), value.strip()))
+    return Message(lines[0], headers)
+
+
+def relay_fixed(reader, writer, length, sink=None):
+    while length > 0:
+        part = reader.read(min(length, CHUNK_SIZE))
+        if not part:
+            raise ConnectionError("Connection closed before the end of the body")
+        if writer:
+            writer.sendall(part)
+        if sink:
+            sink.write(part)
+        length -= len(part)
+
+
+def relay_chunked(reader, writer, sink=None):
+    # Куски пересылаются как есть, разбираем только их размеры, чтобы найти конец тела.
+    # В sink попадают только данные кусков, без разметки; writer может отсутствовать
+    while True:
+        line = reader.read_line()
+        if writer:
+            writer.sendall(line)
+        size = int(line.split(b';', 1)[0].strip(), 16)
+        if size == 0:
+            break
+        relay_fixed(reader, writer, size, sink)
+        line = reader.read_line()
+        if writer:
+            writer.sendall(line)
+
+    # Трейлеры заканчиваются пустой строкой
+    while True:
+        line = reader.read_line()
+        if writer:
+            writer.sendall(line)
+        if line == b'\r\n':
+            break
+
+
+def relay_until_close(reader, writer, sink=None):
+    while True:
+        part = reader.read(CHUNK_SIZE)
+        if not part:
+            break
+        if writer:
+            writer.sendall(part)
+        if sink:
+            sink.write(part)
+
+
+def relay_body(message, reader, writer, until_close, sink=None):
+    if message.is_chunked():
+        relay_chunked(reader, writer, sink)
+    elif message.content_length() is not None:
+        relay_fixed(reader, writer, message.content_length(), sink)
+    elif until_close:
+        relay_until_close(reader, writer, sink)
+
+
+def fixed_parts(reader, length):
+    while length > 0:
+        part = reader.read(min(length, CHUNK_SIZE))
+        if not part:
+            raise ConnectionError("Connection closed before the end of the body")
+        yield part
+        length -= len(part)
+
+
+def body_parts(message, reader):
+    # Тело по частям, по мере получения и уже без разметки chunked
+    if message.is_chunked():
+        while True:
+            size = int(reader.read_line().split(b';', 1)[0].strip(), 16)
+            if size == 0:
+                break
+            yield from fixed_parts(reader, size)
+            reader.read_line()
+        while reader.read_line() != b'\r\n':
+            pass
+    elif message.content_length() is not None:
+        yield from fixed_parts(reader, message.content_length())
+    else:
+        while True:
+            part = reader.read(CHUNK_SIZE)
+            if not part:
+                break
+            yield part
+
+
+def has_body(method, status):
+    return method != 'HEAD' and not (100 <= status < 200 or status in (204, 304))
+
+
+def keeps_alive(message, protocol):
+    connection = message.get('Connection', '').lower()
+    if protocol == 'HTTP/1.0':
+        return 'keep-alive' in connection
+    return 'close' not in connection
+
+
+def open_upstream_socket(address):
+    # То же, что socket.create_connection, но с отдельным временем разрешения имени и подключения.
+    # Возвращает (сокет, (секунд на DNS, секунд на подключение))
+    started = time.perf_counter()
+    addresses = socket.getaddrinfo(*address, type=socket.SOCK_STREAM)
+    resolved = time.perf_counter()
+    error = None
+    for family, kind, protocol, _, sockaddr in addresses:
+        sock = socket.socket(family, kind, protocol)
+        try:
+            sock.settimeout(UPSTREAM_TIMEOUT)
+            sock.connect(sockaddr)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return sock, (resolved - started, time.perf_counter() - resolved)
+        except OSError as e:
+            error = e
+            sock.close()
+    raise error or OSError(f"Cannot resolve {address[0]}")
+
+
+class UpstreamConnection:
+    def __init__(self, address):
+        self.address = address
+        # Время установки соединения достается метрикам первого запроса по нему
+        self.sock, self.setup = open_upstream_socket(address)
+        self.reader = SocketReader(self.sock)
+        self.requests = 0
+        self.last_used = time.monotonic()
+
+    def is_stale(self, current_time):
+        if current_time - self.last_used > POOL_IDLE_TIMEOUT:
+            return True
+        # Простаивающее соединение не должно быть готово к чтению: это либо закрытие сервером, либо мусор
+        readable, _, _ = select.select([self.sock], [], [], 0)
+        return bool(readable) or bool(self.reader.buffer)
+
+    def close(self):
+        self.sock.close()
+
+
+class UpstreamPool:
+    def __init__(self, max_idle_per_host=POOL_MAX_IDLE_PER_HOST, max_per_host=POOL_MAX_PER_HOST):
+        self.max_idle_per_host = max_idle_per_host
+        self.max_per_host = max_per_host
+        self.condition = threading.Condition()
+        # (хост, порт) -> свободные соединения, последнее освобожденное в конце
+        self.idle = defaultdict(list)
+        self.active = Counter()
+        self.stats = Counter()
+
+    def record(self, name):
+        with self.condition:
+            self.stats[name] += 1
+
+    def record_tunnel(self, tunnel):
+        with self.condition:
+            self.stats['tunnels'] += 1
+            self.stats['tunnel_upload'] += tunnel.upload.transferred
+            self.stats['tunnel_download'] += tunnel.download.transferred
+
+    def acquire(self, address):
+        stale = []
+        deadline = time.monotonic() + UPSTREAM_TIMEOUT
+        try:
+            with self.condition:
+                while True:
+                    idle = self.idle[address]
+                    current_time = time.monotonic()
+                    while idle:
+                        connection = idle.pop()
+                        if connection.is_stale(current_time):
+                            self.stats['stale'] += 1
+                            stale.append(connection)
+                            continue
+                        self.active[address] += 1
+                        self.stats['reused'] += 1
+                        return connection
+
+                    if self.active[address] < self.max_per_host:
+                        self.active[address] += 1
+                        break
+                    # Все соединения с хостом заняты, ждем освобождения
+                    remaining = deadline - current_time
+                    if remaining <= 0 or not self.condition.wait(remaining):
+                        raise TimeoutError(f"No free connection to {address[0]}:{address[1]}")
+        finally:
+            for connection in stale:
+                connection.close()
+
+        try:
+            connection = UpstreamConnection(address)
+        except OSError:
+            self.release(None, address, False)
+            raise
+        self.record('created')
+        return connection
+
+    def release(self, connection, address, reusable):
+        with self.condition:
+            self.active[address] -= 1
+            idle = self.idle[address]
+            if connection is not None:
+                connection.requests += 1
+                connection.last_used = time.monotonic()
+                if reusable and len(idle) < self.max_idle_per_host:
+                    idle.append(connection)
+                    connection = None
+            self.condition.notify()
+        if connection is not None:
+            connection.close()
+
+    def snapshot(self):
+        # (счетчики, число свободных соединений)
+        with self.condition:
+            return Counter(self.stats), sum(len(connections) for connections in self.idle.values())
+
+    def print_stats(self):
+        stats, idle = self.snapshot()
+        connections = stats['created'] + stats['reused']
+        ratio = stats['reused'] / connections * 100 if connections else 0
+        client_ratio = stats['client_requests'] / stats['client_connections'] if stats['client_connections'] else 0
+        print(f"Upstream pool: {stats['created']} connections opened, {stats['reused']} reused "
+              f"({ratio:.1f}% reuse), {stats['stale']} stale dropped, {stats['retries']} retries, {idle} idle")
+        print(f"Clients: {stats['client_connections']} connections, {stats['client_requests']} requests "
+              f"({client_ratio:.1f} per connection)")
+        if stats['tunnels']:
+            print(f"Tunnels: {stats['tunnels']}, {stats['tunnel_upload'] / 1024 / 1024:.1f} MB up, "
+                  f"{stats['tunnel_download'] / 1024 / 1024:.1f} MB down")
+
+
+# Правила фильтрации рекламы в формате Adblock Plus (EasyList). Без файла правил действуют эти
+DEFAULT_FILTERS = '''
+e1.ru##img.ad
+e1.ru##script.ad
+e1.ru##iframe.ad
+vk.com##img
+'''
+FILTERS_RELOAD_INTERVAL = 1
+# Сколько хостов держать со скомпилированными правилами и сколько адресов с готовым решением
+FILTERS_HOST_CACHE_SIZE = 1024
+FILTERS_URL_CACHE_SIZE = 64 * 1024
+
+# Внутри этих элементов текст, а не разметка (HTML, 13.1.2): теги там искать нельзя
+RAW_TEXT_ELEMENTS = {b'script', b'style', b'textarea', b'title', b'iframe', b'xmp', b'noembed', b'noframes'}
+VOID_ELEMENTS = {b'area', b'base', b'br', b'col', b'embed', b'hr', b'img', b'input', b'link', b'meta',
+                 b'source', b'track', b'wbr'}
+# Элементы, которые загружают ресурс: атрибут с адресом и тип ресурса для опций $image, $script...
+RESOURCE_ELEMENTS = {b'img': (b'src', 'image'), b'script': (b'src', 'script'), b'iframe': (b'src', 'subdocument'),
+                     b'embed': (b'src', 'object'), b'object': (b'data', 'object')}
+RESOURCE_TYPES = {'script', 'image', 'stylesheet', 'object', 'subdocument', 'xmlhttprequest', 'media', 'font',
+                  'ping', 'websocket', 'other'}
+# Дольше этого незакрытый тег не ждем и считаем символ '<' текстом
+MAX_TAG_SIZE = 64 * 1024
+# Для правил без тега годится любой тег; длиннее имена тегов не ждем на границе частей тела
+MAX_TAG_NAME = 64
+START_TAG_RE = re.compile(rb'''<([a-zA-Z][^\s/>]*)((?:[^>"']|"[^"]*"|'[^']*')*)>''')
+ATTRIBUTE_RE = re.compile(rb'''([^\s=/>]+)(?:\s*=\s*("[^"]*"|'[^']*'|[^\s>]*))?''')
+ANY_TAG_RE = re.compile(rb'<(?:!--|([a-zA-Z][^\s/>]*)[\s/>])')
+
+HIDING_RULE_RE = re.compile(r'^([^/|@"!]*?)#([@?$%]?)#(.+)$')
+SELECTOR_RE = re.compile(r'^([a-zA-Z][a-zA-Z0-9-]*)?((?:[.#][\w-]+)*)$')
+SELECTOR_PART_RE = re.compile(r'([.#])([\w-]+)')
+HOST_ANCHOR_RE = re.compile(r'^\|\|([a-z0-9.-]+)[\^/:]')
+URL_TOKEN_RE = re.compile(r'[%0-9a-z]{2,}')
+URL_GRAM = 4
+# Такие части адреса есть почти в каждом URL и для индекса бесполезны
+COMMON_TOKENS = {'http', 'https', 'www', 'com', 'net', 'org', 'ru', 'js', 'html'}
+
+
+def host_suffixes(host):
+    # a.b.c -> a.b.c, b.c, c: правило для домена действует и на его поддомены
+    labels = host.split('.')
+    return ['.'.join(labels[i:]) for i in range(len(labels))]
+
+
+def base_domain(host):
+    # Приближение регистрируемого домена без списка публичных суффиксов
+    return '.'.join(host.split('.')[-2:])
+
+
+def parse_domains(text, separator):
+    include, exclude = [], []
+    for domain in text.lower().split(separator):
+        domain = domain.strip()
+        if domain.startswith('~'):
+            exclude.append(domain[1:])
+        elif domain:
+            include.append(domain)
+    return include, exclude
+
+
+def domain_applies(host, include, exclude):
+    suffixes = host_suffixes(host)
+    if include and not any(domain in suffixes for domain in include):
+        return False
+    return not any(domain in suffixes for domain in exclude)
+
+
+class Selector:
+    # Простой селектор: тег, #id, .класс и их сочетания. Комбинаторы и псевдоклассы не поддерживаются
+    def __init__(self, text, tag, element_id, classes):
+        self.text = text
+        self.tag = tag
+        self.id = element_id
+        self.classes = frozenset(classes)
+        # Ключ индекса - самая редкая часть селектора: id, затем первый класс, затем тег
+        self.key = b'#' + element_id if element_id else b'.' + classes[0] if classes else tag
+
+    @classmethod
+    def parse(cls, text):
+        match = SELECTOR_RE.match(text.strip())
+        if not match or not (match.group(1) or match.group(2)):
+            return None
+        ids, classes = [], []
+        for kind, name in SELECTOR_PART_RE.findall(match.group(2)):
+            (ids if kind == '#' else classes).append(name.encode())
+        if len(set(ids)) > 1:
+            return None
+        tag = match.group(1).lower().encode() if match.group(1) else None
+        return cls(text.strip(), tag, ids[0] if ids else None, classes)
+
+    def matches(self, tag, element_id, classes):
+        return ((self.tag is None or self.tag == tag) and (self.id is None or self.id == element_id)
+                and self.classes <= classes)
+
+
+class SelectorIndex:
+    def __init__(self, selectors):
+        self.index = defaultdict(list)
+        # Теги, которые нужно разбирать; None - селекторы без тега, подходит любой
+        self.tags = set()
+        for selector in selectors:
+            self.index[selector.key].append(selector)
+            self.tags.add(selector.tag)
+
+    def match(self, tag, element_id, classes, disabled):
+        # Проверяются только селекторы, ключ которых есть у элемента: тег, id или один из классов
+        index = self.index
+        candidates = [index.get(tag)]
+        if element_id:
+            candidates.append(index.get(b'#' + element_id))
+        for class_name in classes:
+            candidates.append(index.get(b'.' + class_name))
+        for selectors in candidates:
+            for selector in selectors or ():
+                if selector.matches(tag, element_id, classes) and selector.text not in disabled:
+                    return True
+        return False
+
+
+def is_regex_pattern(pattern):
+    return len(pattern) > 1 and pattern.startswith('/') and pattern.endswith('/')
+
+
+def pattern_regex(pattern):
+    # Шаблон адреса Adblock Plus в регулярное выражение: || - начало домена, | - край адреса,
+    # ^ - разделитель, * - любые символы; /.../ - готовое регулярное выражение
+    if is_regex_pattern(pattern):
+        return pattern[1:-1]
+    parts = []
+    if pattern.startswith('||'):
+        parts.append(r'^[a-z][a-z0-9+.-]*://(?:[^/?#]*\.)?')
+        pattern = pattern[2:]
+    elif pattern.startswith('|'):
+        parts.append('^')
+        pattern = pattern[1:]
+    end_anchor = pattern.endswith('|')
+    if end_anchor:
+        pattern = pattern[:-1]
+    for char in pattern:
+        if char == '*':
+            parts.append('.*')
+        elif char == '^':
+            parts.append(r'(?:[^\w.%-]|$)')
+        else:
+            parts.append(re.escape(char))
+    if end_anchor:
+        parts.append('$')
+    return ''.join(parts)
+
+
+def pattern_tokens(pattern):
+    # Куски шаблона, которые обязательно будут целыми токенами адреса: по ним правило ищется в индексе.
+    # Соседи токена в шаблоне не должны быть буквами, цифрами или *, иначе в адресе токен будет длиннее
+    text = pattern.lower()
+    start_anchor = text.startswith('|')
+    end_anchor = text.endswith('|') and not text.endswith('||')
+    tokens = []
+    for match in URL_TOKEN_RE.finditer(text):
+        before = text[match.start() - 1] if match.start() else None
+        after = text[match.end()] if match.end() < len(text) else None
+        if before is None and not start_anchor or before == '*':
+            continue
+        if after is None and not end_anchor or after == '*':
+            continue
+        tokens.append(match.group())
+    return tokens
+
+
+def pattern_grams(pattern):
+    # Подстроки длины URL_GRAM из буквальных частей шаблона: хотя бы одна из них есть в подходящем адресе
+    literals = re.split(r'[*^|]', pattern.lower())
+    return {literal[i:i + URL_GRAM] for literal in literals for i in range(len(literal) - URL_GRAM + 1)}
+
+
+class NetworkRule:
+    def __init__(self, text, source, flags, include, exclude, types, third_party):
+        self.text = text
+        # Выражение компилируется при первой проверке: большинство правил до нее не доходит
+        self.source = source
+        self.flags = flags
+        self.regex = None
+        self.include = include
+        self.exclude = exclude
+        self.types = types
+        self.third_party = third_party
+
+    @classmethod
+    def parse(cls, line):
+        pattern, options = line, ''
+        if '$' in line and not is_regex_pattern(line):
+            pattern, _, options = line.rpartition('$')
+        include, exclude, types, third_party, flags = [], [], None, None, re.IGNORECASE
+        for option in filter(None, (option.strip().lower() for option in options.split(','))):
+            negated = option.startswith('~')
+            name = option.lstrip('~')
+            if name.startswith('domain='):
+                include, exclude = parse_domains(name[7:], '|')
+            elif name in RESOURCE_TYPES:
+                if types is None:
+                    types = set(RESOURCE_TYPES) if negated else set()
+                if negated:
+                    types.discard(name)
+                else:
+                    types.add(name)
+            elif name == 'third-party':
+                third_party = not negated
+            elif name == 'match-case':
+                flags = 0
+            else:
+                # Неизвестные опции сужают действие правила, без них оно заблокировало бы лишнее
+                return None
+        source = pattern_regex(pattern)
+        if is_regex_pattern(pattern):
+            re.compile(source, flags)
+        return cls(line, source, flags, include, exclude, types, third_party), pattern
+
+    def matches(self, url, url_host, page_host, resource_type):
+        if self.types is not None and resource_type not in self.types:
+            return False
+        if page_host is None:
+            # Запрос не со страницы: правила для определенных страниц к нему не относятся
+            if self.include or self.third_party is not None:
+                return False
+        else:
+            if self.third_party is not None and (base_domain(url_host) != base_domain(page_host)) != self.third_party:
+                return False
+            if (self.include or self.exclude) and not domain_applies(page_host, self.include, self.exclude):
+                return False
+        if self.regex is None:
+            self.regex = re.compile(self.source, self.flags)
+        return self.regex.search(url) is not None
+
+
+class NetworkFilter:
+    # Правила для адресов, разложенные так, чтобы проверка адреса не зависела от их числа: по домену
+    # после ||, по обязательному токену адреса, по подстроке из URL_GRAM символов. Правила, для которых
+    # ничего из этого нет (в основном /регулярные выражения/), проверяются через одно общее выражение
+    def __init__(self):
+        self.hosts = defaultdict(list)
+        self.tokens = defaultdict(list)
+        self.grams = defaultdict(list)
+        self.other = []
+        self.combined = None
+
+    def __bool__(self):
+        return bool(self.hosts or self.tokens or self.grams or self.other)
+
+    def add(self, rule, pattern):
+        host = HOST_ANCHOR_RE.match(pattern.lower())
+        if host:
+            self.hosts[host.group(1)].append(rule)
+            return
+        if is_regex_pattern(pattern):
+            self.other.append(rule)
+            return
+        # Из возможных ключей берем тот, под которым пока меньше всего правил; токен проверяется
+        # быстрее подстрок, поэтому при равенстве выигрывает он
+        token = min(pattern_tokens(pattern), default=None,
+                    key=lambda token: (token in COMMON_TOKENS, len(self.tokens.get(token, ())), -len(token)))
+        gram = min(pattern_grams(pattern), default=None, key=lambda gram: len(self.grams.get(gram, ())))
+        token_size = len(self.tokens.get(token, ())) if token and token not in COMMON_TOKENS else None
+        if token and (gram is None or token_size is not None and token_size <= len(self.grams.get(gram, ()))):
+            self.tokens[token].append(rule)
+        elif gram:
+            self.grams[gram].append(rule)
+        elif token:
+            self.tokens[token].append(rule)
+        else:
+            self.other.append(rule)
+
+    def compile(self):
+        if self.other:
+            try:
+                self.combined = re.compile('|'.join(f'(?:{rule.source})' for rule in self.other), re.I)
+            except re.error:
+                self.combined = None
+
+    def candidates(self, url, url_host):
+        for suffix in host_suffixes(url_host):
+            yield from self.hosts.get(suffix, ())
+        lowered = url.lower()
+        if self.tokens:
+            for token in set(URL_TOKEN_RE.findall(lowered)):
+                yield from self.tokens.get(token, ())
+        if self.grams:
+            grams = self.grams
+            for gram in {lowered[i:i + URL_GRAM] for i in range(len(lowered) - URL_GRAM + 1)}:
+                yield from grams.get(gram, ())
+        # Общее выражение отсеивает адреса, которым не подходит ни одно правило без индекса
+        if self.other and (self.combined is None or self.combined.search(url)):
+            yield from self.other
+
+    def match(self, url, url_host, page_host, resource_type):
+        for rule in self.candidates(url, url_host):
+            if rule.matches(url, url_host, page_host, resource_type):
+                return rule
+        return None
+
+
+class FilterList:
+    # Скомпилированный список правил. Правила для хоста собираются при первом обращении и запоминаются
+    def __init__(self, text):
+        self.count = 0
+        self.skipped = 0
+        # Правила скрытия без доменов - общие для всех страниц, остальные - по доменам
+        generic = []
+        self.generic_exclusions = []
+        self.hiding = defaultdict(list)
+        # Исключения #@#: домен -> тексты селекторов, '' - исключения для всех доменов
+        self.unhiding = defaultdict(set)
+        self.blocking = NetworkFilter()
+        self.allowing = NetworkFilter()
+        for line in text.splitlines():
+            line = line.strip()
+            if not line or line.startswith(('!', '[')):
+                continue
+            self.count += 1
+            if not self.add(line, generic):
+                self.skipped += 1
+        self.generic = SelectorIndex(generic)
+        self.blocking.compile()
+        self.allowing.compile()
+        self.lock = threading.Lock()
+        self.hosts = OrderedDict()
+        self.urls = {}
+
+    def add(self, line, generic):
+        hiding = HIDING_RULE_RE.match(line)
+        if hiding:
+            domains, kind, selector_text = hiding.groups()
+            if kind == '@':
+                include, _ = parse_domains(domains, ',')
+                for domain in include or ['']:
+                    self.unhiding[domain].add(selector_text.strip())
+                return True
+            # Расширенный синтаксис (#?#, #$#, #%#) требует CSS-движка или скриптов
+            selector = Selector.parse(selector_text) if not kind else None
+            if selector is None:
+                return False
+            include, exclude = parse_domains(domains, ',')
+            if not include:
+                generic.append(selector)
+                if exclude:
+                    self.generic_exclusions.append((selector.text, exclude))
+            for domain in include:
+                self.hiding[domain].append((selector, exclude))
+            return True
+
+        allowing = line.startswith('@@')
+        try:
+            parsed = NetworkRule.parse(line[2:] if allowing else line)
+        except re.error:
+            return False
+        if parsed is None:
+            return False
+        (self.allowing if allowing else self.blocking).add(*parsed)
+        return True
+
+    def for_host(self, host):
+        # Правила для страниц хоста или None, если на его страницах удалять нечего
+        host = host.lower()
+        with self.lock:
+            if host in self.hosts:
+                self.hosts.move_to_end(host)
+                return self.hosts[host]
+        rules = self.compile_host(host)
+        with self.lock:
+            self.hosts[host] = rules
+            if len(self.hosts) > FILTERS_HOST_CACHE_SIZE:
+                self.hosts.popitem(last=False)
+        return rules
+
+    def compile_host(self, host):
+        suffixes = host_suffixes(host)
+        disabled = set(self.unhiding.get('', ()))
+        for suffix in suffixes:
+            disabled |= self.unhiding.get(suffix, set())
+        disabled.update(text for text, exclude in self.generic_exclusions
+                        if any(domain in suffixes for domain in exclude))
+        specific = [selector for suffix in suffixes for selector, exclude in self.hiding.get(suffix, ())
+                    if not any(domain in suffixes for domain in exclude)]
+        indexes = [index for index in (self.generic, SelectorIndex(specific)) if index.index]
+        if not indexes and not self.blocking:
+            return None
+        return HostRules(host, indexes, disabled, self if self.blocking else None)
+
+    def blocks(self, url, page_host=None, resource_type=None):
+        if not self.blocking:
+            return False
+        key = (url, page_host, resource_type)
+        result = self.urls.get(key)
+        if result is None:
+            url_host = (urlparse(url).hostname or '').lower()
+            result = (self.blocking.match(url, url_host, page_host, resource_type) is not None
+                      and self.allowing.match(url, url_host, page_host, resource_type) is None)
+            if len(self.urls) >= FILTERS_URL_CACHE_SIZE:
+                self.urls.clear()
+            self.urls[key] = result
+        return result
+
+
+class HostRules:
+    # Правила, действующие на страницах одного хоста, в виде для проверки элемента за постоянное время
+    def __init__(self, host, indexes, disabled, filters):
+        self.host = host
+        self.indexes = indexes
+        self.disabled = disabled
+        # Список правил для проверки адресов ресурсов, если в нем есть такие правила
+        self.filters = filters
+        tags = set().union(*(index.tags for index in indexes))
+        if filters:
+            tags |= set(RESOURCE_ELEMENTS)
+        if None in tags:
+            self.pattern = ANY_TAG_RE
+            self.max_prefix = MAX_TAG_NAME + 2
+        else:
+            # Ищем только комментарии и теги, которые важны для правил; остальной текст копируется как есть
+            names = sorted(tags | RAW_TEXT_ELEMENTS, key=len, reverse=True)
+            self.pattern = re.compile(rb'<(?:!--|(' + b'|'.join(map(re.escape, names)) + rb')[\s/>])', re.I)
+            self.max_prefix = max(map(len, names)) + 2
+        self.closing = {}
+
+    def closing_pattern(self, tag):
+        pattern = self.closing.get(tag)
+        if pattern is None:
+            pattern = self.closing[tag] = re.compile(rb'<(/?)' + re.escape(tag) + rb'[\s/>]', re.I)
+        return pattern
+
+    def removes(self, tag, attributes, page_url):
+        element_id = url = None
+        classes = frozenset()
+        resource = RESOURCE_ELEMENTS.get(tag) if self.filters else None
+        if attributes.strip():
+            for match in ATTRIBUTE_RE.finditer(attributes):
+                name = match.group(1).lower()
+                if name == b'class':
+                    classes = frozenset((match.group(2) or b'').strip(b'"\'').split())
+                elif name == b'id':
+                    element_id = (match.group(2) or b'').strip(b'"\'') or None
+                elif resource and name == resource[0]:
+                    url = (match.group(2) or b'').strip(b'"\'')
+        for index in self.indexes:
+            if index.match(tag, element_id, classes, self.disabled):
+                return True
+        if url:
+            url = urljoin(page_url, unescape(url.decode('latin-1')).strip())
+            return url.startswith(('http://', 'https://')) and self.filters.blocks(url, self.host, resource[1])
+        return False
+
+
+class FilterFile:
+    # Файл правил: фоновый поток раз в FILTERS_RELOAD_INTERVAL секунд проверяет, не изменился ли он,
+    # и подменяет скомпилированный список. Без файла действуют правила по умолчанию
+    def __init__(self, path=None):
+        self.path = path
+        self.version = None
+        self.filters = FilterList(DEFAULT_FILTERS)
+        if path:
+            if not self.reload():
+                raise OSError(f"Cannot load filter rules from {path}")
+            threading.Thread(target=self.watch, daemon=True).start()
+
+    def current(self):
+        return self.filters
+
+    def watch(self):
+        while True:
+            time.sleep(FILTERS_RELOAD_INTERVAL)
+            self.reload()
+
+    def reload(self):
+        try:
+            stat = os.stat(self.path)
+            version = (stat.st_mtime_ns, stat.st_size)
+            if version == self.version:
+                return True
+            with open(self.path, encoding='utf-8', errors='replace') as file:
+                text = file.read()
+        except OSError as e:
+            print(f"Cannot read filter rules: {e}")
+            return False
+        started = time.monotonic()
+        self.filters = FilterList(text)
+        self.version = version
+        print(f"Loaded {self.filters.count} filter rules from {self.path} in "
+              f"{time.monotonic() - started:.2f} s, {self.filters.skipped} unsupported skipped")
+        return True
+
+
+class HTMLRewriter:
+    # Потоковая правка HTML без построения дерева: feed() принимает очередную часть тела и возвращает
+    # готовую часть результата, а незаконченный тег или комментарий откладывает до следующей части
+    def __init__(self, rules, page_url):
+        self.rules = rules
+        # Адрес страницы нужен, чтобы проверять относительные адреса ресурсов
+        self.page_url = page_url
+        self.pending = b''
+        # Открытый элемент, внутри которого теги не разбираются: (тег, удаляется ли он, глубина вложенности)
+        self.inside = None
+        self.removed = 0
+
+    def close(self):
+        return self.feed(b'', final=True)
+
+    def feed(self, data, final=False):
+        buffer = self.pending + data if self.pending else data
+        output = []
+        position = 0
+        end = len(buffer)
+        while position < end:
+            if self.inside:
+                tag, removing, depth = self.inside
+                match = self.rules.closing_pattern(tag).search(buffer, position)
+                if match is None:
+                    # Конец буфера может оказаться началом закрывающего тега
+                    stop = end if final else max(position, end - len(tag) - 3)
+                    if not removing:
+                        output.append(buffer[position:stop])
+                    position = stop
+                    break
+                close = buffer.find(b'>', match.end() - 1)
+                if close == -1:
+                    if not final:
+                        if not removing:
+                            output.append(buffer[position:match.start()])
+                        position = match.start()
+                        break
+                    close = end - 1
+                if match.group(1):
+                    depth -= 1
+                elif tag not in RAW_TEXT_ELEMENTS:
+                    depth += 1
+                if not removing:
+                    output.append(buffer[position:close + 1])
+                position = close + 1
+                self.inside = (tag, removing, depth) if depth else None
+                continue
+
+            match = self.rules.pattern.search(buffer, position)
+            if match is None:
+                stop = end
+                if not final:
+                    hold = buffer.rfind(b'<', max(position, end - self.rules.max_prefix))
+                    if hold != -1:
+                        stop = hold
+                output.append(buffer[position:stop])
+                position = stop
+                break
+
+            start = match.start()
+            output.append(buffer[position:start])
+            position = start
+            if match.group(1) is None:
+                close = buffer.find(b'-->', start + 4)
+                if close == -1:
+                    if final:
+                        output.append(buffer[start:])
+                        position = end
+                    break
+                output.append(buffer[start:close + 3])
+                position = close + 3
+                continue
+
+            tag_match = START_TAG_RE.match(buffer, start)
+            if tag_match is None:
+                if not final and end - start <= MAX_TAG_SIZE:
+                    break
+                # Это не тег, а текст с символом '<'
+                output.append(b'<')
+                position = start + 1
+                continue
+            tag = match.group(1).lower()
+            position = tag_match.end()
+            if self.rules.removes(tag, tag_match.group(2), self.page_url):
+                self.removed += 1
+                if tag not in VOID_ELEMENTS:
+                    self.inside = (tag, True, 1)
+                continue
+            output.append(buffer[start:position])
+            if tag in RAW_TEXT_ELEMENTS:
+                self.inside = (tag, False, 1)
+
+        self.pending = buffer[position:]
+        return b''.join(output)
+
+
+def rewrite_rules(response, filters, host):
+    # Правила для ответа или None, если ответ пересылается без изменений
+    if 'text/html' not in response.get('Content-Type', '').lower():
+        return None
+    # Тело в кодировке, которую мы не умеем распаковывать, пересылается как есть
+    if content_coding(response) not in DECODABLE_CODINGS:
+        return None
+    return filters.for_host(host)
+
+
+def prepare_streamed_body(request, response):
+    # Длина измененного на лету тела заранее неизвестна: клиенту HTTP/1.1 отправляем его кусками,
+    # клиенту HTTP/1.0 - до закрытия соединения. Возвращает (кусками ли, оставить ли соединение с клиентом)
+    protocol = request.start_line.split()[2]
+    chunked = protocol != 'HTTP/1.0'
+    client_keep_alive = chunked and keeps_alive(request, protocol)
+    response.remove('Content-Length', 'Transfer-Encoding')
+    if chunked:
+        response.set('Transfer-Encoding', 'chunked')
+    response.set('Connection', 'keep-alive' if client_keep_alive else 'close')
+    return chunked, client_keep_alive
+
+
+def encode_chunk(data):
+    # Пустой кусок означал бы конец тела, поэтому пустые данные не кодируются
+    return b'%x\r\n%s\r\n' % (len(data), data) if data else b''
+
+
+LAST_CHUNK = b'0\r\n\r\n'
+
+
+# Сжатие переписанного HTML: распаковываем поток от сервера и снова сжимаем для клиента
+DECODABLE_CODINGS = {'identity', 'gzip', 'x-gzip', 'deflate'} | ({'br'} if brotli else set())
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def content_coding(message):
+    return message.get('Content-Encoding', 'identity').strip().lower() or 'identity'
+
+
+def accepted_codings(message):
+    # Accept-Encoding: кодировка -> q (RFC 9110, 12.5.3)
+    codings = {}
+    for value in message.get_all('Accept-Encoding'):
+        for item in value.split(','):
+            coding, _, parameters = item.partition(';')
+            coding = coding.strip().lower()
+            if not coding:
+                continue
+            q = 1.0
+            name, _, number = parameters.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(number)
+                except ValueError:
+                    q = 0.0
+            codings[coding] = q
+    return codings
+
+
+def restrict_accept_encoding(upstream_request):
+    # Просим у сервера только те кодировки, которые сумеем распаковать для вырезания рекламы
+    if upstream_request.get('Accept-Encoding') is None:
+        return
+    codings = [f'{coding};q={q:g}' if q < 1 else coding
+               for coding, q in accepted_codings(upstream_request).items() if coding in DECODABLE_CODINGS]
+    # Пустой Accept-Encoding разрешал бы серверу любую кодировку
+    upstream_request.set('Accept-Encoding', ', '.join(codings) or 'identity')
+
+
+class ContentDecoder:
+    # Потоковая распаковка gzip, deflate и br. За один шаг отдается порядка CHUNK_SIZE,
+    # чтобы маленькое сжатое тело не разворачивалось в памяти целиком
+    def __init__(self, coding):
+        self.brotli = coding == 'br'
+        self.decompressor = brotli.Decompressor() if self.brotli else self.zlib_decompressor()
+        # Данные после конца сжатого потока, по которым еще не ясно, начало ли это следующей части
+        self.rest = b''
+
+    @staticmethod
+    def zlib_decompressor():
+        # Заголовок gzip или zlib определяется автоматически
+        return zlib.decompressobj(zlib.MAX_WBITS | 32)
+
+    def decode(self, data):
+        if self.brotli:
+            yield from self.decode_brotli(data)
+            return
+        while True:
+            if self.decompressor.eof:
+                # За концом потока может идти следующая часть gzip (RFC 1952, 2.2), остальное - мусор
+                data = self.rest + data
+                if not data.startswith(GZIP_MAGIC):
+                    self.rest = data if GZIP_MAGIC.startswith(data) else b''
+                    return
+                self.rest = b''
+                self.decompressor = self.zlib_decompressor()
+            part = self.decompressor.decompress(data, CHUNK_SIZE)
+            if part:
+                yield part
+            if self.decompressor.eof:
+                data = self.decompressor.unused_data
+                continue
+            data = self.decompressor.unconsumed_tail
+            if not data and len(part) < CHUNK_SIZE:
+                return
+
+    def decode_brotli(self, data):
+        if not hasattr(self.decompressor, 'can_accept_more_data'):
+            # Старые версии brotli не умеют ограничивать выход
+            yield self.decompressor.process(data)
+            return
+        # Лимит выхода мягкий, и часть распакованного может остаться внутри: выбираем, пока что-то выходит
+        part = self.decompressor.process(data, output_buffer_limit=CHUNK_SIZE)
+        while part:
+            yield part
+            if self.decompressor.is_finished():
+                break
+            part = self.decompressor.process(b'', output_buffer_limit=CHUNK_SIZE)
+
+    def finish(self):
+        return b'' if self.brotli else self.decompressor.flush()
+
+
+class ContentEncoder:
+    # Потоковое сжатие для клиента. Каждая часть дожимается до границы блока, чтобы клиент
+    # получал страницу так же постепенно, как она приходит от сервера
+    def __init__(self, coding, level):
+        self.brotli = coding == 'br'
+        if self.brotli:
+            self.compressor = brotli.Compressor(quality=level)
+        else:
+            self.compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+    def encode(self, data):
+        if not data:
+            return b''
+        if self.brotli:
+            return self.compressor.process(data) + self.compressor.flush()
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.finish() if self.brotli else self.compressor.flush()
+
+
+class ContentCodings:
+    # Кодировки, которыми сжимаем переписанные ответы; уровень 0 отключает кодировку
+    def __init__(self, gzip_level=GZIP_LEVEL, brotli_quality=BROTLI_QUALITY):
+        self.levels = {'gzip': gzip_level}
+        if brotli:
+            self.levels['br'] = brotli_quality
+
+    def choose(self, request):
+        # Лучшая из принятых клиентом кодировок, при равных q предпочитаем br; None - без сжатия
+        accepted = accepted_codings(request)
+        best, best_q = None, 0.0
+        for coding in ('br', 'gzip'):
+            q = accepted.get(coding, accepted.get('*', 0.0))
+            if self.levels.get(coding) and q > best_q:
+                best, best_q = coding, q
+        return best
+
+    def encoder(self, coding):
+        return ContentEncoder(coding, self.levels[coding]) if coding else None
+
+
+class BodyRewriter:
+    # Распаковка, правка HTML и новое сжатие одного тела, часть за частью
+    def __init__(self, rewriter, decoder=None, encoder=None):
+        self.rewriter = rewriter
+        self.decoder = decoder
+        self.encoder = encoder
+
+    def feed(self, data):
+        if self.decoder:
+            data = b''.join(self.rewriter.feed(part) for part in self.decoder.decode(data))
+        else:
+            data = self.rewriter.feed(data)
+        return self.encoder.encode(data) if self.encoder else data
+
+    def close(self):
+        data = self.rewriter.feed(self.decoder.finish()) if self.decoder else b''
+        data += self.rewriter.close()
+        if self.encoder:
+            return self.encoder.encode(data) + self.encoder.finish()
+        return data
+
+
+def body_rewriter(request, response, rules, page_url, codings):
+    # Готовит правку тела: выбирает кодировку ответа клиенту и меняет заголовки под нее
+    coding = content_coding(response)
+    decoder = ContentDecoder(coding) if coding != 'identity' else None
+    output = codings.choose(request)
+    if output:
+        response.set('Content-Encoding', output)
+    else:
+        response.remove('Content-Encoding')
+    # Сжатие теперь зависит от Accept-Encoding клиента
+    vary = [name.strip().lower() for value in response.get_all('Vary') for name in value.split(',')]
+    if 'accept-encoding' not in vary and '*' not in vary:
+        response.headers.append(('Vary', 'Accept-Encoding'))
+    # Измененное тело не совпадает с исходным байт в байт, строгий валидатор становится слабым
+    etag = response.get('ETag')
+    if etag and not etag.startswith('W/'):
+        response.set('ETag', 'W/' + etag)
+    return BodyRewriter(HTMLRewriter(rules, page_url), decoder, codings.encoder(output))
+
+
+# Что прокси делает с запросом клиента, см. classify_request
+FORWARD, TUNNEL, STATS = 'forward', 'tunnel', 'stats'
+
+
+def classify_request(request):
+    # Проверка стартовой строки до обращения к старшему серверу; None - запрос неверен, ответ 400.
+    # Пересылается только absolute-form (http://хост/путь). Origin-form адресован самому прокси, и на него
+    # отвечает только /__stats: переслать такой запрос по Host значило бы при Host, указывающем на прокси,
+    # отправить его по кругу самому себе
+    parts = request.start_line.split()
+    if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+        return None
+    method, target, _ = parts
+    if method == 'CONNECT':
+        return TUNNEL
+    if target.startswith('/'):
+        return STATS if is_stats_request(request) else None
+    try:
+        parsed_url = urlparse(target)
+        valid = parsed_url.scheme.lower() == 'http' and parsed_url.hostname and parsed_url.port != 0
+    except ValueError:
+        # Порт не число или вне диапазона
+        return None
+    return FORWARD if valid else None
+
+
+def prepare_request(request):
+    # Возвращает адрес старшего сервера и запрос к нему; запрос уже проверен classify_request
+    method, url, protocol = request.start_line.split()
+    parsed_url = urlparse(url)
+
+    host = parsed_url.hostname
+    port = parsed_url.port or 80
+    path = (parsed_url.path or '/') + ('?' + parsed_url.query if parsed_url.query else '')
+
+    # Модифицируем запрос
+    upstream_request = Message(f'{method} {path} {protocol}', list(request.headers))
+    upstream_request.remove_hop_by_hop()
+    upstream_request.remove('Host')
+    upstream_request.headers.insert(0, ('Host', host if port == 80 else f'{host}:{port}'))
+    upstream_request.set('Connection', 'keep-alive')
+    restrict_accept_encoding(upstream_request)
+    return (host, port), upstream_request
+
+
+def request_url(address, upstream_request):
+    path = upstream_request.start_line.split()[1]
+    return f'http://{address[0].lower()}:{address[1]}{path}'
+
+
+def prepare_response(request, response):
+    # Правит заголовки ответа клиенту. Возвращает (есть ли тело, можно ли вернуть соединение
+    # со старшим сервером в пул, можно ли оставить открытым соединение с клиентом)
+    method, _, protocol = request.start_line.split()
+    status = int(response.start_line.split()[1])
+    body = has_body(method, status)
+    framed = not body or response.is_chunked() or response.content_length() is not None
+    upstream_keep_alive = framed and keeps_alive(response, response.start_line.split()[0])
+    # Тело до закрытия соединения клиент не сможет отделить от следующего ответа
+    client_keep_alive = framed and keeps_alive(request, protocol)
+    response.remove_hop_by_hop()
+    response.set('Connection', 'keep-alive' if client_keep_alive else 'close')
+    return body, upstream_keep_alive, client_keep_alive
+
+
+def is_informational(response):
+    return response.start_line.split()[1].startswith('1')
+
+
+def is_replayable(request):
+    return not request.is_chunked() and not request.content_length()
+
+
+def parse_cache_control(message):
+    # Директивы Cache-Control: имя в нижнем регистре -> аргумент (пустая строка, если его нет)
+    directives = {}
+    for value in message.get_all('Cache-Control'):
+        for item in value.split(','):
+            name, _, argument = item.partition('=')
+            name = name.strip().lower()
+            if name:
+                directives[name] = argument.strip().strip('"')
+    return directives
+
+
+def request_directives(request):
+    directives = parse_cache_control(request)
+    # Pragma: no-cache учитывается только у клиентов HTTP/1.0 без Cache-Control
+    if not directives and 'no-cache' in request.get('Pragma', '').lower():
+        directives['no-cache'] = ''
+    return directives
+
+
+def parse_seconds(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_http_date(value):
+    if not value:
+        return None
+    try:
+        parsed = email.utils.parsedate_tz(value)
+        return email.utils.mktime_tz(parsed) if parsed else None
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def freshness_lifetime(response, directives, date):
+    # RFC 9111, 4.2.1: для общего кэша s-maxage важнее max-age, затем Expires, затем эвристика
+    for name in ('s-maxage', 'max-age'):
+        if name in directives:
+            return parse_seconds(directives[name]) or 0
+    if response.get('Expires') is not None:
+        expires = parse_http_date(response.get('Expires'))
+        # Некорректная дата в Expires означает, что ответ уже устарел
+        return max(0, expires - date) if expires is not None else 0
+    last_modified = parse_http_date(response.get('Last-Modified'))
+    if last_modified is not None and int(response.start_line.split()[1]) in CACHEABLE_STATUSES:
+        return min(HEURISTIC_MAX_LIFETIME, max(0, date - last_modified) * HEURISTIC_FRACTION)
+    return 0
+
+
+def vary_values(request, response):
+    # Значения заголовков запроса из Vary: сохраненный ответ подходит только запросу с теми же значениями
+    names = [name.strip().lower() for value in response.get_all('Vary') for name in value.split(',')]
+    return {name: request.get(name) for name in names if name}
+
+
+def is_storable(request, response):
+    # RFC 9111, 3: что вправе сохранить общий кэш
+    status = int(response.start_line.split()[1])
+    if request.start_line.split()[0] != 'GET' or status not in CACHEABLE_STATUSES:
+        return False
+    directives = parse_cache_control(response)
+    if 'no-store' in directives or 'private' in directives or 'no-store' in parse_cache_control(request):
+        return False
+    if request.get('Authorization') is not None and not directives.keys() & {'public', 's-maxage', 'must-revalidate'}:
+        return False
+    # Куки одного клиента не должны достаться другому, а для Vary: * вариант не подобрать
+    if response.get('Set-Cookie') is not None or '*' in response.get('Vary', ''):
+        return False
+    return bool(directives.keys() & {'max-age', 's-maxage', 'public', 'no-cache'} or response.get('Expires')
+                or response.get('ETag') or response.get('Last-Modified'))
+
+
+def add_validators(upstream_request, entry):
+    # Устаревший ответ проверяем у сервера своими условиями вместо условий клиента (RFC 9111, 4.3.1)
+    if not entry.etag and not entry.last_modified:
+        return False
+    upstream_request.remove('If-None-Match', 'If-Modified-Since')
+    if entry.etag:
+        upstream_request.set('If-None-Match', entry.etag)
+    if entry.last_modified:
+        upstream_request.set('If-Modified-Since', entry.last_modified)
+    return True
+
+
+def is_not_modified(request, entry):
+    # Условный запрос клиента к сохраненному ответу (RFC 9110, 13.1)
+    if entry.status != 200:
+        return False
+    if_none_match = request.get('If-None-Match')
+    if if_none_match is not None:
+        # Слабое сравнение: префикс W/ не учитывается
+        tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+        return '*' in tags or (entry.etag is not None and entry.etag.removeprefix('W/') in tags)
+    since = parse_http_date(request.get('If-Modified-Since'))
+    modified = parse_http_date(entry.last_modified)
+    return since is not None and modified is not None and modified <= since
+
+
+class CacheEntry:
+    def __init__(self, key, request, response, request_time, response_time):
+        self.key = key
+        self.status_line = response.start_line
+        self.status = int(response.start_line.split()[1])
+        self.vary = vary_values(request, response)
+        # Тело лежит либо в памяти (body), либо в файле (path)
+        self.body = b''
+        self.path = None
+        self.size = 0
+        self.update(response.headers, request_time, response_time)
+
+    def update(self, headers, request_time, response_time):
+        # RFC 9111, 4.2.3: начальный возраст - больший из Age с задержкой ответа и разницы с Date
+        age_value = parse_seconds(Message('', headers).get('Age')) or 0
+        response = Message(self.status_line, [(key, value) for key, value in headers
+                                              if key.lower() not in UNSTORED_HEADERS])
+        date = parse_http_date(response.get('Date'))
+        if date is None:
+            date = response_time
+        apparent_age = max(0, response_time - date)
+        self.initial_age = max(apparent_age, age_value + response_time - request_time)
+        self.response_time = response_time
+
+        directives = parse_cache_control(response)
+        self.lifetime = freshness_lifetime(response, directives, date)
+        # no-cache разрешает хранить ответ, но требует проверять его у сервера перед каждой отдачей
+        self.no_cache = 'no-cache' in directives
+        self.headers = response.headers
+        self.etag = response.get('ETag')
+        self.last_modified = response.get('Last-Modified')
+
+    def age(self, current_time):
+        return self.initial_age + current_time - self.response_time
+
+    def is_fresh(self, current_time, directives):
+        if self.no_cache or 'no-cache' in directives:
+            return False
+        age = self.age(current_time)
+        lifetime = self.lifetime
+        # Клиент может потребовать ответ моложе max-age или свежий еще хотя бы min-fresh секунд
+        if 'max-age' in directives:
+            lifetime = min(lifetime, parse_seconds(directives['max-age']) or 0)
+        if 'min-fresh' in directives:
+            age += parse_seconds(directives['min-fresh']) or 0
+        return age < lifetime
+
+
+class CachedResponse:
+    # Запись кэша, выданная для одного ответа; тело с диска отображено в память и закрывается после отправки
+    def __init__(self, entry, body, fresh):
+        self.entry = entry
+        self.body = body
+        self.fresh = fresh
+
+    def chunks(self):
+        if isinstance(self.body, mmap.mmap):
+            for offset in range(0, len(self.body), CHUNK_SIZE):
+                yield self.body[offset:offset + CHUNK_SIZE]
+        else:
+            view = memoryview(self.body)
+            for offset in range(0, len(view), CHUNK_SIZE):
+                yield view[offset:offset + CHUNK_SIZE]
+
+    def close(self):
+        if isinstance(self.body, mmap.mmap):
+            self.body.close()
+
+
+class CacheWriter:
+    # Копия тела, которое пересылается клиенту: сначала в памяти, крупное - во временном файле
+    def __init__(self, cache):
+        self.cache = cache
+        self.parts = []
+        self.size = 0
+        self.file = None
+        self.path = None
+        self.failed = False
+
+    def write(self, data):
+        if self.failed:
+            return
+        self.size += len(data)
+        if self.size > self.cache.max_object_size:
+            self.discard()
+            return
+        try:
+            if self.file is None and self.size > CACHE_MEMORY_OBJECT_LIMIT:
+                if not self.cache.disk_limit:
+                    self.discard()
+                    return
+                self.file, self.path = self.cache.temporary_file()
+                self.file.writelines(self.parts)
+                self.parts = []
+            if self.file is not None:
+                self.file.write(data)
+            else:
+                self.parts.append(data)
+        except OSError as e:
+            print(f"Cache write error: {e}")
+            self.discard()
+
+    def finish(self):
+        # Возвращает тело в памяти или None, если тело записано в файл self.path
+        if self.file is not None:
+            self.file.close()
+            return None
+        return b''.join(self.parts)
+
+    def discard(self):
+        self.failed = True
+        self.parts = []
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+
+class HTTPCache:
+    def __init__(self, directory, memory_limit=CACHE_MEMORY_LIMIT, disk_limit=CACHE_DISK_LIMIT,
+                 max_object_size=CACHE_MAX_OBJECT_SIZE):
+        self.directory = directory
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.max_object_size = max_object_size
+        self.lock = threading.Lock()
+        # URL -> запись, в начале давно не использованные. Запись лежит в одном из двух словарей,
+        # смотря где ее тело: из памяти старые тела переезжают на диск, с диска - удаляются
+        self.memory = OrderedDict()
+        self.disk = OrderedDict()
+        self.memory_size = 0
+        self.disk_size = 0
+        # URL -> событие незавершенного запроса к серверу, его ждут совпавшие промахи
+        self.fills = {}
+        self.stats = Counter()
+        if disk_limit:
+            os.makedirs(directory, exist_ok=True)
+            # Индекс живет только в памяти, тела от прошлого запуска не нужны
+            for name in os.listdir(directory):
+                if name.endswith(('.body', '.tmp')):
+                    os.remove(os.path.join(directory, name))
+
+    def record(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def request_key(self, request, address, upstream_request):
+        # Ключ кэша - абсолютный URL; None, если запрос нельзя обслужить через кэш
+        method = upstream_request.start_line.split()[0]
+        key = request_url(address, upstream_request)
+        if method in UNSAFE_METHODS:
+            # Изменяющий запрос делает сохраненный ответ устаревшим (RFC 9111, 4.4)
+            self.invalidate(key)
+            return None
+        if method not in ('GET', 'HEAD') or not is_replayable(request) or request.get('Range') is not None:
+            return None
+        if 'no-store' in parse_cache_control(request):
+            return None
+        return key
+
+    def lookup(self, key, request):
+        with self.lock:
+            entry = self.memory.get(key) or self.disk.get(key)
+            if entry is None or any(request.get(name) != value for name, value in entry.vary.items()):
+                return None
+            body = entry.body
+            if entry.path is None:
+                self.memory.move_to_end(key)
+            else:
+                self.disk.move_to_end(key)
+                try:
+                    with open(entry.path, 'rb') as file:
+                        body = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                except (OSError, ValueError):
+                    self.remove(key)
+                    return None
+        return CachedResponse(entry, body, entry.is_fresh(time.time(), request_directives(request)))
+
+    def collapse(self, key, event_factory):
+        # Первый промах по URL получает новое событие и идет к серверу, остальные ждут его
+        with self.lock:
+            event = self.fills.get(key)
+            if event is not None:
+                return event, False
+            event = self.fills[key] = event_factory()
+            return event, True
+
+    def finish_fill(self, key, event):
+        # Отпускает ждущих. Лидер может отпустить их раньше конца своего запроса, тогда к этому времени
+        # у URL бывает уже новый лидер со своим событием - его не трогаем
+        with self.lock:
+            if self.fills.get(key) is event:
+                del self.fills[key]
+        event.set()
+
+    def temporary_file(self):
+        fd, path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        return open(fd, 'wb'), path
+
+    def body_path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + '.body')
+
+    def store(self, key, request, response, request_time, response_time, writer):
+        body = writer.finish()
+        if writer.failed:
+            return
+        entry = CacheEntry(key, request, response, request_time, response_time)
+        entry.size = writer.size
+        with self.lock:
+            self.remove(key)
+            if body is not None:
+                entry.body = body
+                self.memory[key] = entry
+                self.memory_size += entry.size
+            else:
+                entry.path = self.body_path(key)
+                os.replace(writer.path, entry.path)
+                writer.path = None
+                self.disk[key] = entry
+                self.disk_size += entry.size
+            self.stats['stored'] += 1
+            self.shrink()
+
+    def refresh(self, entry, response, request_time, response_time):
+        # Ответ 304 заменяет одноименные заголовки сохраненного ответа и обновляет его возраст (RFC 9111, 4.3.4)
+        names = {key.lower() for key, _ in response.headers}
+        headers = [(key, value) for key, value in entry.headers if key.lower() not in names] + response.headers
+        with self.lock:
+            entry.update(headers, request_time, response_time)
+            self.stats['revalidated'] += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            if self.remove(key) is not None:
+                self.stats['invalidated'] += 1
+
+    def remove(self, key):
+        # Вызывается под self.lock
+        entry = self.memory.pop(key, None)
+        if entry is not None:
+            self.memory_size -= entry.size
+            return entry
+        entry = self.disk.pop(key, None)
+        if entry is not None:
+            self.disk_size -= entry.size
+            # Уже отображенные в память копии файла остаются доступны до закрытия
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+        return entry
+
+    def shrink(self):
+        # Вызывается под self.lock
+        while self.memory_size > self.memory_limit:
+            key, entry = self.memory.popitem(last=False)
+            self.memory_size -= entry.size
+            if not self.disk_limit or not entry.size:
+                self.stats['evicted'] += 1
+                continue
+            path = self.body_path(key)
+            try:
+                with open(path, 'wb') as file:
+                    file.write(entry.body)
+            except OSError as e:
+                print(f"Cache write error: {e}")
+                self.stats['evicted'] += 1
+                continue
+            entry.body, entry.path = b'', path
+            self.disk[key] = entry
+            self.disk_size += entry.size
+            self.stats['moved_to_disk'] += 1
+
+        while self.disk_size > self.disk_limit:
+            key, entry = self.disk.popitem(last=False)
+            self.disk_size -= entry.size
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+            self.stats['evicted'] += 1
+
+    def snapshot(self):
+        # (счетчики, (объектов в памяти, байт), (объектов на диске, байт))
+        with self.lock:
+            return Counter(self.stats), (len(self.memory), self.memory_size), (len(self.disk), self.disk_size)
+
+    def print_stats(self):
+        stats, memory, disk = self.snapshot()
+        memory = memory[0], memory[1] / 1024 / 1024
+        disk = disk[0], disk[1] / 1024 / 1024
+        requests = stats['hits'] + stats['collapsed'] + stats['misses'] + stats['stale']
+        # Без полного ответа сервера обошлись попадания, дождавшиеся чужого запроса промахи и ответы 304
+        saved = stats['hits'] + stats['collapsed'] + stats['revalidated']
+        ratio = saved / requests * 100 if requests else 0
+        print(f"Cache: {requests} requests, {stats['hits']} hits, {stats['collapsed']} collapsed misses, "
+              f"{stats['misses']} misses, {stats['stale']} stale ({stats['revalidated']} revalidated), "
+              f"{ratio:.1f}% served without a full upstream response")
+        print(f"Cache store: {memory[0]} objects in memory ({memory[1]:.1f} MB), {disk[0]} on disk "
+              f"({disk[1]:.1f} MB), {stats['stored']} stored, {stats['moved_to_disk']} moved to disk, "
+              f"{stats['evicted']} evicted, {stats['invalidated']} invalidated")
+
+
+def cached_response(request, cached):
+    # Заголовок ответа из кэша. Возвращает (заголовок, отправлять ли тело, оставить ли соединение с клиентом)
+    method, _, protocol = request.start_line.split()
+    entry = cached.entry
+    client_keep_alive = keeps_alive(request, protocol)
+    headers = entry.headers + [('Age', str(int(entry.age(time.time()))))]
+    if is_not_modified(request, entry):
+        response = Message('HTTP/1.1 304 Not Modified',
+                           [(key, value) for key, value in headers if key.lower() in NOT_MODIFIED_HEADERS])
+        body = False
+    else:
+        response = Message(entry.status_line, headers)
+        body = has_body(method, entry.status)
+        if has_body('GET', entry.status):
+            response.set('Content-Length', str(entry.size))
+    response.set('Connection', 'keep-alive' if client_keep_alive else 'close')
+    return response, body, client_keep_alive
+
+
+# Туннели CONNECT (RFC 9110, 9.3.6): после ответа 200 прокси только перекладывает байты в обе стороны
+TUNNEL_BUFFER_SIZE = 256 * 1024
+TUNNEL_IDLE_TIMEOUT = 300
+# splice переносит данные из сокета в канал и из канала в сокет внутри ядра, не копируя их в память
+# процесса (только Linux); иначе - recv_into в один переиспользуемый буфер
+TUNNEL_RELAYS = ['splice', 'copy'] if hasattr(os, 'splice') else ['copy']
+CONNECTION_ESTABLISHED = b'HTTP/1.1 200 Connection Established\r\n\r\n'
+
+
+def parse_authority(target):
+    # Цель CONNECT - host:port (RFC 9110, 9.3.6), IPv6 адрес в квадратных скобках. None, если цель неверна
+    host, _, port = target.rpartition(':')
+    host = host[1:-1] if host.startswith('[') and host.endswith(']') else host
+    if not host or not port.isdigit() or not 0 < int(port) < 65536:
+        return None
+    return host.lower(), int(port)
+
+
+def tunnel_url(address):
+    return f'https://{address[0]}:{address[1]}/'
+
+
+class SpliceChannel:
+    # Одно направление туннеля через канал ядра
+    def __init__(self, source, destination):
+        self.source = source
+        self.destination = destination
+        self.read_end, self.write_end = os.pipe()
+        if hasattr(fcntl, 'F_SETPIPE_SZ'):
+            try:
+                fcntl.fcntl(self.write_end, fcntl.F_SETPIPE_SZ, TUNNEL_BUFFER_SIZE)
+            except OSError:
+                pass  # Больше /proc/sys/fs/pipe-max-size без прав не дадут, остается 64 КБ
+        self.pending = 0
+        self.eof = False
+        self.shut = False
+        self.transferred = 0
+
+    def receive(self):
+        try:
+            count = os.splice(self.source.fileno(), self.write_end, TUNNEL_BUFFER_SIZE,
+                              flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        except BlockingIOError:
+            return
+        self.eof = not count
+        self.pending += count
+        self.transferred += count
+
+    def send(self):
+        try:
+            self.pending -= os.splice(self.read_end, self.destination.fileno(), self.pending,
+                                      flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self.read_end)
+        os.close(self.write_end)
+
+
+class CopyChannel:
+    # Одно направление туннеля через буфер процесса: recv_into не создает новых объектов на каждую порцию
+    def __init__(self, source, destination):
+        self.source = source
+        self.destination = destination
+        self.buffer = memoryview(bytearray(TUNNEL_BUFFER_SIZE))
+        self.start = 0
+        self.pending = 0
+        self.eof = False
+        self.shut = False
+        self.transferred = 0
+
+    def receive(self):
+        try:
+            count = self.source.recv_into(self.buffer)
+        except BlockingIOError:
+            return
+        self.eof = not count
+        self.start = 0
+        self.pending = count
+        self.transferred += count
+
+    def send(self):
+        try:
+            count = self.destination.send(self.buffer[self.start:self.start + self.pending])
+        except BlockingIOError:
+            return
+        self.start += count
+        self.pending -= count
+
+    def close(self):
+        self.buffer.release()
+
+
+class Tunnel:
+    # Обе стороны туннеля в неблокирующем режиме. Ожиданием событий занимается вызывающий код:
+    # interest() говорит, каких событий ждать, readable()/writable() их обрабатывают
+    def __init__(self, client, upstream, address, relay):
+        self.client = client
+        self.upstream = upstream
+        self.address = address
+        for sock in (client, upstream):
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        channel = SpliceChannel if relay == 'splice' else CopyChannel
+        self.upload = channel(client, upstream)
+        self.download = channel(upstream, client)
+        self.channels = (self.upload, self.download)
+        self.started = time.monotonic()
+
+    @property
+    def done(self):
+        return all(channel.shut for channel in self.channels)
+
+    def interest(self):
+        # (сокеты, которых ждем на чтение, сокеты, которых ждем на запись)
+        readers = [channel.source for channel in self.channels if not channel.eof and not channel.pending]
+        writers = [channel.destination for channel in self.channels if channel.pending]
+        return readers, writers
+
+    def readable(self, sock):
+        for channel in self.channels:
+            if channel.source is sock and not channel.eof and not channel.pending:
+                channel.receive()
+                if channel.pending:
+                    channel.send()
+                self.check(channel)
+
+    def writable(self, sock):
+        for channel in self.channels:
+            if channel.destination is sock and channel.pending:
+                channel.send()
+                self.check(channel)
+
+    def check(self, channel):
+        # Конец данных с одной стороны передаем другой, второе направление продолжает работать
+        if channel.eof and not channel.pending and not channel.shut:
+            channel.shut = True
+            try:
+                channel.destination.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    def close(self):
+        for channel in self.channels:
+            channel.close()
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        up, down = self.upload.transferred / 1024 / 1024, self.download.transferred / 1024 / 1024
+        print(f"Tunnel {self.address[0]}:{self.address[1]}: {up:.2f} MB up, {down:.2f} MB down "
+              f"in {elapsed:.1f} s ({(up + down) / elapsed:.1f} MB/s)")
+
+
+def relay_tunnel(tunnel):
+    # Один поток обслуживает оба направления через poll
+    poller = select.poll()
+    sockets = {sock.fileno(): sock for sock in (tunnel.client, tunnel.upstream)}
+    registered = {}
+    while not tunnel.done:
+        readers, writers = tunnel.interest()
+        for fd, sock in sockets.items():
+            mask = (select.POLLIN if sock in readers else 0) | (select.POLLOUT if sock in writers else 0)
+            if registered.get(fd, 0) == mask:
+                continue
+            # Сокет без интересующих событий снимаем с учета, иначе POLLHUP будет будить poll впустую
+            if mask:
+                poller.register(fd, mask)
+            else:
+                poller.unregister(fd)
+            registered[fd] = mask
+        events = poller.poll(TUNNEL_IDLE_TIMEOUT * 1000)
+        if not events:
+            break  # Туннель простаивает слишком долго
+        for fd, event in events:
+            if event & select.POLLOUT:
+                tunnel.writable(sockets[fd])
+            if event & (select.POLLIN | select.POLLHUP | select.POLLERR):
+                tunnel.readable(sockets[fd])
+
+
+async def async_relay_tunnel(tunnel):
+    # Те же сокеты под наблюдением цикла событий вместо poll
+    loop = asyncio.get_running_loop()
+    finished = loop.create_future()
+    registered = set()
+    activity = [time.monotonic()]
+
+    def update():
+        if tunnel.done:
+            if not finished.done():
+                finished.set_result(None)
+            return
+        readers, writers = tunnel.interest()
+        for sock in (tunnel.client, tunnel.upstream):
+            for kind, wanted, add, remove, handler in (
+                    ('r', sock in readers, loop.add_reader, loop.remove_reader, tunnel.readable),
+                    ('w', sock in writers, loop.add_writer, loop.remove_writer, tunnel.writable)):
+                key = (sock.fileno(), kind)
+                if wanted and key not in registered:
+                    add(sock.fileno(), on_event, handler, sock)
+                    registered.add(key)
+                elif not wanted and key in registered:
+                    remove(sock.fileno())
+                    registered.discard(key)
+
+    def on_event(handler, sock):
+        activity[0] = time.monotonic()
+        try:
+            handler(sock)
+        except OSError as e:
+            if not finished.done():
+                finished.set_exception(e)
+            return
+        update()
+
+    update()
+    try:
+        while not finished.done():
+            try:
+                await asyncio.wait_for(asyncio.shield(finished), TUNNEL_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                if time.monotonic() - activity[0] >= TUNNEL_IDLE_TIMEOUT:
+                    break  # Туннель простаивает слишком долго
+        if finished.done():
+            finished.result()
+    finally:
+        for fd, kind in registered:
+            (loop.remove_reader if kind == 'r' else loop.remove_writer)(fd)
+
+
+# Метрики запросов - гистограммы в формате Prometheus, их отдает /__stats. Каждый поток пишет в свой
+# набор без блокировок и только дописывает значения в списки; по корзинам они раскладываются пачками
+STATS_PATH = '/__stats'
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = tuple(256 * 4 ** power for power in range(10))
+HISTOGRAMS = (
+    ('proxy_request_duration_seconds', 'From the request head to the end of the response', LATENCY_BUCKETS),
+    ('proxy_upstream_dns_seconds', 'Upstream host name resolution for new connections', LATENCY_BUCKETS),
+    ('proxy_upstream_connect_seconds', 'Upstream TCP connect for new connections', LATENCY_BUCKETS),
+    ('proxy_upstream_ttfb_seconds', 'From sending the request upstream to the response head', LATENCY_BUCKETS),
+    ('proxy_rewrite_seconds', 'Decoding, ad removal and re-encoding of a response body', LATENCY_BUCKETS),
+    ('proxy_response_bytes', 'Bytes sent to the client per response', SIZE_BUCKETS),
+)
+REQUEST_DURATION, UPSTREAM_DNS, UPSTREAM_CONNECT, UPSTREAM_TTFB, REWRITE, RESPONSE_BYTES = range(len(HISTOGRAMS))
+# Номер корзины для значения; map с ним раскладывает пачку без цикла на Python
+BUCKET_INDEX = [partial(bisect_left, buckets) for _, _, buckets in HISTOGRAMS]
+# Через столько запросов значения набора раскладываются по корзинам: память набора ограничена,
+# а цена раскладки делится на всю пачку
+FOLD_SIZE = 1024
+
+
+def add_values(counts, sums, values):
+    for index, batch in enumerate(values):
+        if batch:
+            bucket_counts = counts[index]
+            for position, number in Counter(map(BUCKET_INDEX[index], batch)).items():
+                bucket_counts[position] += number
+            sums[index] += sum(batch)
+
+
+class MetricShard:
+    # Набор одного потока: значения, еще не разложенные по корзинам, и корзины без накопления,
+    # последняя - больше всех границ. Блокировку берут только раскладка пачки и чтение метрик,
+    # чтобы читатель видел каждое значение ровно один раз: либо в списке, либо в корзине
+    def __init__(self):
+        self.counts = [[0] * (len(buckets) + 1) for _, _, buckets in HISTOGRAMS]
+        self.sums = [0.0] * len(HISTOGRAMS)
+        self.values = [[] for _ in HISTOGRAMS]
+        self.lock = threading.Lock()
+
+    def observe(self, index, value):
+        self.values[index].append(value)
+
+    def upstream(self, connection, started):
+        # Время до заголовка ответа, а для нового соединения - еще DNS и connect
+        values = self.values
+        values[UPSTREAM_TTFB].append(time.perf_counter() - started)
+        if connection.setup:
+            dns, connect = connection.setup
+            connection.setup = None
+            values[UPSTREAM_DNS].append(dns)
+            values[UPSTREAM_CONNECT].append(connect)
+
+    def record(self, duration, size):
+        # Конец запроса: длительность и число байт, отправленных клиенту
+        values = self.values
+        values[REQUEST_DURATION].append(duration)
+        values[RESPONSE_BYTES].append(size)
+        if len(values[REQUEST_DURATION]) >= FOLD_SIZE:
+            self.fold()
+
+    def fold(self):
+        with self.lock:
+            values, self.values = self.values, [[] for _ in HISTOGRAMS]
+            add_values(self.counts, self.sums, values)
+
+    def snapshot(self):
+        # Пишущий поток дописывает списки и без блокировки; копия списка под GIL атомарна
+        with self.lock:
+            counts = [list(bucket_counts) for bucket_counts in self.counts]
+            sums = list(self.sums)
+            values = [list(batch) for batch in self.values]
+        add_values(counts, sums, values)
+        return counts, sums
+
+
+class Metrics:
+    def __init__(self):
+        self.shards = []
+        self.free = []
+
+    def acquire(self):
+        # Поток берет набор на время соединения; pop и append списка атомарны, блокировка не нужна.
+        # Наборов столько, сколько соединений обслуживалось одновременно
+        try:
+            return self.free.pop()
+        except IndexError:
+            shard = MetricShard()
+            self.shards.append(shard)
+            return shard
+
+    def release(self, shard):
+        self.free.append(shard)
+
+    def render(self):
+        lines = []
+        snapshots = [shard.snapshot() for shard in list(self.shards)]
+        for index, (name, description, buckets) in enumerate(HISTOGRAMS):
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} histogram']
+            cumulative = 0
+            for position, bound in enumerate(buckets + ('+Inf',)):
+                cumulative += sum(counts[index][position] for counts, _ in snapshots)
+                lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum {sum(sums[index] for _, sums in snapshots)}')
+            lines.append(f'{name}_count {cumulative}')
+        return lines
+
+
+def render_stats(metrics, pool, cache):
+    # Текст для /__stats в формате Prometheus: гистограммы запросов и счетчики пула и кэша
+    lines = metrics.render() if metrics else []
+    stats, idle = pool.snapshot()
+    lines += ['# HELP proxy_pool_events_total Upstream pool, client and tunnel counters',
+              '# TYPE proxy_pool_events_total counter']
+    lines += [f'proxy_pool_events_total{{event="{name}"}} {value}' for name, value in sorted(stats.items())]
+    lines += ['# HELP proxy_pool_idle_connections Idle upstream connections',
+              '# TYPE proxy_pool_idle_connections gauge', f'proxy_pool_idle_connections {idle}']
+    if cache:
+        stats, memory, disk = cache.snapshot()
+        lines += ['# HELP proxy_cache_events_total Response cache counters', '# TYPE proxy_cache_events_total counter']
+        lines += [f'proxy_cache_events_total{{event="{name}"}} {value}' for name, value in sorted(stats.items())]
+        lines += ['# HELP proxy_cache_objects Cached responses', '# TYPE proxy_cache_objects gauge',
+                  f'proxy_cache_objects{{store="memory"}} {memory[0]}', f'proxy_cache_objects{{store="disk"}} {disk[0]}',
+                  '# HELP proxy_cache_bytes Size of cached bodies', '# TYPE proxy_cache_bytes gauge',
+                  f'proxy_cache_bytes{{store="memory"}} {memory[1]}', f'proxy_cache_bytes{{store="disk"}} {disk[1]}']
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def is_stats_request(request):
+    # Запрос к самому прокси (не через него) - путь без схемы и хоста
+    method, target, _ = request.start_line.split()
+    return method in ('GET', 'HEAD') and target.split('?', 1)[0] == STATS_PATH
+
+
+def stats_response(request, body):
+    # Возвращает (ответ, оставить ли соединение с клиентом)
+    method, _, protocol = request.start_line.split()
+    client_keep_alive = keeps_alive(request, protocol)
+    head = Message('HTTP/1.1 200 OK', [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'),
+                                       ('Content-Length', str(len(body))), ('Cache-Control', 'no-store'),
+                                       ('Connection', 'keep-alive' if client_keep_alive else 'close')])
+    return head.encode() + (body if method != 'HEAD' else b''), client_keep_alive
+
+
+class ClientWriter:
+    # Сокет клиента со счетчиком отправленных байт для метрик
+    def __init__(self, sock):
+        self.sock = sock
+        self.sent = 0
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+        self.sent += len(data)
+
+
+BAD_REQUEST = b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+BAD_GATEWAY = b'HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+BLOCKED = b'HTTP/1.1 403 Forbidden\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
 
 
 class ProxyHandler(BaseRequestHandler):
-    def handle_request(self, host, port, request):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as target_sock:
-            target_sock.settimeout(5)
-            target_sock.connect((host, port))
-            target_sock.sendall(request)
+    def send(self, data):
+        self.responded = True
+        self.client.sendall(data)
+
+    def exchange(self, address, upstream_request, request, client_reader):
+        # Отправляет запрос и читает заголовок ответа. Соединение из пула могло быть закрыто сервером,
+        # тогда запрос без тела один раз повторяется на новом соединении
+        pool = self.server.pool
+        for attempt in range(2):
+            connection = pool.acquire(address)
+            try:
+                started = time.perf_counter()
+                connection.sock.sendall(upstream_request.encode())
+                relay_body(request, client_reader, connection.sock, until_close=False)
+                response = read_message_head(connection.reader)
+                if response is None:
+                    raise ConnectionError("Upstream closed the connection without a response")
+                if self.shard:
+                    self.shard.upstream(connection, started)
+                return connection, response
+            except OSError as e:
+                # release увеличивает счетчик запросов и у закрываемого соединения, поэтому смотрим до него:
+                # повтор нужен, только если сервер закрыл соединение из пула, новое соединение не повторяем
+                reused = connection.requests > 0
+                pool.release(connection, address, False)
+                if attempt or not reused or not is_replayable(request) or isinstance(e, socket.timeout):
+                    raise
+                pool.record('retries')
+
+    def send_rewritten(self, response, reader, rewriter, chunked):
+        frame = encode_chunk if chunked else bytes
+        # Время правки без ожидания сети
+        spent = 0.0
+        for part in body_parts(response, reader):
+            started = time.perf_counter()
+            data = frame(rewriter.feed(part))
+            spent += time.perf_counter() - started
+            if data:
+                self.client.sendall(data)
+        started = time.perf_counter()
+        data = frame(rewriter.close()) + (LAST_CHUNK if chunked else b'')
+        spent += time.perf_counter() - started
+        self.client.sendall(data)
+        if self.shard:
+            self.shard.observe(REWRITE, spent)
+
+    def send_cached(self, request, cached):
+        response, body, client_keep_alive = cached_response(request, cached)
+        self.send(response.encode())
+        if body:
+            for part in cached.chunks():
+                self.client.sendall(part)
+        return client_keep_alive
+
+    def send_stats(self, request):
+        data, client_keep_alive = stats_response(
+            request, render_stats(self.server.metrics, self.server.pool, self.server.cache))
+        self.send(data)
+        return client_keep_alive
+
+    def tunnel(self, request, client_reader):
+        address = parse_authority(request.start_line.split()[1])
+        if address is None:
+            self.send(BAD_REQUEST)
+            return False
+        if self.server.filters.current().blocks(tunnel_url(address)):
+            self.send(BLOCKED)
+            return False
+
+        upstream = socket.create_connection(address, UPSTREAM_TIMEOUT)
+        try:
+            self.send(CONNECTION_ESTABLISHED)
+            if client_reader.buffer:
+                # Клиент мог прислать данные, не дожидаясь ответа на CONNECT
+                upstream.sendall(client_reader.buffer)
+                client_reader.buffer = b''
+            tunnel = Tunnel(self.request, upstream, address, self.server.tunnel_relay)
+            try:
+                relay_tunnel(tunnel)
+            finally:
+                tunnel.close()
+                self.server.pool.record_tunnel(tunnel)
+        finally:
+            upstream.close()
+        return False
+
+    def handle_request(self, request, client_reader):
+        # Возвращает True, если соединение с клиентом можно использовать для следующего запроса
+        kind = classify_request(request)
+        if kind is None:
+            self.send(BAD_REQUEST)
+            return False
+        if kind == TUNNEL:
+            # Туннель живет долго, в гистограммы запросов его не записываем
+            self.shard = None
+            return self.tunnel(request, client_reader)
+        if kind == STATS:
+            self.shard = None
+            return self.send_stats(request)
+        address, upstream_request = prepare_request(request)
+        if self.server.filters.current().blocks(request_url(address, upstream_request)):
+            # Запрос на адрес из правил блокировки до сервера не доходит
+            self.send(BLOCKED)
+            return False
+
+        cache = self.server.cache
+        key = cache and cache.request_key(request, address, upstream_request)
+        if not key:
+            return self.forward(address, upstream_request, request, client_reader)
+
+        cached = cache.lookup(key, request)
+        leader = False
+        try:
+            if cached and cached.fresh:
+                cache.record('hits')
+                return self.send_cached(request, cached)
 
-            response = b''
+            fill, leader = cache.collapse(key, threading.Event)
+            if not leader:
+                # Этот URL уже запрошен у сервера, ждем ответа и пробуем взять его из кэша
+                fill.wait(UPSTREAM_TIMEOUT)
+                if cached:
+                    cached.close()
+                cached = cache.lookup(key, request)
+                if cached and cached.fresh:
+                    cache.record('collapsed')
+                    return self.send_cached(request, cached)
+            cache.record('stale' if cached else 'misses')
+            return self.forward(address, upstream_request, request, client_reader, key, cached,
+                                fill if leader else None)
+        finally:
+            if cached:
+                cached.close()
+            if leader:
+                cache.finish_fill(key, fill)
+
+    def forward(self, address, upstream_request, request, client_reader, key=None, cached=None, fill=None):
+        # fill - событие, которого ждут совпавшие промахи, если этот запрос их лидер. Ждать тела им имеет
+        # смысл, только если оно попадет в кэш, поэтому они отпускаются, как только это ясно по заголовку
+        cache = self.server.cache
+        revalidating = cached is not None and add_validators(upstream_request, cached.entry)
+        request_time = time.time()
+        connection, response = self.exchange(address, upstream_request, request, client_reader)
+        reusable = revalidated = False
+        sink = None
+        try:
+            while is_informational(response):
+                # Промежуточные ответы 1xx передаем клиенту и ждем окончательный
+                self.send(response.encode())
+                response = read_message_head(connection.reader)
+                if response is None:
+                    raise ConnectionError("Upstream closed the connection without a response")
+            response_time = time.time()
+
+            if revalidating and response.start_line.split()[1] == '304':
+                # Сервер подтвердил сохраненный ответ, тело отдадим из кэша
+                reusable = keeps_alive(response, response.start_line.split()[0])
+                response.remove_hop_by_hop()
+                cache.refresh(cached.entry, response, request_time, response_time)
+                revalidated = True
+                if fill:
+                    cache.finish_fill(key, fill)
+            else:
+                rules = rewrite_rules(response, self.server.filters.current(), address[0])
+                stored = None
+                if key and not rules and is_storable(request, response):
+                    stored = Message(response.start_line, list(response.headers))
+                    stored.remove_hop_by_hop()
+                    sink = CacheWriter(cache)
+                elif fill:
+                    # Ответ не сохранится: ждущие сразу идут к серверу сами
+                    cache.finish_fill(key, fill)
+
+                body, upstream_keep_alive, client_keep_alive = prepare_response(request, response)
+                if not body:
+                    self.send(response.encode())
+                elif rules:
+                    # HTML определённых хостов правим на лету, не собирая документ целиком;
+                    # сжатое тело распаковываем и сжимаем заново
+                    upstream_framing = Message(response.start_line, list(response.headers))
+                    rewriter = body_rewriter(request, response, rules, request_url(address, upstream_request),
+                                             self.server.codings)
+                    chunked, client_keep_alive = prepare_streamed_body(request, response)
+                    self.send(response.encode())
+                    self.send_rewritten(upstream_framing, connection.reader, rewriter, chunked)
+                else:
+                    # Остальное тело пересылаем по мере получения, не держа его в памяти целиком;
+                    # копия для кэша пишется параллельно
+                    self.send(response.encode())
+                    relay_body(response, connection.reader, self.client, until_close=True, sink=sink)
+                if stored:
+                    cache.store(key, request, stored, request_time, response_time, sink)
+                reusable = upstream_keep_alive
+        finally:
+            self.server.pool.release(connection, address, reusable)
+            if sink:
+                sink.discard()
+
+        if revalidated:
+            return self.send_cached(request, cached)
+        return client_keep_alive
+
+    def handle(self):
+        pool = self.server.pool
+        metrics = self.server.metrics
+        pool.record('client_connections')
+        self.request.settimeout(CLIENT_IDLE_TIMEOUT)
+        # Заголовок и тело ответа уходят разными вызовами; с алгоритмом Нейгла второй ждал бы
+        # отложенного подтверждения клиента (до 40 мс). Транспорты asyncio отключают его сами
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client_reader = SocketReader(self.request)
+        self.client = ClientWriter(self.request)
+        self.responded = False
+        shard = metrics.acquire() if metrics else None
+        try:
             while True:
                 try:
-                    part = target_sock.recv(4096)
-                    if not part:
-                        break
-                    response += part
+                    request = read_message_head(client_reader)
                 except socket.timeout:
+                    break  # Клиент простаивает слишком долго
+                if not request:
                     break
-        return response
 
-    def process_response(self, response, host):
+                pool.record('client_requests')
+                self.responded = False
+                # Запрос пишет в набор, только если его не отключил обработчик (туннель, /__stats)
+                self.shard = shard
+                if shard:
+                    started, sent = time.perf_counter(), self.client.sent
+                keep_alive = self.handle_request(request, client_reader)
+                if self.shard:
+                    shard.record(time.perf_counter() - started, self.client.sent - sent)
+                if not keep_alive:
+                    break
+        except Exception as e:
+            print(f"Error handling request: {e}")
+            pool.record('errors')
+            if not self.responded:
+                try:
+                    self.request.sendall(BAD_GATEWAY)
+                except OSError:
+                    pass
+        finally:
+            if shard:
+                metrics.release(shard)
+
+
+# Асинхронный режим: все соединения обслуживает один поток с циклом событий
+class AsyncStream:
+    # Обертка над парой asyncio потоков с тем же набором операций, что у SocketReader и сокета.
+    # Запись ждет drain(), так что медленный получатель притормаживает чтение с другой стороны.
+    # asyncio.wait_for на каждую операцию слишком дорог, поэтому операция только запоминает свой срок,
+    # а просроченные соединения раз в секунду обрывает сторож AsyncProxyServer.watch_timeouts
+    def __init__(self, reader, writer, timeout):
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.deadline = None
+        self.timed_out = False
+        self.responded = False
+        # Для метрик: отправлено байт и набор, в который пишет текущий запрос клиента
+        self.sent = 0
+        self.shard = None
+
+    async def wait(self, operation, timeout=None):
+        self.deadline = time.monotonic() + (timeout or self.timeout)
         try:
-            headers_end = response.find(b'\r\n\r\n')
-            headers_part = response[:headers_end + 4] if headers_end != -1 else response
-            body = response[headers_end + 4:] if headers_end != -1 else b''
+            return await operation
+        finally:
+            self.deadline = None
+            if self.timed_out:
+                raise TimeoutError("Connection timed out")
 
-            headers = headers_part.decode('latin-1').split('\r\n')
-            content_type = next((h.split(': ')[1] for h in headers if h.lower().startswith('content-type:')), None)
+    def abort(self):
+        self.timed_out = True
+        self.writer.transport.abort()
 
-            if content_type and 'text/html' in content_type[0]:
-                soup = BeautifulSoup(body.decode('utf-8', errors='ignore'), 'html.parser')
+    async def read_head(self, timeout=None):
+        try:
+            head = await self.wait(self.reader.readuntil(b'\r\n\r\n'), timeout)
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise ConnectionError("Connection closed in the middle of a message")
+            return None
+        except asyncio.LimitOverrunError:
+            raise ValueError("Header section is too large")
+        return parse_message_head(head)
 
-                # Удаляем рекламные элементы
-                for tag in soup.find_all(['img', 'script', 'iframe']):
-                    if host == 'e1.ru' and 'ad' in tag.get('class', []):
-                        tag.decompose()
-                    elif host == 'vk.com' and tag.name == 'img':
-                        tag.decompose()
+    async def read_line(self):
+        try:
+            return await self.wait(self.reader.readuntil(b'\r\n'))
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("Connection closed in the middle of a message")
 
-                modified_body = str(soup).encode('utf-8')
-                content_length = len(modified_body)
+    async def read(self, size):
+        return await self.wait(self.reader.read(min(size, CHUNK_SIZE)))
 
-                # Обновляем заголовки
-                new_headers = []
-                for h in headers:
-                    if h.lower().startswith('content-length'):
-                        new_headers.append(f'Content-Length: {content_length}')
-                    else:
-                        new_headers.append(h)
+    async def sendall(self, data):
+        self.responded = True
+        self.writer.write(data)
+        self.sent += len(data)
+        await self.wait(self.writer.drain())
 
-                return '\r\n'.join(new_headers).encode('latin-1') + modified_body
-        except Exception as e:
-            print(f"Processing error: {e}")
-        return response
+    def close(self):
+        self.writer.close()
 
-    def handle(self):
+
+def detach_socket(stream):
+    # Забирает сокет у транспорта asyncio для туннеля: транспорт перестает читать,
+    # а копия дескриптора работает с сокетом напрямую
+    stream.writer.transport.pause_reading()
+    sock = stream.writer.get_extra_info('socket')
+    detached = socket.fromfd(sock.fileno(), sock.family, sock.type)
+    detached.setblocking(False)
+    return detached
+
+
+async def async_relay_fixed(reader, writer, length, sink=None):
+    while length > 0:
+        part = await reader.read(min(length, CHUNK_SIZE))
+        if not part:
+            raise ConnectionError("Connection closed before the end of the body")
+        if writer:
+            await writer.sendall(part)
+        if sink:
+            sink.write(part)
+        length -= len(part)
+
+
+async def async_relay_chunked(reader, writer, sink=None):
+    while True:
+        line = await reader.read_line()
+        if writer:
+            await writer.sendall(line)
+        size = int(line.split(b';', 1)[0].strip(), 16)
+        if size == 0:
+            break
+        await async_relay_fixed(reader, writer, size, sink)
+        line = await reader.read_line()
+        if writer:
+            await writer.sendall(line)
+
+    while True:
+        line = await reader.read_line()
+        if writer:
+            await writer.sendall(line)
+        if line == b'\r\n':
+            break
+
+
+async def async_relay_until_close(reader, writer, sink=None):
+    while True:
+        part = await reader.read(CHUNK_SIZE)
+        if not part:
+            break
+        if writer:
+            await writer.sendall(part)
+        if sink:
+            sink.write(part)
+
+
+async def async_relay_body(message, reader, writer, until_close, sink=None):
+    if message.is_chunked():
+        await async_relay_chunked(reader, writer, sink)
+    elif message.content_length() is not None:
+        await async_relay_fixed(reader, writer, message.content_length(), sink)
+    elif until_close:
+        await async_relay_until_close(reader, writer, sink)
+
+
+async def async_fixed_parts(reader, length):
+    while length > 0:
+        part = await reader.read(min(length, CHUNK_SIZE))
+        if not part:
+            raise ConnectionError("Connection closed before the end of the body")
+        yield part
+        length -= len(part)
+
+
+async def async_body_parts(message, reader):
+    if message.is_chunked():
+        while True:
+            size = int((await reader.read_line()).split(b';', 1)[0].strip(), 16)
+            if size == 0:
+                break
+            async for part in async_fixed_parts(reader, size):
+                yield part
+            await reader.read_line()
+        while await reader.read_line() != b'\r\n':
+            pass
+    elif message.content_length() is not None:
+        async for part in async_fixed_parts(reader, message.content_length()):
+            yield part
+    else:
+        while True:
+            part = await reader.read(CHUNK_SIZE)
+            if not part:
+                break
+            yield part
+
+
+async def async_open_upstream(address):
+    # То же, что asyncio.open_connection, но с отдельным временем разрешения имени и подключения.
+    # Возвращает (reader, writer, (секунд на DNS, секунд на подключение))
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    try:
+        # getaddrinfo цикла событий всегда уходит в пул потоков, для IP адреса это лишний круг
+        ipaddress.ip_address(address[0])
+        addresses = [address]
+    except ValueError:
+        addresses = [info[4][:2] for info in await loop.getaddrinfo(*address, type=socket.SOCK_STREAM)]
+    resolved = time.perf_counter()
+    error = None
+    for host, port in addresses:
         try:
-            data = self.request.recv(4096)
-            if not data:
-                return
+            reader, writer = await asyncio.open_connection(host, port, limit=MAX_HEAD_SIZE)
+            return reader, writer, (resolved - started, time.perf_counter() - resolved)
+        except OSError as e:
+            error = e
+    raise error or OSError(f"Cannot resolve {address[0]}")
 
-            first_line = data.split(b'\r\n')[0].decode()
-            method, url, protocol = first_line.split()
-            parsed_url = urlparse(url)
-
-            host = parsed_url.hostname
-            port = parsed_url.port or 80
-            path = parsed_url.path + ('?' + parsed_url.query if parsed_url.query else '')
-
-            # Модифицируем запрос
-            new_request = b'\r\n'.join([
-                f'{method} {path} {protocol}'.encode(),
-                b'\r\n'.join([
-                    h.encode() for h in data.decode().split('\r\n')[1:]
-                    if not h.lower().startswith('host:') and h.strip()
-                ]),
-                f'Host: {host}'.encode(),
-                b''
-            ]) + b'\r\n'
-
-            # Получаем ответ
-            response = self.handle_request(host, port, new_request)
-
-            # Обрабатываем ответ для определённых хостов
-            if host in ['e1.ru', 'vk.com']:
-                response = self.process_response(response, host)
-
-            self.request.sendall(response)
+
+class AsyncUpstreamConnection(AsyncStream):
+    def __init__(self, address, reader, writer, setup):
+        super().__init__(reader, writer, UPSTREAM_TIMEOUT)
+        self.address = address
+        self.setup = setup
+        self.requests = 0
+        self.last_used = time.monotonic()
+
+    def is_stale(self, current_time):
+        # Закрытие соединения сервером цикл событий уже обработал, пока соединение простаивало
+        return (current_time - self.last_used > POOL_IDLE_TIMEOUT or self.reader.at_eof()
+                or self.writer.is_closing())
+
+
+class AsyncUpstreamPool(UpstreamPool):
+    # Те же ограничения и счетчики, что у UpstreamPool; вместо блокировок - семафор на хост
+    def __init__(self, streams, max_idle_per_host=POOL_MAX_IDLE_PER_HOST, max_per_host=POOL_MAX_PER_HOST):
+        super().__init__(max_idle_per_host, max_per_host)
+        self.slots = defaultdict(lambda: asyncio.Semaphore(self.max_per_host))
+        # Все открытые соединения, за их сроками следит сторож сервера
+        self.streams = streams
+
+    async def acquire(self, address):
+        try:
+            await asyncio.wait_for(self.slots[address].acquire(), UPSTREAM_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"No free connection to {address[0]}:{address[1]}")
+
+        idle = self.idle[address]
+        current_time = time.monotonic()
+        while idle:
+            connection = idle.pop()
+            if connection.is_stale(current_time):
+                self.stats['stale'] += 1
+                self.discard(connection)
+                continue
+            self.stats['reused'] += 1
+            return connection
+
+        try:
+            reader, writer, setup = await asyncio.wait_for(async_open_upstream(address), UPSTREAM_TIMEOUT)
+        except BaseException:
+            self.slots[address].release()
+            raise
+        self.stats['created'] += 1
+        connection = AsyncUpstreamConnection(address, reader, writer, setup)
+        self.streams.add(connection)
+        return connection
+
+    def discard(self, connection):
+        self.streams.discard(connection)
+        connection.close()
+
+    def release(self, connection, address, reusable):
+        self.slots[address].release()
+        connection.requests += 1
+        connection.last_used = time.monotonic()
+        idle = self.idle[address]
+        if reusable and len(idle) < self.max_idle_per_host:
+            idle.append(connection)
+        else:
+            self.discard(connection)
+
+
+class AsyncProxyServer:
+    def __init__(self, max_clients, cache=None, filters=None, codings=None, tunnel_relay=None, metrics=None):
+        self.streams = set()
+        self.pool = AsyncUpstreamPool(self.streams)
+        self.cache = cache
+        self.filters = filters or FilterFile()
+        self.codings = codings or ContentCodings()
+        self.tunnel_relay = tunnel_relay or TUNNEL_RELAYS[0]
+        self.metrics = metrics
+        # Все запросы обслуживает один поток, ему хватит одного набора счетчиков
+        self.shard = metrics.acquire() if metrics else None
+        # Сверх лимита соединения принимаются, но ждут своей очереди
+        self.clients = asyncio.Semaphore(max_clients)
+
+    async def in_cache(self, function, *args):
+        # С дисковым уровнем вызовы кэша открывают, отображают в память, переименовывают и удаляют файлы,
+        # поэтому уходят в пул потоков и не останавливают цикл событий; кэшу это безопасно, он под блокировкой.
+        # Только в памяти вызов короче переключения потоков и делается на месте. Тело во временный файл
+        # CacheWriter пишет по ходу пересылки небольшими порциями в буфер ОС - это остается в цикле
+        if self.cache.disk_limit:
+            return await asyncio.to_thread(function, *args)
+        return function(*args)
+
+    async def exchange(self, address, upstream_request, request, client):
+        for attempt in range(2):
+            connection = await self.pool.acquire(address)
+            try:
+                started = time.perf_counter()
+                await connection.sendall(upstream_request.encode())
+                await async_relay_body(request, client, connection, until_close=False)
+                response = await connection.read_head()
+                if response is None:
+                    raise ConnectionError("Upstream closed the connection without a response")
+                if client.shard:
+                    client.shard.upstream(connection, started)
+                return connection, response
+            except OSError as e:
+                # release увеличивает счетчик запросов и у закрываемого соединения, поэтому смотрим до него:
+                # повтор нужен, только если сервер закрыл соединение из пула, новое соединение не повторяем
+                reused = connection.requests > 0
+                self.pool.release(connection, address, False)
+                if attempt or not reused or not is_replayable(request) or isinstance(e, TimeoutError):
+                    raise
+                self.pool.stats['retries'] += 1
+
+    async def send_rewritten(self, response, reader, rewriter, chunked, client):
+        frame = encode_chunk if chunked else bytes
+        spent = 0.0
+        async for part in async_body_parts(response, reader):
+            started = time.perf_counter()
+            data = frame(rewriter.feed(part))
+            spent += time.perf_counter() - started
+            if data:
+                await client.sendall(data)
+        started = time.perf_counter()
+        data = frame(rewriter.close()) + (LAST_CHUNK if chunked else b'')
+        spent += time.perf_counter() - started
+        await client.sendall(data)
+        if client.shard:
+            client.shard.observe(REWRITE, spent)
+
+    async def send_cached(self, request, cached, client):
+        response, body, client_keep_alive = cached_response(request, cached)
+        await client.sendall(response.encode())
+        if body:
+            for part in cached.chunks():
+                await client.sendall(part)
+        return client_keep_alive
+
+    async def send_stats(self, request, client):
+        data, client_keep_alive = stats_response(request, render_stats(self.metrics, self.pool, self.cache))
+        await client.sendall(data)
+        return client_keep_alive
+
+    async def tunnel(self, request, client):
+        address = parse_authority(request.start_line.split()[1])
+        if address is None:
+            await client.sendall(BAD_REQUEST)
+            return False
+        if self.filters.current().blocks(tunnel_url(address)):
+            await client.sendall(BLOCKED)
+            return False
+
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(*address, limit=MAX_HEAD_SIZE), UPSTREAM_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Cannot connect to {address[0]}:{address[1]}")
+        upstream = AsyncStream(reader, writer, UPSTREAM_TIMEOUT)
+        self.streams.add(upstream)
+        try:
+            await client.sendall(CONNECTION_ESTABLISHED)
+            client_socket, upstream_socket = detach_socket(client), detach_socket(upstream)
+            try:
+                loop = asyncio.get_running_loop()
+                # Прочитанное транспортами до отключения лежит в буферах StreamReader, отдаем его первым.
+                # Транспорт на паузе и больше ничего не добавит: после feed_eof read() сразу вернет остаток
+                for stream, destination in ((client, upstream_socket), (upstream, client_socket)):
+                    stream.reader.feed_eof()
+                    data = await stream.reader.read()
+                    if data:
+                        await loop.sock_sendall(destination, data)
+                tunnel = Tunnel(client_socket, upstream_socket, address, self.tunnel_relay)
+                try:
+                    await async_relay_tunnel(tunnel)
+                finally:
+                    tunnel.close()
+                    self.pool.record_tunnel(tunnel)
+            finally:
+                client_socket.close()
+                upstream_socket.close()
+        finally:
+            self.streams.discard(upstream)
+            upstream.close()
+        return False
+
+    async def handle_request(self, request, client):
+        kind = classify_request(request)
+        if kind is None:
+            await client.sendall(BAD_REQUEST)
+            return False
+        if kind == TUNNEL:
+            client.shard = None
+            return await self.tunnel(request, client)
+        if kind == STATS:
+            client.shard = None
+            return await self.send_stats(request, client)
+        address, upstream_request = prepare_request(request)
+        if self.filters.current().blocks(request_url(address, upstream_request)):
+            await client.sendall(BLOCKED)
+            return False
+
+        cache = self.cache
+        key = cache and await self.in_cache(cache.request_key, request, address, upstream_request)
+        if not key:
+            return await self.forward(address, upstream_request, request, client)
+
+        cached = await self.in_cache(cache.lookup, key, request)
+        leader = False
+        try:
+            if cached and cached.fresh:
+                cache.record('hits')
+                return await self.send_cached(request, cached, client)
+
+            fill, leader = cache.collapse(key, asyncio.Event)
+            if not leader:
+                try:
+                    await asyncio.wait_for(fill.wait(), UPSTREAM_TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass
+                if cached:
+                    cached.close()
+                cached = await self.in_cache(cache.lookup, key, request)
+                if cached and cached.fresh:
+                    cache.record('collapsed')
+                    return await self.send_cached(request, cached, client)
+            cache.record('stale' if cached else 'misses')
+            return await self.forward(address, upstream_request, request, client, key, cached,
+                                      fill if leader else None)
+        finally:
+            if cached:
+                cached.close()
+            if leader:
+                cache.finish_fill(key, fill)
+
+    async def forward(self, address, upstream_request, request, client, key=None, cached=None, fill=None):
+        revalidating = cached is not None and add_validators(upstream_request, cached.entry)
+        request_time = time.time()
+        connection, response = await self.exchange(address, upstream_request, request, client)
+        reusable = revalidated = False
+        sink = None
+        try:
+            while is_informational(response):
+                await client.sendall(response.encode())
+                response = await connection.read_head()
+                if response is None:
+                    raise ConnectionError("Upstream closed the connection without a response")
+            response_time = time.time()
+
+            if revalidating and response.start_line.split()[1] == '304':
+                reusable = keeps_alive(response, response.start_line.split()[0])
+                response.remove_hop_by_hop()
+                self.cache.refresh(cached.entry, response, request_time, response_time)
+                revalidated = True
+                if fill:
+                    self.cache.finish_fill(key, fill)
+            else:
+                rules = rewrite_rules(response, self.filters.current(), address[0])
+                stored = None
+                if key and not rules and is_storable(request, response):
+                    stored = Message(response.start_line, list(response.headers))
+                    stored.remove_hop_by_hop()
+                    sink = CacheWriter(self.cache)
+                elif fill:
+                    self.cache.finish_fill(key, fill)
+
+                body, upstream_keep_alive, client_keep_alive = prepare_response(request, response)
+                if not body:
+                    await client.sendall(response.encode())
+                elif rules:
+                    upstream_framing = Message(response.start_line, list(response.headers))
+                    rewriter = body_rewriter(request, response, rules, request_url(address, upstream_request),
+                                             self.codings)
+                    chunked, client_keep_alive = prepare_streamed_body(request, response)
+                    await client.sendall(response.encode())
+                    await self.send_rewritten(upstream_framing, connection, rewriter, chunked, client)
+                else:
+                    await client.sendall(response.encode())
+                    await async_relay_body(response, connection, client, until_close=True, sink=sink)
+                if stored:
+                    await self.in_cache(self.cache.store, key, request, stored, request_time, response_time, sink)
+                reusable = upstream_keep_alive
+        finally:
+            self.pool.release(connection, address, reusable)
+            if sink:
+                sink.discard()
+
+        if revalidated:
+            return await self.send_cached(request, cached, client)
+        return client_keep_alive
+
+    async def handle_client(self, reader, writer):
+        client = AsyncStream(reader, writer, UPSTREAM_TIMEOUT)
+        self.streams.add(client)
+        try:
+            async with self.clients:
+                self.pool.stats['client_connections'] += 1
+                while True:
+                    try:
+                        request = await client.read_head(CLIENT_IDLE_TIMEOUT)
+                    except TimeoutError:
+                        break  # Клиент простаивает слишком долго
+                    if not request:
+                        break
+
+                    self.pool.stats['client_requests'] += 1
+                    client.responded = False
+                    client.shard = self.shard
+                    if self.shard:
+                        started, sent = time.perf_counter(), client.sent
+                    keep_alive = await self.handle_request(request, client)
+                    if client.shard:
+                        self.shard.record(time.perf_counter() - started, client.sent - sent)
+                    if not keep_alive:
+                        break
         except Exception as e:
             print(f"Error handling request: {e}")
+            self.pool.stats['errors'] += 1
+            if not client.responded and not client.timed_out:
+                writer.write(BAD_GATEWAY)
+        finally:
+            self.streams.discard(client)
+            client.close()
+
+    async def watch_timeouts(self):
+        while True:
+            await asyncio.sleep(1)
+            current_time = time.monotonic()
+            for stream in [stream for stream in self.streams if stream.deadline and stream.deadline < current_time]:
+                stream.abort()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_client, host, port, limit=MAX_HEAD_SIZE, backlog=1024)
+        watchdog = asyncio.ensure_future(self.watch_timeouts())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            watchdog.cancel()
+
+
+def raise_file_limit():
+    # Каждое соединение через прокси - два дескриптора, стандартных 1024 не хватит на тысячи клиентов
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HTTP proxy')
+    parser.add_argument('--host', default='0.0.0.0', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on')
+    parser.add_argument('--mode', choices=['threads', 'asyncio'], default='threads',
+                        help='Thread per connection or a single asyncio event loop')
+    parser.add_argument('--max-clients', type=int, default=10000,
+                        help='Clients served at once in asyncio mode, the rest wait in the queue')
+    parser.add_argument('--rules', help='Ad filter rules in Adblock Plus format, reloaded when the file changes')
+    parser.add_argument('--no-cache', action='store_true', help='Disable the shared response cache')
+    parser.add_argument('--cache-dir', default='proxy_cache', help='Directory for cached response bodies')
+    parser.add_argument('--cache-memory', type=int, default=CACHE_MEMORY_LIMIT // 1024 // 1024,
+                        help='Memory for cached bodies in MB')
+    parser.add_argument('--cache-disk', type=int, default=CACHE_DISK_LIMIT // 1024 // 1024,
+                        help='Disk space for cached bodies in MB, 0 keeps the cache in memory only')
+    parser.add_argument('--gzip-level', type=int, choices=range(10), default=GZIP_LEVEL,
+                        help='gzip level for rewritten pages, 0 disables gzip')
+    parser.add_argument('--brotli-quality', type=int, choices=range(12), default=BROTLI_QUALITY,
+                        help='Brotli quality for rewritten pages, 0 disables brotli (needs the brotli package)')
+    parser.add_argument('--tunnel-relay', choices=TUNNEL_RELAYS, default=TUNNEL_RELAYS[0],
+                        help='How CONNECT tunnels move data: splice in the kernel or copy through a buffer')
+    parser.add_argument('--no-metrics', action='store_true',
+                        help=f'Do not time requests, {STATS_PATH} then shows only pool and cache counters')
+    args = parser.parse_args()
+
+    raise_file_limit()
+    cache = None
+    if not args.no_cache:
+        cache = HTTPCache(args.cache_dir, args.cache_memory * 1024 * 1024, args.cache_disk * 1024 * 1024)
+    filters = FilterFile(args.rules)
+    codings = ContentCodings(args.gzip_level, args.brotli_quality)
+    metrics = None if args.no_metrics else Metrics()
+    print(f"Proxy server started on port {args.port} ({args.mode})")
+
+    if args.mode == 'asyncio':
+        proxy = AsyncProxyServer(args.max_clients, cache, filters, codings, args.tunnel_relay, metrics)
+        try:
+            asyncio.run(proxy.serve(args.host, args.port))
+        except KeyboardInterrupt:
+            proxy.pool.print_stats()
+            if cache:
+                cache.print_stats()
+        return
+
+    server = ThreadingTCPServer((args.host, args.port), ProxyHandler, cache, filters, codings,
+                                args.tunnel_relay, metrics)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.pool.print_stats()
+        if cache:
+            cache.print_stats()
+        server.server_close()
 
 
 if __name__ == '__main__':
-    HOST, PORT = '0.0.0.0', 8080
-    server = ThreadingTCPServer((HOST, PORT), ProxyHandler)
-    print(f"Proxy server started on port {PORT}")
-    server.serve_forever()
\ No newline at end of file
+    main()
@@ -0,0 +1,815 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import re
+import resource
+import socket
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import zlib
+from html import unescape
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlparse
+
+from http_proxy import (ATTRIBUTE_RE, CHUNK_SIZE, DEFAULT_FILTERS, HIDING_RULE_RE, RESOURCE_ELEMENTS, START_TAG_RE,
+                        TUNNEL_RELAYS, BodyRewriter, ContentDecoder, ContentEncoder, FilterList, HTMLRewriter, Metrics,
+                        NetworkRule, Selector, domain_applies, parse_domains)
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+PROXY_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'http_proxy.py')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def raise_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+# Заглушка сервера: на любой запрос отвечает телом фиксированного размера, соединения держит открытыми
+def run_upstream(port, body_size):
+    raise_file_limit()
+    body = b'x' * body_size
+    response = b'HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: %d\r\n\r\n' % body_size + body
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                if not head:
+                    break
+                writer.write(response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve():
+        server = await asyncio.start_server(handle, '127.0.0.1', port, backlog=4096)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+def start_upstream(body_size):
+    port = free_port()
+    process = multiprocessing.Process(target=run_upstream, args=(port, body_size), daemon=True)
+    process.start()
+    wait_port(port)
+    return process, port
+
+
+def start_proxy(mode, port, *options):
+    process = subprocess.Popen([sys.executable, PROXY_SCRIPT, '--mode', mode, '--host', '127.0.0.1',
+                                '--port', str(port), *options], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_port(port)
+    return process
+
+
+def wait_port(port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Port {port} is not listening")
+
+
+def stop_process(process):
+    process.terminate()
+    try:
+        process.wait(5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def process_memory(pid):
+    # (текущий RSS, пиковый RSS в МБ, число потоков) из /proc, только Linux
+    info = {}
+    try:
+        with open(f'/proc/{pid}/status') as file:
+            for line in file:
+                key, _, value = line.partition(':')
+                if value.split():
+                    info[key] = value.split()[0]
+    except OSError:
+        return None, None, None
+    return int(info['VmRSS']) / 1024, int(info['VmHWM']) / 1024, int(info['Threads'])
+
+
+def process_cpu(pid):
+    # Процессорное время процесса в секундах (user + system) из /proc, только Linux
+    try:
+        with open(f'/proc/{pid}/stat') as file:
+            fields = file.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return 0.0
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+class LoadResult:
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.connected = 0
+
+
+async def client(proxy_port, url, result, stop_at, think, connect_slots):
+    # Медленный клиент: держит соединение и раз в think секунд делает запрос
+    try:
+        async with connect_slots:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', proxy_port), 30)
+    except (OSError, asyncio.TimeoutError):
+        result.errors += 1
+        return
+
+    result.connected += 1
+    request = f'GET {url} HTTP/1.1\r\nHost: bench\r\n\r\n'.encode()
+    # Разносим первые запросы по времени, чтобы клиенты не шли строем
+    await asyncio.sleep(random.random() * think)
+    try:
+        while time.monotonic() < stop_at:
+            started = time.monotonic()
+            writer.write(request)
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 30)
+            length = 0
+            for line in head.split(b'\r\n'):
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':', 1)[1])
+            await asyncio.wait_for(reader.readexactly(length), 30)
+            if not head.startswith(b'HTTP/1.1 200'):
+                result.errors += 1
+            else:
+                result.latencies.append(time.monotonic() - started)
+            await asyncio.sleep(think)
+    except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+        result.errors += 1
+    finally:
+        writer.close()
+
+
+async def generate_load(proxy_port, upstream_port, connections, duration, think, proxy_pid):
+    result = LoadResult()
+    url = f'http://127.0.0.1:{upstream_port}/'
+    connect_slots = asyncio.Semaphore(256)
+    started = time.monotonic()
+    stop_at = started + duration
+    tasks = [asyncio.ensure_future(client(proxy_port, url, result, stop_at, think, connect_slots))
+             for _ in range(connections)]
+
+    # Память прокси снимаем в середине теста, когда все клиенты подключены
+    await asyncio.sleep(duration / 2)
+    memory = process_memory(proxy_pid)
+    await asyncio.gather(*tasks)
+    return result, time.monotonic() - started, memory
+
+
+def bench_load(args):
+    limit = raise_file_limit()
+    # Прокси держит по дескриптору на клиента и еще пул соединений со старшим сервером
+    if limit < max(args.connections) + 1024:
+        print(f"Warning: open file limit {limit} is too low for {max(args.connections)} connections")
+
+    upstream, upstream_port = start_upstream(args.body_size)
+    print(f"Clients send a request every {args.think} s for {args.duration} s, "
+          f"response body {args.body_size} bytes, CPUs: {os.cpu_count()}")
+    print(f"{'mode':<10}{'conns':>8}{'req/s':>10}{'p50, ms':>10}{'p99, ms':>10}{'errors':>8}"
+          f"{'RSS, MB':>10}{'peak, MB':>10}{'threads':>9}")
+
+    try:
+        for connections in args.connections:
+            for mode in args.modes:
+                port = free_port()
+                proxy = start_proxy(mode, port)
+                try:
+                    result, elapsed, memory = asyncio.run(generate_load(
+                        port, upstream_port, connections, args.duration, args.think, proxy.pid))
+                    _, peak, _ = process_memory(proxy.pid)
+                finally:
+                    stop_process(proxy)
+
+                rss, _, threads = memory
+                print(f"{mode:<10}{connections:>8}{len(result.latencies) / elapsed:>10.0f}"
+                      f"{percentile(result.latencies, 50) * 1000:>10.1f}{percentile(result.latencies, 99) * 1000:>10.1f}"
+                      f"{result.errors:>8}{rss or 0:>10.1f}{peak or 0:>10.1f}{threads or 0:>9}")
+    finally:
+        upstream.terminate()
+
+
+# Прежняя обработка HTML через BeautifulSoup, эталон для сравнения с потоковой правкой
+def bs4_process_response(body, host):
+    try:
+        soup = BeautifulSoup(body.decode('utf-8', errors='ignore'), 'html.parser')
+
+        # Удаляем рекламные элементы
+        for tag in soup.find_all(['img', 'script', 'iframe']):
+            if host == 'e1.ru' and 'ad' in tag.get('class', []):
+                tag.decompose()
+            elif host == 'vk.com' and tag.name == 'img':
+                tag.decompose()
+
+        return str(soup).encode('utf-8')
+    except Exception as e:
+        print(f"Processing error: {e}")
+    return body
+
+
+def stream_rewrite(body, host, chunk_size=CHUNK_SIZE, filters=FilterList(DEFAULT_FILTERS)):
+    rewriter = HTMLRewriter(filters.for_host(host), f'http://{host}/')
+    parts = [rewriter.feed(body[offset:offset + chunk_size]) for offset in range(0, len(body), chunk_size)]
+    parts.append(rewriter.close())
+    return b''.join(parts)
+
+
+def synthetic_page(size, seed=1):
+    # Новостная страница: абзацы, ссылки, картинки и рекламные блоки, скрипты с разметкой в строках
+    rng = random.Random(seed)
+    parts = ['<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>News &amp; ads</title>\n'
+             '<style>.ad { display: block } p > a { color: red }</style>\n'
+             '<script>var banner = "<img src=\'/x.gif\'>"; if (a < b && c > d) { document.write("</div>"); }</script>\n'
+             '</head><body>\n']
+    length = sum(map(len, parts))
+    block = 0
+    while length < size:
+        block += 1
+        kind = rng.random()
+        if kind < 0.4:
+            words = ' '.join(rng.choice(['news', 'city', 'price', 'rain', '&laquo;quote&raquo;', 'x < y', 'a&amp;b'])
+                             for _ in range(rng.randint(20, 80)))
+            piece = f'<div class="article"><p id="p{block}">{words} <a href="/n/{block}">more</a></p></div>\n'
+        elif kind < 0.6:
+            cls = rng.choice(['ad', 'photo', 'photo ad', 'adv', ''])
+            piece = f'<img class="{cls}" src="/img/{block}.jpg" alt="picture {block}">\n'
+        elif kind < 0.7:
+            cls = rng.choice(['ad', 'counter'])
+            piece = (f'<script class="{cls}" src="/js/{block}.js"></script>'
+                     f'<script>counter({block}, "<img src=/c.gif>");</script>\n')
+        elif kind < 0.8:
+            cls = rng.choice(['ad', 'video'])
+            piece = f'<iframe class="{cls}" src="/frame/{block}"><p>Frames are not supported</p></iframe>\n'
+        elif kind < 0.9:
+            piece = f'<!-- banner {block}: <img class="ad" src="/b.gif"> -->\n'
+        else:
+            piece = (f'<ul class="menu">' + ''.join(f'<li><a href="/s/{i}">Section {i}</a></li>' for i in range(5))
+                     + '</ul>\n')
+        parts.append(piece)
+        length += len(piece)
+    parts.append('</body></html>\n')
+    return ''.join(parts).encode('utf-8')
+
+
+class PageOutline(HTMLParser):
+    # Последовательность тегов и текст страницы: сериализация у BeautifulSoup своя, сравниваем по смыслу
+    def __init__(self):
+        super().__init__()
+        self.items = []
+        self.text = []
+
+    def handle_starttag(self, tag, attrs):
+        self.items.append((tag, dict(attrs).get('class')))
+
+    def handle_data(self, data):
+        self.text.append(data)
+
+    def handle_comment(self, data):
+        self.text.append(data)
+
+
+def page_outline(body):
+    outline = PageOutline()
+    outline.feed(body.decode('utf-8', errors='ignore'))
+    outline.close()
+    return outline.items, ' '.join(''.join(outline.text).split())
+
+
+def measure(function, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, best, peak / 1024 / 1024
+
+
+def bench_rewrite(args):
+    # Разбиение тела на части не должно влиять на результат
+    sample = synthetic_page(20000, seed=2)
+    for host in args.hosts:
+        whole = stream_rewrite(sample, host, len(sample))
+        for chunk_size in (1, 2, 3, 7, 64, 1000):
+            if stream_rewrite(sample, host, chunk_size) != whole:
+                print(f"MISMATCH: {host} output depends on chunk size {chunk_size}")
+                sys.exit(1)
+
+    if BeautifulSoup is None:
+        print("bs4 is not installed, timing the streaming rewriter only")
+    print(f"{'host':<8}{'page, KB':>10}{'bs4, ms':>10}{'stream, ms':>12}{'speedup':>9}{'MB/s':>8}"
+          f"{'bs4 peak, MB':>14}{'stream peak, MB':>17}{'removed':>9}")
+    for size in args.sizes:
+        body = synthetic_page(size * 1024)
+        for host in args.hosts:
+            rewritten, stream_time, stream_peak = measure(lambda: stream_rewrite(body, host), args.repeat)
+            removed = len(page_outline(body)[0]) - len(page_outline(rewritten)[0])
+            if BeautifulSoup is None:
+                print(f"{host:<8}{size:>10}{'-':>10}{stream_time * 1000:>12.1f}{'-':>9}"
+                      f"{len(body) / stream_time / 1024 / 1024:>8.0f}{'-':>14}{stream_peak:>17.2f}{removed:>9}")
+                continue
+
+            reference, bs4_time, bs4_peak = measure(lambda: bs4_process_response(body, host), args.repeat)
+            if page_outline(reference) != page_outline(rewritten):
+                print(f"MISMATCH: {host} {size} KB differs from the BeautifulSoup result")
+                sys.exit(1)
+            print(f"{host:<8}{size:>10}{bs4_time * 1000:>10.1f}{stream_time * 1000:>12.1f}"
+                  f"{bs4_time / stream_time:>8.1f}x{len(body) / stream_time / 1024 / 1024:>8.0f}"
+                  f"{bs4_peak:>14.2f}{stream_peak:>17.2f}{removed:>9}")
+
+
+def generate_rules(count, seed=1):
+    # Правила в духе EasyList: общие и доменные селекторы, домены рекламных сетей, пути, шаблоны и исключения
+    rng = random.Random(seed)
+    lines = ['[Adblock Plus 2.0]', '! Synthetic filter list']
+    for i in range(count):
+        kind = rng.random()
+        site = f'site{rng.randrange(200)}.ru'
+        if kind < 0.25:
+            lines.append(rng.choice([f'##.ad-{i}', f'##.sponsor-{i}', f'##div#banner-{i}', f'##a.promo-{i}.big']))
+        elif kind < 0.4:
+            lines.append(rng.choice([f'{site}##.promo-{i}', f'{site},~m.{site}##img.teaser-{i}', f'{site}##iframe']))
+        elif kind < 0.7:
+            lines.append(rng.choice([f'||ads{i}.network{i % 97}.com^', f'||track{i}.net^$third-party',
+                                     f'||cdn{i}.com/ads/*$image,script', f'||pix{i}.org^$domain={site}']))
+        elif kind < 0.88:
+            lines.append(rng.choice([f'/banner{i}/*', f'-ad-{i}.gif|', f'/adframe{i}.$subdocument', f'&adid{i}=']))
+        elif kind < 0.95:
+            lines.append(rng.choice([f'*/sponsor{i}*', f'*promo{i}x*', f'*.gif?ad{i}']))
+        else:
+            lines.append(rng.choice([f'@@||ads{i - 1}.network{(i - 1) % 97}.com^$image', f'{site}#@#.ad-{i - 1}',
+                                     f'##.weird:has(> .ad-{i})', f'||x{i}.com^$popup']))
+    # Регулярных выражений в настоящих списках единицы, их число от размера списка не зависит
+    lines.extend(f'/\\/ad{i}[0-9]+\\.js/' for i in range(10))
+    return '\n'.join(lines)
+
+
+def sample_elements(count, rules_count, seed=3):
+    # Элементы страниц: обычные и подходящие под сгенерированные правила
+    rng = random.Random(seed)
+    page = synthetic_page(256 * 1024, seed=seed)
+    elements = [(match.group(1).lower(), match.group(2)) for match in START_TAG_RE.finditer(page)]
+    for _ in range(count // 4):
+        i = rng.randrange(max(1, rules_count))
+        elements.append(rng.choice([
+            (b'div', b' class="ad-%d wide" id="x"' % i), (b'div', b' id="banner-%d"' % i),
+            (b'img', b' src="http://ads%d.network%d.com/a.gif"' % (i, i % 97)),
+            (b'img', b' class="teaser-%d" src="/t.jpg"' % i), (b'script', b' src="/banner%d/x.js"' % i),
+            (b'iframe', b' src="//cdn%d.com/ads/f.html"' % i), (b'img', b' src="/img/pic-ad-%d.gif"' % i),
+            (b'a', b' class="promo-%d big" href="/"' % i), (b'img', b' src="/p?x=1&amp;adid%d=5"' % i)]))
+    rng.shuffle(elements)
+    return elements[:count]
+
+
+class LinearFilters:
+    # Эталон: каждое правило проверяется по очереди, без индексов
+    def __init__(self, text):
+        self.hiding = []
+        self.unhiding = []
+        self.network = []
+        for line in text.splitlines():
+            line = line.strip()
+            if not line or line.startswith(('!', '[')):
+                continue
+            hiding = HIDING_RULE_RE.match(line)
+            if hiding:
+                domains, kind, selector_text = hiding.groups()
+                include, exclude = parse_domains(domains, ',')
+                if kind == '@':
+                    self.unhiding.append((selector_text.strip(), include))
+                elif not kind and Selector.parse(selector_text):
+                    self.hiding.append((Selector.parse(selector_text), include, exclude))
+                continue
+            allowing = line.startswith('@@')
+            try:
+                parsed = NetworkRule.parse(line[2:] if allowing else line)
+            except re.error:
+                continue
+            if parsed:
+                self.network.append((parsed[0], allowing))
+
+    def removes(self, host, tag, attributes, page_url):
+        element = http_proxy_element(attributes, tag)
+        element_id, classes, url = element
+        for selector, include, exclude in self.hiding:
+            if (domain_applies(host, include, exclude) and selector.matches(tag, element_id, classes)
+                    and not any(text == selector.text and (not domains or domain_applies(host, domains, []))
+                                for text, domains in self.unhiding)):
+                return True
+        if url is None:
+            return False
+        url = urljoin(page_url, unescape(url.decode('latin-1')).strip())
+        if not url.startswith(('http://', 'https://')):
+            return False
+        url_host = (urlparse(url).hostname or '').lower()
+        resource_type = RESOURCE_ELEMENTS[tag][1]
+        matched = [allowing for rule, allowing in self.network if rule.matches(url, url_host, host, resource_type)]
+        return False in matched and True not in matched
+
+
+def http_proxy_element(attributes, tag):
+    # (id, классы, адрес ресурса) элемента так же, как их разбирает HostRules.removes
+    element_id = url = None
+    classes = frozenset()
+    resource = RESOURCE_ELEMENTS.get(tag)
+    for match in ATTRIBUTE_RE.finditer(attributes):
+        name = match.group(1).lower()
+        value = (match.group(2) or b'').strip(b'"\'')
+        if name == b'class':
+            classes = frozenset(value.split())
+        elif name == b'id':
+            element_id = value or None
+        elif resource and name == resource[0]:
+            url = value
+    return element_id, classes, url
+
+
+def bench_filters(args):
+    hosts = ['news.site7.ru', 'site7.ru', 'm.site3.ru', 'example.com']
+    print(f"{'rules':>8}{'compile, ms':>13}{'host, ms':>10}{'ns/element':>12}{'linear ns/element':>19}"
+          f"{'removed':>9}{'unsupported':>13}")
+    for count in args.rules:
+        text = generate_rules(count)
+        started = time.perf_counter()
+        filters = FilterList(text)
+        compile_time = time.perf_counter() - started
+        elements = sample_elements(args.elements, count)
+
+        started = time.perf_counter()
+        host_rules = {host: filters.for_host(host) for host in hosts}
+        host_time = (time.perf_counter() - started) / len(hosts)
+
+        # Решения по адресам запоминаются, для честного замера каждый проход начинается с пустой памяти
+        removed = 0
+        elapsed = 0.0
+        for host in hosts:
+            filters.urls.clear()
+            page_url = f'http://{host}/news/1.html'
+            rules = host_rules[host]
+            started = time.perf_counter()
+            for tag, attributes in elements:
+                removed += rules.removes(tag, attributes, page_url)
+            elapsed += time.perf_counter() - started
+        per_element = elapsed / (len(elements) * len(hosts)) * 1e9
+
+        linear = '-'
+        if count <= args.linear_limit:
+            reference = LinearFilters(text)
+            sample = elements[:max(1, args.elements // 10)]
+            started = time.perf_counter()
+            for host in hosts:
+                page_url = f'http://{host}/news/1.html'
+                for tag, attributes in sample:
+                    expected = reference.removes(host, tag, attributes, page_url)
+                    if host_rules[host].removes(tag, attributes, page_url) != expected:
+                        print(f"MISMATCH: {host} <{tag.decode()}{attributes.decode()}> expected {expected}")
+                        sys.exit(1)
+            linear = f'{(time.perf_counter() - started) / (len(sample) * len(hosts)) * 1e9:.0f}'
+
+        print(f"{count:>8}{compile_time * 1000:>13.1f}{host_time * 1000:>10.2f}{per_element:>12.0f}{linear:>19}"
+              f"{removed:>9}{filters.skipped:>13}")
+
+
+def compress(data, coding, level):
+    if coding == 'br':
+        return brotli.compress(data, quality=level)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(data, coding):
+    if coding == 'br':
+        return brotli.decompress(data)
+    return zlib.decompress(data, zlib.MAX_WBITS | 16) if coding == 'gzip' else data
+
+
+def recode(body, host, upstream_coding, coding, level, part_size, filters=FilterList(DEFAULT_FILTERS)):
+    # Тот же путь, что у прокси: распаковка, правка HTML и сжатие для клиента по частям из сети
+    rewriter = BodyRewriter(HTMLRewriter(filters.for_host(host), f'http://{host}/'),
+                            ContentDecoder(upstream_coding) if upstream_coding != 'identity' else None,
+                            ContentEncoder(coding, level) if coding != 'identity' else None)
+    parts = [rewriter.feed(body[offset:offset + part_size]) for offset in range(0, len(body), part_size)]
+    parts.append(rewriter.close())
+    return b''.join(parts)
+
+
+def bench_compression(args):
+    codings = [('identity', 0)] + [('gzip', level) for level in args.gzip_levels]
+    if brotli is None:
+        print("brotli is not installed, measuring gzip only")
+    else:
+        codings += [('br', quality) for quality in args.brotli_qualities]
+    upstream_codings = ['gzip', 'br'] if brotli else ['gzip']
+
+    print(f"{'page, KB':>8}{'upstream':>10}{'client':>10}{'level':>7}{'in, KB':>9}{'out, KB':>9}{'of plain':>10}"
+          f"{'flush cost':>12}{'ms':>9}{'MB/s':>7}{'peak, MB':>10}")
+    for size in args.sizes:
+        page = synthetic_page(size * 1024)
+        expected = stream_rewrite(page, args.host)
+        for upstream_coding in upstream_codings:
+            body = compress(page, upstream_coding, 5 if upstream_coding == 'br' else 6)
+            for coding, level in codings:
+                output, elapsed, peak = measure(
+                    lambda: recode(body, args.host, upstream_coding, coding, level, args.part_size), args.repeat)
+                if decompress(output, coding) != expected:
+                    print(f"MISMATCH: {upstream_coding} -> {coding} {level} differs from the plain rewrite")
+                    sys.exit(1)
+                # Во сколько обходится сброс сжатия на каждой части по сравнению со сжатием целиком
+                flush_cost = f'{len(output) / len(compress(expected, coding, level)) - 1:+.1%}' if level else '-'
+                print(f"{size:>8}{upstream_coding:>10}{coding:>10}{level or '-':>7}{len(body) / 1024:>9.1f}"
+                      f"{len(output) / 1024:>9.1f}{len(output) / len(expected):>10.1%}{flush_cost:>12}"
+                      f"{elapsed * 1000:>9.1f}{len(page) / elapsed / 1024 / 1024:>7.0f}{peak:>10.2f}")
+
+
+TUNNEL_BLOCK = 1024 * 1024
+
+
+# Заглушка сервера для туннелей: после команды D отдает size байт и закрывает соединение,
+# после U читает все до конца и отвечает числом принятых байт
+def run_tunnel_upstream(port, size):
+    block = memoryview(b'x' * TUNNEL_BLOCK)
+
+    def serve(conn):
+        with conn:
+            if conn.recv(1) == b'D':
+                remaining = size
+                while remaining > 0:
+                    conn.sendall(block[:min(remaining, TUNNEL_BLOCK)])
+                    remaining -= TUNNEL_BLOCK
+                return
+            buffer = bytearray(TUNNEL_BLOCK)
+            received = 0
+            while True:
+                count = conn.recv_into(buffer)
+                if not count:
+                    break
+                received += count
+            conn.sendall(b'%d' % received)
+
+    server = socket.create_server(('127.0.0.1', port), backlog=1024)
+    while True:
+        conn, _ = server.accept()
+        threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+
+def tunnel_client(proxy_port, upstream_port, direction, size):
+    # Один туннель: через прокси, если задан его порт, иначе напрямую. Возвращает число переданных байт
+    if proxy_port:
+        sock = socket.create_connection(('127.0.0.1', proxy_port))
+        sock.sendall(f'CONNECT 127.0.0.1:{upstream_port} HTTP/1.1\r\nHost: 127.0.0.1:{upstream_port}\r\n\r\n'.encode())
+        head = b''
+        while not head.endswith(b'\r\n\r\n'):
+            part = sock.recv(1)
+            if not part:
+                raise ConnectionError("Proxy closed the connection")
+            head += part
+        if not head.startswith(b'HTTP/1.1 200'):
+            raise ConnectionError(head.split(b'\r\n', 1)[0].decode())
+    else:
+        sock = socket.create_connection(('127.0.0.1', upstream_port))
+    with sock:
+        buffer = bytearray(TUNNEL_BLOCK)
+        if direction == 'download':
+            sock.sendall(b'D')
+            received = 0
+            while True:
+                count = sock.recv_into(buffer)
+                if not count:
+                    break
+                received += count
+            return received
+        sock.sendall(b'U')
+        block = memoryview(buffer)
+        remaining = size
+        while remaining > 0:
+            sock.sendall(block[:min(remaining, TUNNEL_BLOCK)])
+            remaining -= TUNNEL_BLOCK
+        sock.shutdown(socket.SHUT_WR)
+        return int(sock.recv(64))
+
+
+def bench_tunnel(args):
+    size = args.size * 1024 * 1024
+    upstream_port = free_port()
+    upstream = multiprocessing.Process(target=run_tunnel_upstream, args=(upstream_port, size), daemon=True)
+    upstream.start()
+    wait_port(upstream_port)
+
+    setups = [('-', 'direct')] + [(mode, relay) for mode in args.modes for relay in args.relays]
+    print(f"{args.size} MB per tunnel over loopback, CPUs: {os.cpu_count()}")
+    print(f"{'mode':<10}{'relay':<8}{'tunnels':>8}{'direction':>10}{'MB/s':>8}{'proxy CPU, s/GB':>17}")
+    try:
+        for mode, relay in setups:
+            proxy = None
+            proxy_port = None
+            if relay != 'direct':
+                proxy_port = free_port()
+                proxy = start_proxy(mode, proxy_port, '--tunnel-relay', relay, '--no-cache')
+            try:
+                for tunnels in args.tunnels:
+                    for direction in ('download', 'upload'):
+                        with multiprocessing.Pool(tunnels) as pool:
+                            cpu = process_cpu(proxy.pid) if proxy else 0.0
+                            started = time.monotonic()
+                            transferred = pool.starmap(tunnel_client, [(proxy_port, upstream_port, direction, size)]
+                                                       * tunnels)
+                            elapsed = time.monotonic() - started
+                            cpu = process_cpu(proxy.pid) - cpu if proxy else 0.0
+                        if any(count != size for count in transferred):
+                            print(f"MISMATCH: {mode} {relay} {direction} transferred {transferred}, expected {size}")
+                            sys.exit(1)
+                        total = size * tunnels
+                        cpu_per_gb = f'{cpu / (total / 1024 ** 3):.2f}' if proxy else '-'
+                        print(f"{mode:<10}{relay:<8}{tunnels:>8}{direction:>10}{total / elapsed / 1024 / 1024:>8.0f}"
+                              f"{cpu_per_gb:>17}")
+            finally:
+                if proxy:
+                    stop_process(proxy)
+    finally:
+        upstream.terminate()
+
+
+class StubConnection:
+    # Соединение из пула: время DNS и connect уже забрано первым запросом
+    setup = None
+
+
+def record_cost(repeat=200000):
+    # Цена учета одного запроса внутри процесса - все, что добавляют метрики на пути запроса,
+    # включая раскладку по корзинам раз в FOLD_SIZE запросов
+    metrics = Metrics()
+    shard = metrics.acquire()
+    connection = StubConnection()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        request_started, sent = time.perf_counter(), 0
+        shard.upstream(connection, time.perf_counter())
+        shard.record(time.perf_counter() - request_started, 4096 - sent)
+    return (time.perf_counter() - started) / repeat
+
+
+def bench_metrics(args):
+    upstream, upstream_port = start_upstream(args.body_size)
+    print(f"{args.connections} keep-alive clients without pauses for {args.duration} s, "
+          f"response body {args.body_size} bytes, CPUs: {os.cpu_count()}")
+    cost = record_cost()
+    print(f"Recording one request costs {cost * 1e6:.2f} us in this process")
+    print(f"{'mode':<10}{'metrics':>8}{'req/s':>10}{'p50, ms':>10}{'errors':>8}{'proxy CPU, us/req':>19}{'overhead':>10}")
+    try:
+        for mode in args.modes:
+            # Прогоны без метрик и с ними идут парами, чтобы дрейф нагрузки на машине влиял на обе стороны;
+            # итог - медианы по повторам
+            runs = {False: [], True: []}
+            ratios = []
+            for _ in range(args.repeat):
+                for metrics in (False, True):
+                    port = free_port()
+                    proxy = start_proxy(mode, port, '--no-cache', *([] if metrics else ['--no-metrics']))
+                    try:
+                        cpu = process_cpu(proxy.pid)
+                        result, elapsed, _ = asyncio.run(generate_load(
+                            port, upstream_port, args.connections, args.duration, 0, proxy.pid))
+                        cpu = process_cpu(proxy.pid) - cpu
+                    finally:
+                        stop_process(proxy)
+                    requests = len(result.latencies)
+                    runs[metrics].append((cpu / max(requests, 1), requests / elapsed,
+                                          percentile(result.latencies, 50), result.errors))
+                ratios.append(runs[True][-1][0] / runs[False][-1][0] - 1)
+            for metrics in (False, True):
+                cpu, rate, p50 = (percentile([run[column] for run in runs[metrics]], 50) for column in range(3))
+                errors = sum(run[3] for run in runs[metrics])
+                overhead = f'{percentile(ratios, 50):+.1%}' if metrics else '-'
+                print(f"{mode:<10}{'on' if metrics else 'off':>8}{rate:>10.0f}{p50 * 1000:>10.2f}{errors:>8}"
+                      f"{cpu * 1e6:>19.1f}{overhead:>10}")
+            # Разница прогонов на одной машине тонет в шуме, поэтому бюджет считаем по цене учета
+            # относительно процессорного времени запроса без метрик
+            cpu = percentile([run[0] for run in runs[False]], 50)
+            print(f"{mode}: recording is {cost / cpu:.2%} of proxy CPU per request")
+    finally:
+        upstream.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HTTP proxy benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    load = commands.add_parser('load', help='Load test: threads vs asyncio')
+    load.add_argument('--modes', nargs='+', default=['threads', 'asyncio'],
+                      help='Proxy modes to compare')
+    load.add_argument('--connections', type=int, nargs='+', default=[100, 1000, 10000],
+                      help='Numbers of concurrent client connections')
+    load.add_argument('--duration', type=float, default=10.0,
+                      help='Length of each run in seconds')
+    load.add_argument('--think', type=float, default=1.0,
+                      help='Pause between requests of one client in seconds')
+    load.add_argument('--body-size', type=int, default=1024,
+                      help='Upstream response body size in bytes')
+    load.set_defaults(func=bench_load)
+
+    rewrite = commands.add_parser('rewrite', help='Ad removal: streaming HTML rewriter vs BeautifulSoup')
+    rewrite.add_argument('--sizes', type=int, nargs='+', default=[64, 1024, 8192],
+                         help='Page sizes in KB')
+    rewrite.add_argument('--hosts', nargs='+', default=['e1.ru', 'vk.com'],
+                         help='Hosts whose rules are applied')
+    rewrite.add_argument('--repeat', type=int, default=3,
+                         help='Runs per measurement, the best one is reported')
+    rewrite.set_defaults(func=bench_rewrite)
+
+    filters = commands.add_parser('filters', help='Ad filter engine: per-element cost as the rule count grows')
+    filters.add_argument('--rules', type=int, nargs='+', default=[100, 1000, 10000, 50000],
+                         help='Numbers of generated rules')
+    filters.add_argument('--elements', type=int, default=20000,
+                         help='Elements checked per host')
+    filters.add_argument('--linear-limit', type=int, default=10000,
+                         help='Largest rule count also checked against the linear reference matcher')
+    filters.set_defaults(func=bench_filters)
+
+    compression = commands.add_parser('compression', help='Rewriting compressed pages: decode, rewrite and re-encode')
+    compression.add_argument('--sizes', type=int, nargs='+', default=[64, 1024],
+                             help='Page sizes in KB')
+    compression.add_argument('--host', default='e1.ru',
+                             help='Host whose rules are applied')
+    compression.add_argument('--gzip-levels', type=int, nargs='+', default=[1, 6, 9],
+                             help='gzip levels toward the client')
+    compression.add_argument('--brotli-qualities', type=int, nargs='+', default=[1, 5, 9],
+                             help='Brotli qualities toward the client')
+    compression.add_argument('--part-size', type=int, default=16 * 1024,
+                             help='Size of the compressed parts read from upstream')
+    compression.add_argument('--repeat', type=int, default=3,
+                             help='Runs per measurement, the best one is reported')
+    compression.set_defaults(func=bench_compression)
+
+    tunnel = commands.add_parser('tunnel', help='CONNECT tunnel throughput over loopback')
+    tunnel.add_argument('--modes', nargs='+', default=['threads', 'asyncio'],
+                        help='Proxy modes to compare')
+    tunnel.add_argument('--relays', nargs='+', default=TUNNEL_RELAYS, choices=TUNNEL_RELAYS,
+                        help='Tunnel relays to compare')
+    tunnel.add_argument('--tunnels', type=int, nargs='+', default=[1, 8],
+                        help='Numbers of parallel tunnels')
+    tunnel.add_argument('--size', type=int, default=1024,
+                        help='Data sent through each tunnel in MB')
+    tunnel.set_defaults(func=bench_tunnel)
+
+    metrics = commands.add_parser('metrics', help='Cost of per-request timing: proxy CPU per request with and without it')
+    metrics.add_argument('--modes', nargs='+', default=['threads', 'asyncio'],
+                         help='Proxy modes to compare')
+    metrics.add_argument('--connections', type=int, default=32,
+                         help='Concurrent keep-alive clients')
+    metrics.add_argument('--duration', type=float, default=5.0,
+                         help='Length of each run in seconds')
+    metrics.add_argument('--body-size', type=int, default=1024,
+                         help='Upstream response body size in bytes')
+    metrics.add_argument('--repeat', type=int, default=5,
+                         help='Pairs of runs without and with metrics, medians are reported')
+    metrics.set_defaults(func=bench_metrics)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()